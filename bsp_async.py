@@ -0,0 +1,567 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+
+from bsp_upgrade import (
+    PROGRESS_PATTERN, PROGRESS_STATUS_INTERVAL, RECONNECT_DOWN_GRACE, RECONNECT_PROBE_MAX, RECONNECT_PROBE_MIN,
+    RECONNECT_PROBE_TIMEOUT, STABILIZATION_WAIT, OutputTail, SSHConnectionError, backoff_delays,
+    bsp_dir_cleanup_commands, build_remote_command, check_command_output, connect_gateway, count_metric,
+    current_gateway, get_bsp_file_for_version, get_bsp_manifest, get_hop_stats, get_journal, get_reboot_stats,
+    get_remote_shell, get_sftp_session, journal_phase, journal_reached, journal_resume_point, log_output_line,
+    log_timings, observe_metric, open_progress_stream, parse_bsp_version, pause_seconds, plan_gateway_upgrade,
+    prestage_next_hop, record_run_metrics, renew_connection, timed, upload_and_prepare_bsp, upload_slot, logger,
+)
+from bsp_planner import version_matches
+
+# Threads used for short calls that paramiko can only do blocking (handshakes, channel opens, journal writes).
+# Waiting on reboots and polling never occupies one of these.
+ASYNC_BLOCKING_WORKERS = 32
+# Threads that run whole uploads and pre-stagings, kept apart so that short calls never queue behind them
+ASYNC_TRANSFER_WORKERS = 16
+
+# Channel polling interval bounds while a remote command is running (seconds)
+ASYNC_POLL_MIN = 0.01
+ASYNC_POLL_MAX = 0.25
+
+# How often a gateway waiting for a slot of the rollout's upload budget checks again (seconds)
+ASYNC_UPLOAD_SLOT_POLL = 1
+
+
+_transfer_executor = contextvars.ContextVar('bsp_transfer_executor', default=None)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a short blocking call in the executor, keeping the caller's gateway context"""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(ctx.run, func, *args, **kwargs))
+
+
+async def run_transfer(func, *args, **kwargs):
+    """run_blocking for a whole upload, on the transfer executor of run_async when there is one"""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_transfer_executor.get(), functools.partial(ctx.run, func, *args, **kwargs))
+
+
+def async_timed(name):
+    """timed() as a decorator for coroutine functions"""
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timed(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+async def async_pause(seconds):
+    """Coroutine version of pause: asyncio.sleep counted as fixed waiting"""
+    start = time.monotonic()
+    await asyncio.sleep(pause_seconds(seconds))
+    current_gateway().timings.slept(time.monotonic() - start)
+
+
+def _open_exec_channel(ssh, command, timeout):
+    chan = ssh.open_channel(timeout=timeout)
+    chan.exec_command(command)
+    return chan
+
+
+async def async_shell_run(shell, command, timeout, out, err):
+    """Coroutine version of RemoteShell.run that waits for the reply without holding a thread"""
+    while not shell.lock.acquire(blocking=False):
+        await asyncio.sleep(ASYNC_POLL_MIN)
+    try:
+        reply = shell.start(command, out, err)
+        last_data = time.monotonic()
+        poll = ASYNC_POLL_MIN
+        while not reply.done:
+            if shell.receive(reply):
+                last_data = time.monotonic()
+                poll = ASYNC_POLL_MIN
+                continue
+            shell.check_alive()
+            if time.monotonic() - last_data > timeout:
+                shell.close()
+                raise TimeoutError(f"No output for {timeout} seconds")
+            await asyncio.sleep(poll)
+            poll = min(poll * 2, ASYNC_POLL_MAX)
+        return reply.finish()
+    finally:
+        shell.lock.release()
+
+
+async def async_exec_run(ssh, command, timeout, out, err):
+    """Run command on its own exec channel, polling it from the event loop. Returns the exit status"""
+    chan = await run_blocking(_open_exec_channel, ssh, command, timeout)
+    try:
+        last_data = time.monotonic()
+        poll = ASYNC_POLL_MIN
+        while True:
+            got_data = False
+            while chan.recv_ready():
+                out.write(chan.recv(32768))
+                got_data = True
+            while chan.recv_stderr_ready():
+                err.write(chan.recv_stderr(32768))
+                got_data = True
+
+            if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+                break
+            if chan.closed:
+                if not chan.exit_status_ready():
+                    # The connection dropped (e.g. a reboot) before the command finished
+                    raise paramiko.SSHException("Channel closed before the command exited")
+                break
+
+            now = time.monotonic()
+            if got_data:
+                last_data = now
+                poll = ASYNC_POLL_MIN
+            else:
+                if now - last_data > timeout:
+                    raise TimeoutError(f"No output for {timeout} seconds")
+                poll = min(poll * 2, ASYNC_POLL_MAX)
+            await asyncio.sleep(poll)
+        exit_status = chan.recv_exit_status()
+    finally:
+        chan.close()
+    if exit_status == -1:
+        raise paramiko.SSHException("Channel closed before the command exited")
+    out.close()
+    err.close()
+    return exit_status
+
+
+async def async_execute_command(ssh, command, use_sudo=False, timeout=30, on_line=None):
+    """
+    Coroutine version of execute_command: runs through the gateway's persistent shell like it,
+    else on an exec channel, and waits for output without holding a thread
+    """
+    start = time.monotonic()
+    try:
+        out = OutputTail('stdout', on_line=on_line)
+        err = OutputTail('stderr', on_line=on_line)
+        gw = current_gateway()
+        # Opening the shell is a blocking handshake; once open it is reused without one
+        shell = gw.shell if gw.shell and gw.shell.transport is ssh.get_transport() and gw.shell.active else None
+        shell = shell or await run_blocking(get_remote_shell, ssh)
+        if shell:
+            # The persistent shell is already elevated, so no per-command sudo
+            command = build_remote_command(command, use_sudo=False)
+            logger.debug(f"Executing command: {command}")
+            _, _, exit_status = await async_shell_run(shell, command, timeout, out, err)
+        else:
+            command = build_remote_command(command, use_sudo)
+            logger.debug(f"Executing command: {command}")
+            exit_status = await async_exec_run(ssh, command, timeout, out, err)
+
+        check_command_output(command, out.text(), err.text(), None if exit_status == -1 else exit_status)
+        return out.text().strip()
+    except Exception as e:
+        logger.error(f"Error executing command: {command}\nError: {str(e)}")
+        raise
+    finally:
+        current_gateway().timings.command(time.monotonic() - start)
+
+
+async def async_check_bsp_version(ssh):
+    """Coroutine version of check_bsp_version"""
+    output = await async_execute_command(ssh, 'system_version', use_sudo=not current_gateway().is_root)
+    return parse_bsp_version(output)
+
+
+async def async_probe_ssh_port(host, port, timeout=RECONNECT_PROBE_TIMEOUT):
+    """Coroutine version of probe_ssh_port"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        return (await asyncio.wait_for(reader.read(4), timeout)).startswith(b'SSH-')
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+async def async_wait_for_ssh_port(timeout, max_delay=RECONNECT_PROBE_MAX):
+    """Coroutine version of wait_for_ssh_port"""
+    gw = current_gateway()
+    deadline = time.time() + timeout
+    delays = backoff_delays(RECONNECT_PROBE_MIN, max_delay)
+    while not await async_probe_ssh_port(gw.ip, gw.port):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        await async_pause(min(next(delays), remaining))
+    return True
+
+
+async def async_wait_for_ssh_down(timeout=RECONNECT_DOWN_GRACE):
+    """Coroutine version of wait_for_ssh_down"""
+    gw = current_gateway()
+    deadline = time.time() + timeout
+    while await async_probe_ssh_port(gw.ip, gw.port):
+        if time.time() >= deadline:
+            return False
+        await async_pause(RECONNECT_PROBE_MIN)
+    return True
+
+
+@async_timed('reconnect')
+async def async_reconnect_ssh(max_attempts=10, delay=30):
+    """
+    Coroutine version of reconnect_ssh: probes the SSH port on the event loop and only takes
+    a blocking worker for the handshake once it answers
+    """
+    deadline = time.time() + max_attempts * delay
+    delays = backoff_delays(RECONNECT_PROBE_MIN, delay)
+    for attempt in range(max_attempts):
+        try:
+            if not await async_wait_for_ssh_port(max(deadline - time.time(), 0)):
+                raise SSHConnectionError(f"SSH port {current_gateway().port} not answering")
+
+            logger.info(f"Attempting to reconnect (attempt {attempt + 1}/{max_attempts})")
+            count_metric('bsp_reconnect_attempts_total')
+            ssh = await run_blocking(renew_connection)
+            try:
+                await async_execute_command(ssh, 'uptime')
+            except Exception:
+                ssh.close()
+                raise paramiko.SSHException("Connection established but not responding")
+
+            logger.info("SSH reconnection successful")
+            return ssh
+
+        except Exception as e:
+            wait = next(delays)
+            if attempt == max_attempts - 1 or time.time() + wait >= deadline:
+                raise SSHConnectionError(f"Failed to reconnect after {attempt + 1} attempts: {str(e)}")
+            logger.warning(f"Reconnection failed, retrying in {wait:.1f} seconds: {str(e)}")
+            await async_pause(wait)
+
+
+@async_timed('initiation')
+async def async_initiate_bsp_upgrade(ssh, dry_run=False):
+    """Initiate the BSP upgrade process. Returns the (possibly reconnected) SSH client"""
+    use_sudo = not current_gateway().is_root
+    logger.info("Initiating BSP upgrade...")
+
+    logger.info("Running opkg update...")
+    with timed('opkg update'):
+        await async_execute_command(ssh, 'opkg update', use_sudo=use_sudo, on_line=log_output_line)
+    await async_pause(5)
+    if dry_run:
+        logger.info("Skipping actual upgrade initiation (dry-run mode)")
+        return ssh
+
+    logger.info("Starting tektelic-dist-upgrade...")
+    await async_execute_command(ssh, 'export PATH=/usr/sbin:$PATH && tektelic-dist-upgrade -Ddu',
+                                use_sudo=use_sudo, on_line=log_output_line)
+    logger.info("BSP upgrade initiated")
+
+    await async_pause(20)
+
+    for attempt in range(10):
+        try:
+            output = await async_execute_command(ssh, 'system_version', use_sudo=use_sudo)
+            if "upgrade-in-progress" in output:
+                logger.info("Upgrade process detected. Upgrade in progress.")
+                return ssh
+        except Exception as e:
+            logger.warning(f"Error checking BSP version during upgrade initiation: {str(e)}")
+            await async_wait_for_ssh_down()
+            ssh = await async_reconnect_ssh(max_attempts=20)
+
+    raise Exception("Upgrade did not start properly after multiple checks.")
+
+
+async def async_read_progress(stream, timeout):
+    """UpgradeProgressStream.read for the event loop: waits for log lines without holding a thread"""
+    deadline = time.monotonic() + timeout
+    poll = ASYNC_POLL_MIN
+    while stream.active and not stream.chan.recv_ready() and time.monotonic() < deadline:
+        await asyncio.sleep(min(poll, max(deadline - time.monotonic(), 0)))
+        poll = min(poll * 2, ASYNC_POLL_MAX)
+    return stream.read(timeout=0)
+
+
+async def async_poll_progress(ssh):
+    """Coroutine version of process_upgrade_progress_messages"""
+    try:
+        output = await async_execute_command(ssh, 'dmesg | grep "BSP upgrade progress:" | tail -n 1', use_sudo=True)
+        match = PROGRESS_PATTERN.search(output)
+        return int(match.group(1)) if match else None
+    except Exception as e:
+        logger.error(f"Error processing upgrade progress messages: {str(e)}")
+        return None
+
+
+@async_timed('monitor')
+async def async_monitor_upgrade_progress(ssh, timeout=1800, check_interval=15, stabilize=True):
+    """Monitor the upgrade process across reboots. Returns the SSH client in use at the end"""
+    start_time = time.time()
+    upgrade_completed = False
+    last_progress = 0
+    upgrade_started = False
+    reboot_detected = False
+    reboot_count = 0
+    MAX_REBOOTS = 5
+    last_activity = time.time()
+    MAX_INACTIVITY = 120
+    stream = None
+    lost_at = None
+
+    try:
+        for _ in range(30):
+            try:
+                _, _, in_progress = await async_check_bsp_version(ssh)
+                if in_progress:
+                    upgrade_started = True
+                    break
+            except Exception as e:
+                logger.warning(f"Error checking BSP version during startup: {str(e)}")
+            await async_pause(1)
+
+        if not upgrade_started:
+            raise Exception("Upgrade did not start within 30 seconds")
+
+        stream = await run_blocking(open_progress_stream, ssh)
+        last_status_check = 0
+
+        while time.time() - start_time < timeout:
+            try:
+                current_time = time.time()
+                if stream:
+                    last_activity = max(last_activity, stream.last_activity)
+
+                if current_time - last_activity > MAX_INACTIVITY:
+                    raise Exception(f"No activity detected for {MAX_INACTIVITY} seconds")
+
+                # As in monitor_upgrade_progress: with a live progress stream system_version is only
+                # checked now and then, and a closed stream triggers a check right away
+                streaming = stream is not None and stream.active
+                if not streaming or current_time - last_status_check >= PROGRESS_STATUS_INTERVAL:
+                    last_status_check = current_time
+                    try:
+                        version_output = await async_execute_command(ssh, 'system_version', use_sudo=True)
+                        # A gateway going down may answer with nothing; that is not a completed upgrade
+                        _, _, in_progress = parse_bsp_version(version_output)
+                        last_activity = current_time
+
+                        if in_progress:
+                            logger.info("Upgrade is in progress...")
+                        else:
+                            logger.info("System appears to have completed upgrade")
+                            upgrade_completed = True
+                            break
+
+                    except Exception:
+                        if not reboot_detected:
+                            logger.info("Lost connection - system might be rebooting...")
+                            reboot_detected = True
+                            reboot_count += 1
+                            count_metric('bsp_reboots_total')
+                            if reboot_count > MAX_REBOOTS:
+                                raise Exception(f"Too many reboots detected ({reboot_count})")
+
+                            lost_at = time.time()
+                            await async_wait_for_ssh_down()
+                            typical = get_reboot_stats().typical(current_gateway().model)
+                            if typical:
+                                await async_pause(max(0, typical / 2 - (time.time() - lost_at)))
+
+                        if stream:
+                            stream.close()
+                            stream = None
+                        try:
+                            ssh = await async_reconnect_ssh(max_attempts=20)
+                            if reboot_detected:
+                                reboot_seconds = time.time() - lost_at
+                                await run_blocking(get_reboot_stats().record, current_gateway().model, reboot_seconds)
+                                current_gateway().timings.add('reboot gap', reboot_seconds)
+                                observe_metric('bsp_reboot_duration_seconds', reboot_seconds)
+                                logger.info(f"Successfully reconnected after reboot ({reboot_seconds:.0f}s)")
+                                await run_blocking(journal_phase, 'rebooted')
+                                reboot_detected = False
+                                last_activity = time.time()
+                            stream = await run_blocking(open_progress_stream, ssh)
+                            last_status_check = 0
+                        except Exception as reconnect_error:
+                            logger.error(f"Failed to reconnect: {str(reconnect_error)}")
+                        continue
+
+                if stream is not None and stream.active:
+                    progress = await async_read_progress(stream, min(check_interval, PROGRESS_STATUS_INTERVAL))
+                else:
+                    progress = await async_poll_progress(ssh)
+                if progress is not None and progress != last_progress:
+                    last_progress = progress
+                    last_activity = time.time()
+                    logger.info(f"Upgrade progress: {progress}%")
+
+                if stream is None or not stream.active:
+                    await async_pause(check_interval)
+
+            except Exception as loop_error:
+                logger.error(f"Error in monitoring loop: {str(loop_error)}")
+                if "Too many reboots detected" in str(loop_error):
+                    raise
+                continue
+
+        if not upgrade_completed:
+            raise TimeoutError("Upgrade process timed out")
+
+        if stabilize:
+            logger.info(f"Waiting {STABILIZATION_WAIT} seconds for system to stabilize...")
+            await async_pause(STABILIZATION_WAIT * 2)
+        logger.info("Upgrade process completed!")
+        return ssh
+
+    except Exception as e:
+        logger.error(f"Error monitoring upgrade: {str(e)}")
+        raise
+    finally:
+        if stream:
+            stream.close()
+
+
+@contextlib.asynccontextmanager
+async def async_upload_slot(bsp_file):
+    """upload_slot for the event loop: waits for a free slot without tying up an executor thread"""
+    while True:
+        with upload_slot(bsp_file, blocking=False) as granted:
+            if granted:
+                yield
+                return
+        await asyncio.sleep(ASYNC_UPLOAD_SLOT_POLL)
+
+
+def _upload_bsp(ssh, bsp_file):
+    return upload_and_prepare_bsp(ssh, get_sftp_session(ssh), bsp_file)
+
+
+@async_timed('hop')
+async def async_upgrade_to_version(ssh, version, model, dry_run=False, next_version=None):
+    """
+    Upgrade the system to the specified version, pre-staging next_version while it stabilizes.
+    Returns the SSH client in use at the end
+    """
+    logger.info(f"Starting upgrade to version {version}")
+
+    gw = current_gateway()
+    hop_start = time.time()
+    try:
+        bsp_file = get_bsp_file_for_version(version, model)
+        gw.hop = (version, get_bsp_manifest(bsp_file).sha256)
+        install_start = time.time()
+        if gw.upgrade_in_progress and await run_blocking(journal_reached, 'initiated'):
+            logger.info(f"Upgrade to {version} was already initiated (journal), resuming monitoring")
+        else:
+            async with async_upload_slot(bsp_file):
+                ssh = await run_transfer(_upload_bsp, ssh, bsp_file)
+            install_start = time.time()
+            ssh = await async_initiate_bsp_upgrade(ssh, dry_run=dry_run)
+            if dry_run:
+                return ssh
+            await run_blocking(journal_phase, 'initiated')
+        gw.upgrade_in_progress = False
+        ssh = await async_monitor_upgrade_progress(ssh, stabilize=False)
+
+        logger.info("Waiting for system to stabilize...")
+        stabilization = async_pause(STABILIZATION_WAIT * 3)
+        with timed('stabilization'):
+            if next_version:
+                _, ssh = await asyncio.gather(stabilization, run_transfer(prestage_next_hop, ssh, next_version, model))
+            else:
+                await stabilization
+        await run_blocking(get_hop_stats().record, f"{model} {version}", time.time() - install_start)
+        observe_metric('bsp_hop_duration_seconds', time.time() - hop_start, target=version)
+        await run_blocking(journal_phase, 'confirmed')
+        return ssh
+
+    except Exception as e:
+        logger.error(f"Error during upgrade to version {version}: {str(e)}")
+        raise
+    finally:
+        gw.hop = gw.hop_payload = None
+
+
+async def async_upgrade_gateway(dry_run=False):
+    """Run the full upgrade pipeline against the active gateway context on the event loop"""
+    gw = current_gateway()
+    ssh = None
+    error = None
+
+    try:
+        logger.info(f"Connecting to gateway {gw.ip}")
+        with timed('connect'):
+            ssh = await run_blocking(connect_gateway)
+
+        with timed('plan'):
+            _, model, upgrade_path, _, _ = await run_blocking(plan_gateway_upgrade, ssh)
+
+        resume = await run_blocking(journal_resume_point, upgrade_path, model)
+        if resume:
+            logger.info(f"Resuming upgrade to {resume.version} after phase '{resume.phase}' (journal), "
+                        f"keeping BSP directory")
+        else:
+            logger.info("Cleaning up BSP directory...")
+            with timed('cleanup'):
+                for command in bsp_dir_cleanup_commands():
+                    await async_execute_command(ssh, command, use_sudo=True)
+
+        for i, version in enumerate(upgrade_path):
+            next_version = upgrade_path[i + 1] if i + 1 < len(upgrade_path) else None
+            ssh = await async_upgrade_to_version(ssh, version, model, dry_run=dry_run, next_version=next_version)
+
+        if dry_run:
+            logger.info("Dry-run completed, skipping final version check")
+            return None
+
+        final_version, _, _ = await async_check_bsp_version(ssh)
+        gw.final_version = final_version
+        if version_matches(final_version, gw.target_version):
+            await run_blocking(get_journal().forget, gw.ip)
+            logger.info(f"Upgrade successful! Final BSP version is {final_version}")
+        else:
+            raise Exception(f"Upgrade failed! Final version is {final_version}, expected {gw.target_version}")
+        return final_version
+
+    except Exception as e:
+        error = e
+        logger.error(f"Upgrade process failed: {str(e)}")
+        raise
+    finally:
+        log_timings()
+        record_run_metrics(error)
+        if ssh:
+            try:
+                ssh.close()
+            except Exception as e:
+                logger.error(f"Error closing SSH connection: {str(e)}")
+
+
+def run_async(coro, blocking_workers=ASYNC_BLOCKING_WORKERS, transfer_workers=ASYNC_TRANSFER_WORKERS):
+    """
+    Run coro on a new event loop with bounded executors for blocking paramiko calls:
+    one for short calls and one for uploads (see run_transfer)
+    """
+    async def runner():
+        executor = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix='bsp-blocking')
+        asyncio.get_running_loop().set_default_executor(executor)
+        transfers = ThreadPoolExecutor(max_workers=transfer_workers, thread_name_prefix='bsp-transfer')
+        _transfer_executor.set(transfers)
+        try:
+            return await coro
+        finally:
+            transfers.shutdown(wait=False)
+
+    return asyncio.run(runner())
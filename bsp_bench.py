@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+import bsp_upgrade
+from bsp_upgrade import TransferSettings, open_transfer_channels, transfer_chunks
+from bsp_async import run_async
+from bsp_fleet import run_fleet, run_fleet_async
+from gateway_simulator import SIM_PASSWORD, SIM_USERNAME, LinkEmulator, SimulatedGateway, make_bsp_archive
+
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench'
+
+E2E_PAUSE_SCALE = 0.05  # Fixed waits of the pipeline during end-to-end benchmarks, as a share of their length
+E2E_TOLERANCE = 0.2  # Increase over the baseline that counts as a regression
+# End-to-end results compared against a baseline; lower is better for all of them
+E2E_REGRESSION_KEYS = ['active_seconds_per_hop', 'round_trips_per_hop', 'bytes_per_hop', 'wire_bytes_per_hop',
+                       'connections_per_gateway']
+
+
+class _RootedSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server interface serving a local directory as the remote filesystem root"""
+
+    def __init__(self, server, *args, root=None, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        try:
+            real = self._path(path)
+            out = []
+            for name in os.listdir(real):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(real, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0o644)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                mode = 'rb'
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = paramiko.SFTPHandle(flags)
+        handle.filename = self._path(path)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        if attr.st_size is not None:
+            try:
+                os.truncate(self._path(path), attr.st_size)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class LocalSFTPServer(paramiko.ServerInterface):
+    """Minimal paramiko SSH server exposing an SFTP subsystem rooted in a local directory"""
+
+    def __init__(self, root, host='127.0.0.1', port=0):
+        self.root = root
+        self.host = host
+        self.port = port
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._sock = None
+        self._transports = []
+        self._stop = threading.Event()
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (BENCH_USERNAME, BENCH_PASSWORD):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self._sock.listen(16)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _RootedSFTPServer, root=self.root)
+            self._transports.append(transport)
+            transport.start_server(server=self)
+
+    def stop(self):
+        self._stop.set()
+        if self._sock:
+            self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+
+def _connect(port):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect('127.0.0.1', port=port, username=BENCH_USERNAME, password=BENCH_PASSWORD,
+                look_for_keys=False, allow_agent=False)
+    return ssh
+
+
+def measure_transfer(port, local_file, settings):
+    """Upload local_file with the transfer engine and return throughput in MB/s"""
+    ssh = _connect(port)
+    try:
+        sftp = ssh.open_sftp()
+        remote_file = '/upload.bin'
+        sftp.open(remote_file, 'wb').close()
+        size = os.path.getsize(local_file)
+        chunks = list(range(max(1, -(-size // settings.chunk_size))))
+
+        start_time = time.time()
+        channels = open_transfer_channels(ssh, settings)
+        try:
+            transfer_chunks(channels, local_file, remote_file, settings.chunk_size, chunks, settings)
+        finally:
+            for channel in channels:
+                channel.close()
+        elapsed = time.time() - start_time
+
+        if sftp.stat(remote_file).st_size != size:
+            raise RuntimeError("Benchmark upload size mismatch")
+        sftp.close()
+        return size / (1024 * 1024) / elapsed
+    finally:
+        ssh.close()
+
+
+def measure_sftp_put(port, local_file):
+    """Baseline: paramiko's stock sftp.put"""
+    ssh = _connect(port)
+    try:
+        sftp = ssh.open_sftp()
+        start_time = time.time()
+        sftp.put(local_file, '/upload.bin')
+        elapsed = time.time() - start_time
+        sftp.close()
+        return os.path.getsize(local_file) / (1024 * 1024) / elapsed
+    finally:
+        ssh.close()
+
+
+def run_transfer_benchmark(size_mb, latency_ms, bandwidth_mbit, streams, requests, chunks_mb, window_mb):
+    """Benchmark every combination of the given settings over an emulated link"""
+    workdir = tempfile.mkdtemp(prefix='bsp_bench_')
+    server = LocalSFTPServer(os.path.join(workdir, 'remote'))
+    os.makedirs(server.root)
+    server.start()
+    link = LinkEmulator(server.port, latency_ms, bandwidth_mbit).start()
+
+    local_file = os.path.join(workdir, 'payload.bin')
+    with open(local_file, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    print(f"Link: {latency_ms}ms one-way latency, "
+          f"{f'{bandwidth_mbit}Mbit/s' if bandwidth_mbit else 'unlimited'} bandwidth, {size_mb}MB payload")
+    results = []
+    try:
+        baseline = measure_sftp_put(link.port, local_file)
+        print(f"{'sftp.put baseline':<52} {baseline:8.2f} MB/s")
+        results.append(('sftp.put', baseline))
+
+        for stream_count, max_requests, chunk_mb, window in itertools.product(streams, requests, chunks_mb, window_mb):
+            settings = TransferSettings(chunk_size=int(chunk_mb * 1024 * 1024), streams=stream_count,
+                                        max_requests=max_requests, window_size=int(window * 1024 * 1024))
+            rate = measure_transfer(link.port, local_file, settings)
+            label = f"streams={stream_count} requests={max_requests} chunk={chunk_mb}MB window={window}MB"
+            print(f"{label:<52} {rate:8.2f} MB/s")
+            results.append((label, rate))
+    finally:
+        link.stop()
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    best_label, best_rate = max(results, key=lambda r: r[1])
+    print(f"\nBest: {best_label} ({best_rate:.2f} MB/s, {best_rate / max(baseline, 1e-9):.1f}x sftp.put)")
+    return results
+
+
+def _isolate_state(workdir, archives_dir, target, pause_scale):
+    """Point the pipeline's archives, local state files and fixed waits at the benchmark"""
+    bsp_upgrade.BSP_DIR = archives_dir
+    bsp_upgrade.TARGET_BSP_VERSION = target
+    bsp_upgrade.PAUSE_SCALE = pause_scale
+    bsp_upgrade.TIMING_LOG_PATHS = []
+    for name in ('UPLOAD_CHECKPOINT_DIR', 'FEED_SERVER_DIR', 'BSP_CACHE_DIR', 'REBOOT_STATS_FILE',
+                 'HOP_STATS_FILE', 'JOURNAL_FILE', 'VERSION_INDEX_FILE'):
+        setattr(bsp_upgrade, name, os.path.join(workdir, os.path.basename(getattr(bsp_upgrade, name))))
+    # Progress goes to the per-gateway logs; the console and bsp_upgrade.log only get warnings
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(logging.WARNING)
+
+
+def run_e2e_benchmark(gateways=1, engine='threads', start_version='4.0.2', versions=('7.1.2',), model='Micro',
+                      upload_mode='full', latency_ms=0, bandwidth_mbit=None, package_kb=64,
+                      upgrade_seconds=5, reboot_seconds=3, pause_scale=E2E_PAUSE_SCALE):
+    """
+    Upgrade simulated gateways (gateway_simulator) from start_version to the last of versions
+    through the real pipeline, each behind its own emulated link, and return wall time, round trips
+    and bytes per hop. Gateway i listens on 127.0.0.(i + 2), since runs are keyed by gateway IP.
+    """
+    workdir = tempfile.mkdtemp(prefix='bsp_e2e_')
+    archives_dir = os.path.join(workdir, 'bsps')
+    os.makedirs(archives_dir)
+    for version in versions:
+        make_bsp_archive(os.path.join(archives_dir, f'BSP_{version}.zip'), version, package_kb=package_kb)
+    _isolate_state(workdir, archives_dir, versions[-1], pause_scale)
+
+    simulators, links, inventory = [], [], []
+    try:
+        for i in range(gateways):
+            host = f'127.0.0.{i + 2}'
+            simulator = SimulatedGateway(os.path.join(workdir, f'gw{i}'), model=model, version=start_version,
+                                         upgrade_seconds=upgrade_seconds, reboot_seconds=reboot_seconds,
+                                         host=host).start()
+            simulators.append(simulator)
+            links.append(LinkEmulator(simulator.port, latency_ms, bandwidth_mbit, target_host=host, host=host).start())
+            inventory.append({'ip': host, 'port': links[-1].port, 'username': SIM_USERNAME,
+                              'password': SIM_PASSWORD, 'sudo_password': None, 'model': model})
+
+        log_dir = os.path.join(workdir, 'logs')
+        start_time = time.time()
+        if engine == 'async':
+            results = run_async(run_fleet_async(inventory, gateways, log_dir, upload_mode=upload_mode))
+        else:
+            results = run_fleet(inventory, gateways, log_dir, upload_mode=upload_mode)
+        wall = time.time() - start_time
+    finally:
+        for link in links:
+            link.stop()
+        for simulator in simulators:
+            simulator.stop()
+
+    hops = sum(r['timings'].phases.get('hop', [0])[0] for r in results) or 1
+    summary = {
+        'gateways': gateways, 'engine': engine, 'upload_mode': upload_mode, 'path': results[0]['path'],
+        'latency_ms': latency_ms, 'bandwidth_mbit': bandwidth_mbit, 'pause_scale': pause_scale,
+        'failed': sum(1 for r in results if r['status'] != 'OK'),
+        'wall_seconds': wall,
+        'sleep_seconds_per_hop': sum(r['timings'].sleep_seconds for r in results) / hops,
+        'active_seconds_per_hop': sum(r['duration'] - r['timings'].sleep_seconds for r in results) / hops,
+        'round_trips_per_hop': sum(r['timings'].commands for r in results) / hops,
+        'round_trip_seconds_per_hop': sum(r['timings'].command_seconds for r in results) / hops,
+        'bytes_per_hop': sum(r['timings'].bytes_sent for r in results) / hops,
+        'wire_bytes_per_hop': sum(link.bytes_up + link.bytes_down for link in links) / hops,
+        'connections_per_gateway': sum(simulator.connections for simulator in simulators) / gateways,
+        'gateway_commands_per_hop': sum(len(simulator.commands) for simulator in simulators) / hops,
+    }
+    failed = [r for r in results if r['status'] != 'OK']
+    if failed:
+        print(f"{len(failed)} gateway(s) failed, first error: {failed[0]['error']} (logs in {log_dir})")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return summary
+
+
+def print_e2e_summary(summary):
+    bandwidth = f"{summary['bandwidth_mbit']}Mbit/s" if summary['bandwidth_mbit'] else 'unlimited'
+    print(f"{summary['gateways']} gateway(s), {summary['engine']} engine, {summary['upload_mode']} uploads, "
+          f"path {summary['path']}, link {summary['latency_ms']}ms / {bandwidth}, "
+          f"fixed waits x{summary['pause_scale']}")
+    print(f"Wall time:        {summary['wall_seconds']:.1f}s ({summary['failed']} failed)")
+    print(f"Per hop:          {summary['active_seconds_per_hop']:.1f}s active, "
+          f"{summary['sleep_seconds_per_hop']:.1f}s in fixed waits")
+    print(f"Round trips/hop:  {summary['round_trips_per_hop']:.0f} "
+          f"({summary['round_trip_seconds_per_hop']:.1f}s), "
+          f"{summary['gateway_commands_per_hop']:.0f} commands run on the gateway")
+    print(f"Bytes/hop:        {summary['bytes_per_hop'] / (1024 * 1024):.2f}MB sent, "
+          f"{summary['wire_bytes_per_hop'] / (1024 * 1024):.2f}MB on the wire")
+    print(f"SSH connections:  {summary['connections_per_gateway']:.1f} per gateway")
+
+
+def compare_e2e_baseline(summary, baseline, tolerance=E2E_TOLERANCE):
+    """Print each regression key against the baseline; returns the keys that regressed"""
+    regressed = []
+    for key in E2E_REGRESSION_KEYS:
+        old, new = baseline.get(key), summary[key]
+        if not old:
+            continue
+        change = new / old - 1
+        worse = change > tolerance
+        if worse:
+            regressed.append(key)
+        print(f"{key:<26} {old:12.1f} -> {new:12.1f}  {change:+7.1%}{'  REGRESSION' if worse else ''}")
+    return regressed
+
+
+def _number_list(value, cast=int):
+    return [cast(v) for v in value.split(',') if v]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="BSP upgrade benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    transfer = commands.add_parser('transfer', help="SFTP upload throughput over an emulated link")
+    transfer.add_argument('--size', type=int, default=32, help="Payload size in MB (default 32)")
+    transfer.add_argument('--latency', type=float, default=50, help="One-way latency in ms (default 50)")
+    transfer.add_argument('--bandwidth', type=float, default=None, help="Link bandwidth in Mbit/s (default unlimited)")
+    transfer.add_argument('--streams', type=_number_list, default=[1, 2, 4], help="Comma-separated stream counts")
+    transfer.add_argument('--requests', type=_number_list, default=[16, 64],
+                          help="Comma-separated outstanding request limits")
+    transfer.add_argument('--chunk', type=lambda v: _number_list(v, float), default=[4],
+                          help="Comma-separated chunk sizes in MB")
+    transfer.add_argument('--window', type=lambda v: _number_list(v, float), default=[8],
+                          help="Comma-separated SSH window sizes in MB")
+
+    e2e = commands.add_parser('e2e', help="Full upgrades of simulated gateways (gateway_simulator) over emulated links")
+    e2e.add_argument('--gateways', type=int, default=1, help="Simulated gateways upgraded at once (default 1)")
+    e2e.add_argument('--engine', choices=['threads', 'async'], default='threads', help="Fleet engine (default threads)")
+    e2e.add_argument('--from', dest='start_version', default='4.0.2',
+                     help="Release the gateways start at (default 4.0.2)")
+    e2e.add_argument('--versions', type=lambda v: [x for x in v.split(',') if x], default=['7.1.2'],
+                     help="Comma-separated BSP archives to generate; the last is the target (default 7.1.2)")
+    e2e.add_argument('--model', default='Micro', help="Gateway model (default Micro)")
+    e2e.add_argument('--upload-mode', choices=['full', 'delta', 'http', 'stream'], default='full',
+                     help="Upload mode (default full)")
+    e2e.add_argument('--latency', type=float, default=0, help="One-way latency in ms (default 0)")
+    e2e.add_argument('--bandwidth', type=float, default=None, help="Link bandwidth in Mbit/s (default unlimited)")
+    e2e.add_argument('--package-kb', type=int, default=64, help="Size of each generated package in KB (default 64)")
+    e2e.add_argument('--upgrade-seconds', type=float, default=5, help="Simulated install time (default 5)")
+    e2e.add_argument('--reboot-seconds', type=float, default=3, help="Simulated reboot downtime (default 3)")
+    e2e.add_argument('--pause-scale', type=float, default=E2E_PAUSE_SCALE,
+                     help=f"Multiplier of the pipeline's fixed waits (default {E2E_PAUSE_SCALE})")
+    e2e.add_argument('--json', default=None, help="Write the results to this file")
+    e2e.add_argument('--baseline', default=None, help="Compare with results written by --json; exit 1 on regressions")
+    e2e.add_argument('--tolerance', type=float, default=E2E_TOLERANCE,
+                     help=f"Increase over the baseline that counts as a regression (default {E2E_TOLERANCE})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger('paramiko').setLevel(logging.WARNING)
+    if args.command == 'transfer':
+        run_transfer_benchmark(args.size, args.latency, args.bandwidth, args.streams,
+                               args.requests, args.chunk, args.window)
+    elif args.command == 'e2e':
+        summary = run_e2e_benchmark(args.gateways, args.engine, args.start_version, args.versions, args.model,
+                                    args.upload_mode, args.latency, args.bandwidth, args.package_kb,
+                                    args.upgrade_seconds, args.reboot_seconds, args.pause_scale)
+        print_e2e_summary(summary)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(summary, f, indent=1)
+        if summary['failed']:
+            return 1
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if compare_e2e_baseline(summary, baseline, args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import zipfile
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def _atomic_write_json(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def file_sha256(path):
+    """SHA-256 of a local file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BSPManifest:
+    """Precomputed description of a BSP archive: files, per-file hashes and sizes, feed folders"""
+
+    def __init__(self, sha256, name, size, files):
+        self.sha256 = sha256
+        self.name = name
+        self.size = size
+        # {archive path: {'size', 'compressed_size', 'sha256', 'md5'}}, directories excluded
+        self.files = files
+
+    @property
+    def feeds(self):
+        """Top-level feed folders of the archive"""
+        return sorted({name.split('/', 1)[0] for name in self.files if '/' in name})
+
+    @property
+    def uncompressed_size(self):
+        return sum(entry['size'] for entry in self.files.values())
+
+    @classmethod
+    def build(cls, archive_path, sha256=None, name=None):
+        """Read every entry of an archive once and describe it"""
+        files = {}
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                sha = hashlib.sha256()
+                md5 = hashlib.md5()
+                with zf.open(info) as f:
+                    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                        sha.update(block)
+                        md5.update(block)
+                files[info.filename] = {
+                    'size': info.file_size,
+                    'compressed_size': info.compress_size,
+                    'sha256': sha.hexdigest(),
+                    'md5': md5.hexdigest(),
+                }
+        return cls(sha256 or file_sha256(archive_path), name or os.path.basename(archive_path),
+                   os.path.getsize(archive_path), files)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['sha256'], data['name'], data['size'], data['files'])
+
+    def save(self, path):
+        _atomic_write_json(path, {
+            'sha256': self.sha256,
+            'name': self.name,
+            'size': self.size,
+            'uncompressed_size': self.uncompressed_size,
+            'feeds': self.feeds,
+            'files': self.files,
+        })
+
+
+class BSPStore:
+    """
+    Local BSP archive store keyed by SHA-256.
+    Archives live in <root>/objects/<sha256>/<original name> next to their manifest.json.
+    Source files are only hashed again when their size or mtime changes.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._index_file = os.path.join(self.root, 'index.json')
+        self._lock = threading.RLock()
+        self._manifests = {}
+        self._index = None
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(self._index_file) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+            self._index.setdefault('sources', {})
+            self._index.setdefault('names', {})
+        return self._index
+
+    def _object_dir(self, sha256):
+        return os.path.join(self.root, 'objects', sha256)
+
+    def _archive_path(self, sha256, name):
+        return os.path.join(self._object_dir(sha256), name)
+
+    def find(self, name):
+        """Stored archive most recently imported under name, or None"""
+        with self._lock:
+            sha256 = self._load_index()['names'].get(name)
+            if sha256 and os.path.exists(self._archive_path(sha256, name)):
+                return self._archive_path(sha256, name)
+            return None
+
+    def names(self):
+        """Archive names present in the store"""
+        with self._lock:
+            return sorted(name for name in self._load_index()['names'] if self.find(name))
+
+    def import_archive(self, source):
+        """Add source to the store (hashing and indexing it once) and return the stored path"""
+        source = os.path.abspath(source)
+        stat = os.stat(source)
+        name = os.path.basename(source)
+
+        with self._lock:
+            index = self._load_index()
+            known = index['sources'].get(source)
+            if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                stored = self._archive_path(known['sha256'], name)
+                if os.path.exists(stored) and os.path.exists(os.path.join(os.path.dirname(stored), 'manifest.json')):
+                    if index['names'].get(name) != known['sha256']:
+                        index['names'][name] = known['sha256']
+                        _atomic_write_json(self._index_file, index)
+                    return stored
+
+        sha256 = file_sha256(source)
+        object_dir = self._object_dir(sha256)
+        stored = self._archive_path(sha256, name)
+        manifest_file = os.path.join(object_dir, 'manifest.json')
+
+        with self._lock:
+            os.makedirs(object_dir, exist_ok=True)
+            if not os.path.exists(stored):
+                # A copy rather than a hard link: overwriting the source in place must not alter the object
+                tmp = f"{stored}.tmp"
+                shutil.copyfile(source, tmp)
+                os.replace(tmp, stored)
+            if not os.path.exists(manifest_file):
+                BSPManifest.build(stored, sha256=sha256, name=name).save(manifest_file)
+
+            index = self._load_index()
+            index['sources'][source] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+            index['names'][name] = sha256
+            _atomic_write_json(self._index_file, index)
+        return stored
+
+    def manifest(self, archive_path):
+        """Manifest of a stored archive, memoized in memory; None for files outside the store"""
+        archive_path = os.path.abspath(archive_path)
+        with self._lock:
+            if archive_path not in self._manifests:
+                manifest_file = os.path.join(os.path.dirname(archive_path), 'manifest.json')
+                if not archive_path.startswith(self.root + os.sep) or not os.path.exists(manifest_file):
+                    return None
+                self._manifests[archive_path] = BSPManifest.load(manifest_file)
+            return self._manifests[archive_path]
+
+    def add_manifest(self, manifest):
+        """
+        Keep the manifest of an archive that is not stored itself (a delta built for one gateway),
+        so what was sent can still be checked once the archive is gone
+        """
+        with self._lock:
+            os.makedirs(self._object_dir(manifest.sha256), exist_ok=True)
+            manifest.save(os.path.join(self._object_dir(manifest.sha256), 'manifest.json'))
+
+    def manifest_by_sha256(self, sha256):
+        """Manifest of a stored archive or kept manifest with that SHA-256, or None"""
+        manifest_file = os.path.join(self._object_dir(sha256), 'manifest.json')
+        with self._lock:
+            return BSPManifest.load(manifest_file) if os.path.exists(manifest_file) else None
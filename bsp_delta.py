@@ -0,0 +1,182 @@
+import gzip
+import hashlib
+import posixpath
+import shutil
+import zipfile
+
+# Feed index files that are regenerated for the packages kept in a delta archive
+INDEX_FILES = ('Packages', 'Packages.gz', 'Packages.stamps')
+# Signed feeds cannot be re-indexed without the signing key, so they are always shipped whole
+SIGNATURE_FILES = ('Packages.sig', 'Packages.asc')
+
+
+class FeedPackage:
+    """A package stanza from a feed's Packages index"""
+
+    def __init__(self, feed, fields, stanza):
+        self.feed = feed
+        self.name = fields.get('Package')
+        self.version = fields.get('Version')
+        self.filename = posixpath.normpath(fields.get('Filename', ''))
+        self.md5 = fields.get('MD5Sum')
+        self.stanza = stanza
+
+    @property
+    def path(self):
+        """Path of the package file inside the BSP archive"""
+        return f"{self.feed}/{self.filename}"
+
+
+class DeltaPlan:
+    """Which packages of each feed are uploaded, reused from the gateway or skipped"""
+
+    def __init__(self):
+        self.upload = []
+        self.present = []
+        self.skipped = []
+        self.whole_feeds = []
+        self.total_bytes = 0
+        self.upload_bytes = 0
+
+    def kept(self, feed):
+        """Packages listed in the regenerated index of a feed"""
+        return [pkg for pkg in self.upload + self.present if pkg.feed == feed]
+
+
+def parse_packages(text):
+    """Split a Packages index into (fields, stanza) pairs"""
+    packages = []
+    for stanza in text.replace('\r\n', '\n').split('\n\n'):
+        stanza = stanza.strip('\n')
+        if not stanza:
+            continue
+        fields = {}
+        key = None
+        for line in stanza.split('\n'):
+            if line[:1] in (' ', '\t') and key:
+                fields[key] += '\n' + line
+            elif ':' in line:
+                key, value = line.split(':', 1)
+                fields[key] = value.strip()
+        if fields.get('Package'):
+            packages.append((fields, stanza))
+    return packages
+
+
+def parse_installed_packages(output):
+    """Parse `opkg list-installed` output into {package: version}"""
+    installed = {}
+    for line in output.splitlines():
+        parts = line.split(' - ')
+        if len(parts) >= 2:
+            installed[parts[0].strip()] = parts[1].strip()
+    return installed
+
+
+def parse_md5sum_output(output):
+    """Parse `md5sum` output into {path: digest}"""
+    digests = {}
+    for line in output.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2 and parts[1] != '-':
+            digests[parts[1].strip()] = parts[0]
+    return digests
+
+
+def read_feed_indexes(zf):
+    """
+    Return {feed: [FeedPackage]} for every top-level feed folder of an open BSP archive.
+    Feeds without a usable index, or with a signed one, map to None.
+    """
+    names = set(zf.namelist())
+    feeds = sorted({name.split('/', 1)[0] for name in names if '/' in name})
+    indexes = {}
+    for feed in feeds:
+        if any(f"{feed}/{sig}" in names for sig in SIGNATURE_FILES):
+            indexes[feed] = None
+        elif f"{feed}/Packages" in names:
+            text = zf.read(f"{feed}/Packages").decode('utf-8', 'replace')
+            indexes[feed] = [FeedPackage(feed, fields, stanza) for fields, stanza in parse_packages(text)]
+        elif f"{feed}/Packages.gz" in names:
+            text = gzip.decompress(zf.read(f"{feed}/Packages.gz")).decode('utf-8', 'replace')
+            indexes[feed] = [FeedPackage(feed, fields, stanza) for fields, stanza in parse_packages(text)]
+        else:
+            indexes[feed] = None
+    return indexes
+
+
+def _entry_md5(zf, name):
+    digest = hashlib.md5()
+    with zf.open(name) as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def plan_delta(bsp_file, installed, remote_digests, file_md5s=None):
+    """
+    Decide per package whether it must be uploaded.
+    A package is reused when an identical file already sits in its feed folder on the gateway,
+    skipped when the same version is installed, and uploaded otherwise.
+    remote_digests maps archive paths (feed/file) of the gateway's extracted packages to their md5;
+    file_md5s optionally gives the same for the archive, saving a read of packages without MD5Sum.
+    """
+    file_md5s = file_md5s or {}
+    plan = DeltaPlan()
+    with zipfile.ZipFile(bsp_file) as zf:
+        sizes = {info.filename: info.file_size for info in zf.infolist()}
+        for feed, packages in read_feed_indexes(zf).items():
+            if packages is None:
+                plan.whole_feeds.append(feed)
+                continue
+            for pkg in packages:
+                if pkg.path not in sizes:
+                    plan.skipped.append(pkg)
+                    continue
+                size = sizes[pkg.path]
+                plan.total_bytes += size
+
+                remote_md5 = remote_digests.get(pkg.path)
+                if remote_md5 and remote_md5 == (pkg.md5 or file_md5s.get(pkg.path) or _entry_md5(zf, pkg.path)):
+                    plan.present.append(pkg)
+                elif installed.get(pkg.name) == pkg.version:
+                    plan.skipped.append(pkg)
+                else:
+                    plan.upload.append(pkg)
+                    plan.upload_bytes += size
+    return plan
+
+
+def _copy_entry(src, dst, info):
+    if info.is_dir():
+        dst.writestr(info, b'')
+        return
+    with src.open(info) as fin, dst.open(info, 'w') as fout:
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+
+
+def build_delta_archive(bsp_file, delta_file, plan):
+    """Write a BSP archive holding only the planned uploads and regenerated feed indexes"""
+    uploads = {pkg.path for pkg in plan.upload}
+    referenced = {pkg.path for pkg in plan.upload + plan.present + plan.skipped}
+
+    with zipfile.ZipFile(bsp_file) as src, zipfile.ZipFile(delta_file, 'w', zipfile.ZIP_DEFLATED) as dst:
+        indexed_feeds = set()
+        for info in src.infolist():
+            feed, _, rest = info.filename.partition('/')
+            if not rest or feed in plan.whole_feeds:
+                _copy_entry(src, dst, info)
+                continue
+            indexed_feeds.add(feed)
+            if info.filename in referenced:
+                if info.filename in uploads:
+                    _copy_entry(src, dst, info)
+            elif rest not in INDEX_FILES:
+                _copy_entry(src, dst, info)
+
+        for feed in sorted(indexed_feeds):
+            text = '\n\n'.join(pkg.stanza for pkg in plan.kept(feed))
+            text = text + '\n' if text else ''
+            dst.writestr(f"{feed}/Packages", text)
+            dst.writestr(f"{feed}/Packages.gz", gzip.compress(text.encode()))
+    return delta_file
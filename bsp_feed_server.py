@@ -0,0 +1,76 @@
+import functools
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def extract_bsp(bsp_file, root, sha256):
+    """
+    Extract a BSP archive once into root/<sha256 prefix>/<archive name> and return that directory.
+    Keyed by content, so an archive re-imported under the same name with other packages gets its own copy.
+    """
+    name = os.path.splitext(os.path.basename(bsp_file))[0]
+    parent = os.path.join(root, sha256[:16])
+    target = os.path.join(parent, name)
+    if os.path.isdir(target):
+        return target
+
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f'.{name}.', dir=parent)
+    try:
+        with zipfile.ZipFile(bsp_file) as zf:
+            zf.extractall(staging)
+        os.replace(staging, target)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        if not os.path.isdir(target):
+            raise
+    return target
+
+
+class FeedServer:
+    """HTTP server publishing extracted BSP feeds from a local directory"""
+
+    def __init__(self, root, port=8080, bind=''):
+        self.root = os.path.abspath(root)
+        self.port = port
+        self.bind = bind
+        self._httpd = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        os.makedirs(self.root, exist_ok=True)
+        handler = functools.partial(_QuietHandler, directory=self.root)
+        self._httpd = ThreadingHTTPServer((self.bind, self.port), handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def running(self):
+        return self._httpd is not None
+
+    def publish(self, bsp_file, sha256):
+        """Extract bsp_file (of content sha256) under the served root and return its URL path relative to the root"""
+        with self._lock:
+            target = extract_bsp(bsp_file, self.root, sha256)
+            return os.path.relpath(target, self.root).replace(os.sep, '/')
+
+    def url(self, host):
+        """Base URL of the server as reached through host"""
+        return f"http://{host}:{self.port}"
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
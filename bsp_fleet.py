@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bsp_upgrade import (
+    UPLOAD_MODE, GatewayContext, gateway_context, get_bsp_file_for_version, get_bsp_manifest, get_log_history,
+    upgrade_gateway, logger,
+)
+from bsp_async import async_upgrade_gateway, run_async
+from bsp_metrics import FleetMetrics
+from bsp_relay import build_site_relays
+from bsp_rollout import UploadBudget, parse_waves, plan_waves
+from bsp_timing import PROFILERS, profiled
+
+DEFAULT_CONCURRENCY = 10
+DEFAULT_LOG_DIR = 'fleet_logs'
+DEFAULT_MAX_FAILURE_RATE = 0.2  # Share of failed gateways in a wave that halts a rollout
+
+INVENTORY_FIELDS = ['ip', 'username', 'password', 'model', 'sudo_password', 'site', 'lan_ip', 'relay', 'port']
+
+
+def load_inventory(path):
+    """
+    Load gateway inventory from a CSV file.
+    Expected columns: ip, username, password, model (optional), sudo_password (optional),
+    site, lan_ip and relay (optional, for the 'relay' upload mode), port (optional, default GATEWAY_SSH_PORT).
+    Blank lines and lines starting with '#' are ignored.
+    """
+    gateways = []
+    with open(path, newline='') as f:
+        rows = (line for line in f if line.strip() and not line.lstrip().startswith('#'))
+        for row in csv.DictReader(rows):
+            row = {k.strip(): (v or '').strip() for k, v in row.items() if k}
+            if not row.get('ip'):
+                raise ValueError(f"Inventory entry without ip: {row}")
+            gateways.append({
+                'ip': row['ip'],
+                'username': row.get('username') or 'root',
+                'password': row.get('password', ''),
+                'sudo_password': row.get('sudo_password') or None,
+                'model': row.get('model') or None,
+                'site': row.get('site') or None,
+                'lan_ip': row.get('lan_ip') or None,
+                'relay': (row.get('relay') or '').lower() in ('1', 'yes', 'true'),
+                'port': int(row['port']) if row.get('port') else None,
+            })
+
+    ips = [gw['ip'] for gw in gateways]
+    duplicates = sorted({ip for ip in ips if ips.count(ip) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate gateways in inventory: {', '.join(duplicates)}")
+    return gateways
+
+
+def order_by_expected_duration(gateways):
+    """
+    Longest expected upgrades first, by the historical run time of each gateway's inventory model,
+    so the slow ones do not start last and stretch the fleet run. Unknown models count as the median.
+    """
+    history = get_log_history()
+    default = history.run_seconds() or 0
+    return sorted(gateways, key=lambda entry: -(history.run_seconds(entry['model']) or default))
+
+
+def _new_context(entry, log_dir, context_options, relays=None):
+    return GatewayContext(
+        entry['ip'], entry['username'], entry['password'],
+        sudo_password=entry['sudo_password'],
+        model_hint=entry['model'],
+        log_file=os.path.join(log_dir, f"{entry['ip']}.log"),
+        port=entry.get('port'),
+        site=entry.get('site'),
+        relay=(relays or {}).get(entry.get('site')),
+        **context_options
+    )
+
+
+def _result(ctx, start_time, status, error=''):
+    return {
+        'ip': ctx.ip,
+        'status': status,
+        'error': error,
+        'model': ctx.model or ctx.model_hint or '?',
+        'from': ctx.start_version or '?',
+        'path': ' -> '.join(ctx.upgrade_path) or '-',
+        'final': ctx.final_version or '-',
+        'duration': time.time() - start_time,
+        'timings': ctx.timings,
+    }
+
+
+def _error_text(e):
+    return str(e).splitlines()[0] if str(e) else type(e).__name__
+
+
+def upgrade_one(entry, log_dir, dry_run=False, relays=None, **context_options):
+    """
+    Upgrade a single inventory entry inside its own gateway context.
+    relays maps sites to their SiteRelay (see build_site_relays).
+    context_options (target_version, upload_mode, feed_url, metrics) are passed to GatewayContext.
+    """
+    ctx = _new_context(entry, log_dir, context_options, relays)
+    start_time = time.time()
+    status, error = 'OK', ''
+
+    with gateway_context(ctx):
+        try:
+            upgrade_gateway(dry_run=dry_run, interactive=False)
+            if dry_run:
+                status = 'DRY-RUN'
+        except Exception as e:
+            status, error = 'FAILED', _error_text(e)
+        finally:
+            ctx.close()
+
+    return _result(ctx, start_time, status, error)
+
+
+async def upgrade_one_async(entry, log_dir, dry_run=False, relays=None, **context_options):
+    """Coroutine version of upgrade_one for the asyncio engine"""
+    ctx = _new_context(entry, log_dir, context_options, relays)
+    start_time = time.time()
+    status, error = 'OK', ''
+
+    with gateway_context(ctx):
+        try:
+            await async_upgrade_gateway(dry_run=dry_run)
+            if dry_run:
+                status = 'DRY-RUN'
+        except Exception as e:
+            status, error = 'FAILED', _error_text(e)
+        finally:
+            ctx.close()
+
+    return _result(ctx, start_time, status, error)
+
+
+def _site_relays(gateways, context_options):
+    if (context_options.get('upload_mode') or UPLOAD_MODE) != 'relay':
+        return {}
+    return build_site_relays(gateways)
+
+
+def run_fleet(gateways, concurrency=DEFAULT_CONCURRENCY, log_dir=DEFAULT_LOG_DIR, dry_run=False, relays=None,
+              **context_options):
+    """Upgrade all gateways with at most `concurrency` running at once"""
+    os.makedirs(log_dir, exist_ok=True)
+    logger.info(f"Starting fleet upgrade of {len(gateways)} gateways (concurrency {concurrency})")
+    if relays is None:
+        relays = _site_relays(gateways, context_options)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {
+            pool.submit(upgrade_one, entry, log_dir, dry_run, relays, **context_options): entry['ip']
+            for entry in order_by_expected_duration(gateways)
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            logger.info(f"[{result['ip']}] finished: {result['status']} "
+                        f"({len(results)}/{len(gateways)} done)")
+
+    order = {entry['ip']: i for i, entry in enumerate(gateways)}
+    results.sort(key=lambda r: order[r['ip']])
+    return results
+
+
+async def run_fleet_async(gateways, concurrency=DEFAULT_CONCURRENCY, log_dir=DEFAULT_LOG_DIR, dry_run=False,
+                          relays=None, **context_options):
+    """Upgrade all gateways from one event loop with at most `concurrency` running at once"""
+    os.makedirs(log_dir, exist_ok=True)
+    logger.info(f"Starting async fleet upgrade of {len(gateways)} gateways (concurrency {concurrency})")
+    if relays is None:
+        relays = _site_relays(gateways, context_options)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+
+    async def worker(entry):
+        nonlocal done
+        async with semaphore:
+            result = await upgrade_one_async(entry, log_dir, dry_run, relays, **context_options)
+        done += 1
+        logger.info(f"[{result['ip']}] finished: {result['status']} ({done}/{len(gateways)} done)")
+        return result
+
+    results = await asyncio.gather(*(worker(entry) for entry in order_by_expected_duration(gateways)))
+    order = {entry['ip']: i for i, entry in enumerate(gateways)}
+    results.sort(key=lambda r: order[r['ip']])
+    return results
+
+
+def estimate_wave_upload(wave, target_version):
+    """Bytes a wave uploads at least: the target archive once per gateway (multi-hop paths send more)"""
+    try:
+        bsp_file = get_bsp_file_for_version(target_version, None)
+    except Exception:
+        return None
+    return get_bsp_manifest(bsp_file).size * len(wave)
+
+
+def run_rollout(gateways, waves=None, concurrency=DEFAULT_CONCURRENCY, log_dir=DEFAULT_LOG_DIR, dry_run=False,
+                engine='threads', budget=None, max_failure_rate=DEFAULT_MAX_FAILURE_RATE, **context_options):
+    """
+    Upgrade gateways in waves, in inventory order: waves as parsed by bsp_rollout.parse_waves
+    (e.g. a canary gateway, then growing shares of the fleet), one wave at a time. A wave with
+    more than max_failure_rate of its gateways failed halts the rollout and the rest are skipped;
+    any failure halves the concurrency and upload budget of the waves after it.
+    budget (a bsp_rollout.UploadBudget) is shared by every gateway of the rollout.
+    """
+    planned = plan_waves(gateways, waves or [])
+    relays = _site_relays(gateways, context_options)
+    target_version = context_options.get('target_version') or GatewayContext.from_globals().target_version
+    results = []
+
+    for number, wave in enumerate(planned, 1):
+        estimate = estimate_wave_upload(wave, target_version)
+        seconds = budget.seconds_for(estimate) if budget and estimate else None
+        logger.info(f"Wave {number}/{len(planned)}: {len(wave)} gateways (concurrency {concurrency})"
+                    + (f", at least {estimate / (1024 * 1024):.1f}MB to upload" if estimate else "")
+                    + (f", {seconds:.0f}s at the bandwidth budget" if seconds else ""))
+
+        wave_concurrency = min(concurrency, len(wave))
+        if engine == 'async':
+            wave_results = run_async(run_fleet_async(wave, wave_concurrency, log_dir, dry_run, relays,
+                                                     throttle=budget, **context_options))
+        else:
+            wave_results = run_fleet(wave, wave_concurrency, log_dir, dry_run, relays, throttle=budget,
+                                     **context_options)
+        results.extend(wave_results)
+
+        failed = sum(1 for r in wave_results if r['status'] == 'FAILED')
+        remaining = [entry for later in planned[number:] for entry in later]
+        if not failed or not remaining:
+            continue
+        rate = failed / len(wave)
+        if rate > max_failure_rate:
+            logger.error(f"Wave {number}: {failed}/{len(wave)} gateways failed (over {max_failure_rate:.0%}), "
+                         f"halting rollout; {len(remaining)} gateways not started")
+            results.extend(_skipped(entry, f"rollout halted after wave {number}") for entry in remaining)
+            break
+        concurrency = max(1, concurrency // 2)
+        if budget:
+            budget.throttle(0.5)
+        logger.warning(f"Wave {number}: {failed}/{len(wave)} gateways failed, throttling the next waves "
+                       f"to concurrency {concurrency}")
+
+    order = {entry['ip']: i for i, entry in enumerate(gateways)}
+    results.sort(key=lambda r: order[r['ip']])
+    return results
+
+
+def _skipped(entry, reason):
+    return {
+        'ip': entry['ip'], 'status': 'SKIPPED', 'error': reason, 'model': entry['model'] or '?',
+        'from': '?', 'path': '-', 'final': '-', 'duration': 0, 'timings': None,
+    }
+
+
+def print_summary(results):
+    """Print a final summary table for a fleet run"""
+    columns = [
+        ('IP', 'ip'), ('Model', 'model'), ('From', 'from'), ('Path', 'path'),
+        ('Final', 'final'), ('Status', 'status'), ('Time', 'duration'), ('Error', 'error'),
+    ]
+    rows = []
+    for r in results:
+        row = dict(r, duration=f"{r['duration'] / 60:.1f}m")
+        rows.append([str(row[key]) for _, key in columns])
+
+    widths = [max([len(title)] + [len(row[i]) for row in rows]) for i, (title, _) in enumerate(columns)]
+    line = '  '.join(title.ljust(widths[i]) for i, (title, _) in enumerate(columns)).rstrip()
+
+    print("\n" + "=" * len(line))
+    print("FLEET UPGRADE SUMMARY")
+    print("=" * len(line))
+    print(line)
+    print('-' * len(line))
+    for row in rows:
+        print('  '.join(value.ljust(widths[i]) for i, value in enumerate(row)).rstrip())
+    print("=" * len(line))
+
+    failed = sum(1 for r in results if r['status'] == 'FAILED')
+    skipped = sum(1 for r in results if r['status'] == 'SKIPPED')
+    print(f"Total: {len(results)}  Succeeded: {len(results) - failed - skipped}  Failed: {failed}"
+          + (f"  Skipped: {skipped}" if skipped else ""))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Upgrade BSP on a fleet of Tektelic gateways")
+    parser.add_argument('inventory', help="CSV inventory with columns: " + ', '.join(INVENTORY_FIELDS))
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Maximum gateways upgraded at once (default {DEFAULT_CONCURRENCY})")
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help="threads: one worker thread per gateway; "
+                             "async: one event loop for all gateways (for large fleets)")
+    parser.add_argument('--log-dir', default=DEFAULT_LOG_DIR,
+                        help=f"Directory for per-gateway log files (default {DEFAULT_LOG_DIR})")
+    parser.add_argument('--target', default=None, help="Target BSP version (default TARGET_BSP_VERSION)")
+    parser.add_argument('--dry-run', action='store_true', help="Upload and prepare but do not upgrade")
+    parser.add_argument('--upload-mode', choices=['full', 'delta', 'http', 'stream', 'relay'], default=None,
+                        help="full: upload whole BSP archives; delta: only packages each gateway is missing; "
+                             "http: serve the feeds over HTTP; stream: extract on the fly through a tar pipe; "
+                             "relay: upload each archive once per site and pull it from there over the LAN "
+                             "(default UPLOAD_MODE)")
+    parser.add_argument('--feed-url', default=None,
+                        help="Base URL of an existing feed server for --upload-mode http "
+                             "(default: start one on this host)")
+    parser.add_argument('--waves', default=None,
+                        help="Roll out in waves, e.g. '1,10%%,50%%': a canary gateway, then up to 10%% and 50%% "
+                             "of the fleet, then the rest (default: all gateways in one wave)")
+    parser.add_argument('--max-failure-rate', type=float, default=DEFAULT_MAX_FAILURE_RATE,
+                        help=f"Failed share of a wave that halts the rollout (default {DEFAULT_MAX_FAILURE_RATE})")
+    parser.add_argument('--max-uploads', type=int, default=None,
+                        help="Maximum archive uploads at once across the fleet (default unlimited)")
+    parser.add_argument('--max-site-uploads', type=int, default=None,
+                        help="Maximum archive uploads at once per inventory site (default unlimited)")
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help="Aggregate upload bandwidth budget in MB/s (default unlimited)")
+    parser.add_argument('--metrics-textfile', default=None,
+                        help="Keep Prometheus metrics of the run in this file (e.g. in the node_exporter "
+                             "textfile collector directory, named *.prom)")
+    parser.add_argument('--metrics-jsonl', default=None,
+                        help="Append every metric update of the run to this file as one JSON object per line")
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help="Profile this host's side of the run (pyinstrument must be installed separately); "
+                             "with --engine threads only the main thread is profiled")
+    parser.add_argument('--profile-out', default=None,
+                        help="Write the profile to this file (pstats dump or HTML) instead of printing it")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Fleet entry point"""
+    args = parse_args(argv)
+    if args.concurrency < 1:
+        raise ValueError("Concurrency must be at least 1")
+
+    gateways = load_inventory(args.inventory)
+    if not gateways:
+        logger.warning("Inventory is empty, nothing to do")
+        return 0
+
+    budget = None
+    if args.max_uploads or args.max_site_uploads or args.bandwidth:
+        budget = UploadBudget(args.max_uploads, args.max_site_uploads,
+                              args.bandwidth * 1024 * 1024 if args.bandwidth else None)
+
+    metrics = None
+    if args.metrics_textfile or args.metrics_jsonl:
+        metrics = FleetMetrics(args.metrics_textfile, args.metrics_jsonl)
+
+    context_options = dict(target_version=args.target, upload_mode=args.upload_mode, feed_url=args.feed_url,
+                           metrics=metrics)
+    waves = parse_waves(args.waves) if args.waves else None
+    try:
+        if args.profile:
+            with profiled(args.profile, args.profile_out):
+                results = run_rollout(gateways, waves, args.concurrency, args.log_dir, args.dry_run, args.engine,
+                                      budget, args.max_failure_rate, **context_options)
+        else:
+            results = run_rollout(gateways, waves, args.concurrency, args.log_dir, args.dry_run, args.engine,
+                                  budget, args.max_failure_rate, **context_options)
+    finally:
+        if metrics:
+            metrics.close()
+    print_summary(results)
+    return 1 if any(r['status'] == 'FAILED' for r in results) else 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        logger.error(f"Fleet execution failed: {str(e)}")
+        sys.exit(1)
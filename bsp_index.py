@@ -0,0 +1,91 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class GatewayVersion:
+    """What a scan found on one gateway: model, release and every field of its system_version output"""
+
+    def __init__(self, ip, model, version, upgrading, fields, scanned, error):
+        self.ip = ip
+        self.model = model
+        self.version = version
+        self.upgrading = bool(upgrading)
+        self.fields = json.loads(fields) if isinstance(fields, str) else (fields or {})
+        self.scanned = scanned
+        self.error = error
+
+    @property
+    def age(self):
+        return time.time() - self.scanned
+
+
+class VersionIndex:
+    """
+    Local SQLite cache of the last scan of each gateway, indexed by model and release,
+    so planning runs can work from it instead of connecting to the whole fleet again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS gateways (
+            ip TEXT PRIMARY KEY,
+            model TEXT,
+            version TEXT,
+            upgrading INTEGER NOT NULL DEFAULT 0,
+            fields TEXT NOT NULL DEFAULT '{}',
+            scanned REAL NOT NULL,
+            error TEXT)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS gateways_release ON gateways (model, version)')
+
+    def record(self, ip, model, version, upgrading, fields):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO gateways (ip, model, version, upgrading, fields, scanned, error) '
+                             'VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                             (ip, model, version, int(upgrading), json.dumps(fields), time.time()))
+
+    def record_error(self, ip, error):
+        """Note a failed scan, keeping what an earlier scan found"""
+        with self._lock:
+            self._db.execute('INSERT INTO gateways (ip, scanned, error) VALUES (?, ?, ?) '
+                             'ON CONFLICT (ip) DO UPDATE SET scanned = excluded.scanned, error = excluded.error',
+                             (ip, time.time(), error))
+
+    def get(self, ip, max_age=None):
+        """GatewayVersion of a successful scan of ip no older than max_age seconds, or None"""
+        with self._lock:
+            row = self._db.execute('SELECT ip, model, version, upgrading, fields, scanned, error FROM gateways '
+                                   'WHERE ip = ? AND error IS NULL', (ip,)).fetchone()
+        record = GatewayVersion(*row) if row else None
+        if record and max_age is not None and record.age > max_age:
+            return None
+        return record
+
+    def all(self):
+        """GatewayVersion of every scanned gateway, failed scans included"""
+        with self._lock:
+            rows = self._db.execute('SELECT ip, model, version, upgrading, fields, scanned, error FROM gateways '
+                                    'ORDER BY ip').fetchall()
+        return [GatewayVersion(*row) for row in rows]
+
+    def releases(self, ips=None):
+        """{(model, version): gateway count} over successful scans, of the gateways in ips when given"""
+        with self._lock:
+            if ips is None:
+                rows = self._db.execute('SELECT model, version, COUNT(*) FROM gateways WHERE error IS NULL '
+                                        'GROUP BY model, version').fetchall()
+                return {(model, version): count for model, version, count in rows}
+            rows = self._db.execute('SELECT ip, model, version FROM gateways WHERE error IS NULL').fetchall()
+        counts = {}
+        for ip, model, version in rows:
+            if ip in ips:
+                counts[(model, version)] = counts.get((model, version), 0) + 1
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._db.close()
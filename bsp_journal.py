@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+import time
+
+# Phases of one upgrade hop, in the order they complete
+PHASES = ('uploaded', 'verified', 'extracted', 'feed_written', 'initiated', 'rebooted', 'confirmed')
+
+
+class JournalEntry:
+    """
+    Last completed phase of one gateway's hop to the version in archive (SHA-256).
+    payload is the SHA-256 of the delta archive sent instead of the full one, if any.
+    """
+
+    def __init__(self, gateway, version, archive, phase, updated, payload=None):
+        self.gateway = gateway
+        self.version = version
+        self.archive = archive
+        self.phase = phase
+        self.updated = updated
+        self.payload = payload
+
+    def reached(self, phase):
+        return PHASES.index(self.phase) >= PHASES.index(phase)
+
+
+class UpgradeJournal:
+    """
+    Per-gateway upgrade progress in a local SQLite database, committed after every phase,
+    so a rerun after a crash of this host or the script can skip work already done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS hops (
+            gateway TEXT NOT NULL,
+            archive TEXT NOT NULL,
+            version TEXT NOT NULL,
+            phase TEXT NOT NULL,
+            updated REAL NOT NULL,
+            payload TEXT,
+            PRIMARY KEY (gateway, archive))''')
+        # Journals written before delta payloads were recorded
+        if 'payload' not in {row[1] for row in self._db.execute('PRAGMA table_info(hops)')}:
+            self._db.execute('ALTER TABLE hops ADD COLUMN payload TEXT')
+
+    def record(self, gateway, version, archive, phase, payload=None):
+        """Set the last completed phase of a hop (a repeated earlier phase moves it back)"""
+        if phase not in PHASES:
+            raise ValueError(f"Unknown journal phase {phase}")
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO hops (gateway, archive, version, phase, updated, payload) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (gateway, archive, version, phase, time.time(), payload))
+
+    def entry(self, gateway, archive):
+        """JournalEntry of a hop, or None"""
+        with self._lock:
+            row = self._db.execute('SELECT gateway, version, archive, phase, updated, payload FROM hops '
+                                   'WHERE gateway = ? AND archive = ?', (gateway, archive)).fetchone()
+        return JournalEntry(*row) if row else None
+
+    def pending(self, gateway):
+        """Most recently updated hop of a gateway that was not confirmed, or None"""
+        with self._lock:
+            row = self._db.execute('SELECT gateway, version, archive, phase, updated, payload FROM hops '
+                                   "WHERE gateway = ? AND phase != 'confirmed' ORDER BY updated DESC LIMIT 1",
+                                   (gateway,)).fetchone()
+        return JournalEntry(*row) if row else None
+
+    def forget(self, gateway):
+        """Drop every hop of a gateway, once its upgrade has finished"""
+        with self._lock:
+            self._db.execute('DELETE FROM hops WHERE gateway = ?', (gateway,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
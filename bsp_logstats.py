@@ -0,0 +1,299 @@
+import glob
+import gzip
+import os
+import re
+import time
+
+# '2024-10-22 14:21:19,926 - INFO - [10.0.0.5] message'; the IP prefix is only present for fleet gateways
+LINE_PATTERN = re.compile(
+    r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - \w+ - (?:\[(\d+\.\d+\.\d+\.\d+)\] )?(.*)')
+
+# Log messages that mark the phases of an upgrade, old and current wording
+EVENTS = [
+    ('run_start', r'Connecting to gateway (\S+)'),
+    ('model', r'Gateway Model: (\w+)'),
+    ('version', r'Current BSP Version: (\S+)'),
+    ('hop_start', r'(?:Starting upgrade|Upgrading) to version (\S+)'),
+    ('mode_delta', r'Delta upload:'),
+    ('mode_full', r'Uploading BSP file to'),
+    ('mode_stream', r'Streaming \d+ files'),
+    ('mode_http', r'Using HTTP feeds'),
+    ('mode_relay', r'Pulling BSP file from site relay'),
+    ('rate', r'(?:Transferred|Streamed) ([\d.]+)MB in ([\d.]+)s'),
+    ('space', r'Checking space requirements\. Need ([\d.]+) ?MB'),
+    ('extract', r'Unzipping BSP package'),
+    ('prepared', r'BSP package prepared successfully|HTTP feeds configured successfully'),
+    ('install', r'Initiating BSP upgrade'),
+    ('reboot', r'Lost connection|SSH connection lost'),
+    ('reconnected', r'Successfully reconnected|SSH reconnection successful'),
+    ('installed', r'Waiting (?:\d+ seconds )?for system to stabilize|System version after upgrade'
+                  r'|System (?:seems|appears) to have completed upgrade'),
+    ('hop_failed', r'Error during upgrade to version'),
+    ('run_ok', r'Upgrade successful! Final BSP version is (\S+)'),
+    ('run_failed', r'Upgrade process failed'),
+]
+_EVENT_PATTERNS = {name: re.compile(pattern) for name, pattern in EVENTS}
+# One pass per line finds which event (if any) it is; lastgroup names the outermost group that matched
+_ANY_EVENT = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in EVENTS))
+
+PHASES = ('transfer', 'extract', 'install', 'reboot', 'total')
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) of values with linear interpolation, or None when empty"""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class HopRecord:
+    """Timings of one upgrade hop of one gateway, reconstructed from its log lines"""
+
+    def __init__(self, ip, model, source, target, start):
+        self.ip = ip
+        self.model = model
+        self.source = source
+        self.target = target
+        self.start = start
+        self.mode = None
+        self.phases = {}
+        self.space_mb = None
+        self.rates = []  # Bytes per second of each transfer
+        self.completed = False
+        self._open = {}
+
+    def begin(self, phase, ts):
+        self._open.setdefault(phase, ts)
+
+    def end(self, phase, ts):
+        start = self._open.pop(phase, None)
+        if start is not None:
+            self.phases[phase] = self.phases.get(phase, 0) + ts - start
+
+
+class RunRecord:
+    """One complete upgrade_gateway run of a gateway"""
+
+    def __init__(self, ip, model, source, start, seconds, final_version, ok):
+        self.ip = ip
+        self.model = model
+        self.source = source
+        self.start = start
+        self.seconds = seconds
+        self.final_version = final_version
+        self.ok = ok
+
+
+class _GatewayState:
+    def __init__(self, ip):
+        self.ip = ip
+        self.run_start = None
+        self.model = None
+        self.version = None
+        self.hop = None
+
+
+def log_files(paths):
+    """
+    Expand log paths into files, oldest first. A file also brings its rotated copies
+    (name.1, name.2.gz, ...); a directory brings the *.log files inside it.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            bases = sorted(glob.glob(os.path.join(path, '*.log')))
+        else:
+            bases = [path]
+        for base in bases:
+            rotated = []
+            for name in glob.glob(glob.escape(base) + '.*'):
+                suffix = name[len(base) + 1:].split('.', 1)[0]
+                if suffix.isdigit():
+                    rotated.append((int(suffix), name))
+            # Higher rotation numbers are older
+            files.extend(name for _, name in sorted(rotated, reverse=True))
+            if os.path.exists(base):
+                files.append(base)
+    return files
+
+
+def _open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
+
+
+_last_stamp = (None, 0)
+
+
+def _timestamp(stamp, millis):
+    # Consecutive lines of the same second share one strptime
+    global _last_stamp
+    if _last_stamp[0] != stamp:
+        _last_stamp = (stamp, time.mktime(time.strptime(stamp, '%Y-%m-%d %H:%M:%S')))
+    return _last_stamp[1] + int(millis) / 1000
+
+
+def scan_logs(paths):
+    """
+    Stream through upgrade logs and yield a HopRecord per upgrade hop and a RunRecord per run.
+    Lines are read one at a time, so rotated multi-gigabyte logs need no more memory than small ones.
+    Lines without a gateway prefix belong to the single-gateway run, keyed by IP None.
+    """
+    gateways = {}
+    for path in log_files(paths):
+        with _open_log(path) as f:
+            for line in f:
+                match = LINE_PATTERN.match(line)
+                if not match:
+                    continue
+                message = match.group(4)
+                event = _ANY_EVENT.search(message)
+                if not event:
+                    continue
+                name = event.lastgroup
+                args = _EVENT_PATTERNS[name].search(message).groups()
+                ts = _timestamp(match.group(1), match.group(2))
+                ip = match.group(3)
+                state = gateways.get(ip)
+                if state is None:
+                    state = gateways[ip] = _GatewayState(ip)
+                yield from _apply(state, name, args, ts)
+    for state in gateways.values():
+        if state.hop and state.hop.completed:
+            yield state.hop
+
+
+def _apply(state, name, args, ts):
+    hop = state.hop
+    if name == 'run_start':
+        if hop and hop.completed:
+            yield hop
+        state.ip = state.ip or args[0]
+        state.run_start, state.model, state.version, state.hop = ts, None, None, None
+    elif name == 'model':
+        state.model = args[0]
+    elif name == 'version':
+        state.version = args[0]
+    elif name == 'hop_start':
+        if hop and hop.completed:
+            yield hop
+        state.hop = HopRecord(state.ip, state.model, state.version, args[0], ts)
+    elif hop is None:
+        if name in ('run_ok', 'run_failed') and state.run_start is not None:
+            yield RunRecord(state.ip, state.model, state.version, state.run_start, ts - state.run_start,
+                            args[0] if args else None, name == 'run_ok')
+            state.run_start = None
+    elif name.startswith('mode_'):
+        mode = name[5:]
+        if hop.mode is None or mode == 'delta':
+            hop.mode = mode
+        hop.begin('transfer', ts)
+    elif name == 'rate':
+        megabytes, seconds = float(args[0]), float(args[1])
+        if seconds > 0:
+            hop.rates.append(megabytes * 1024 * 1024 / seconds)
+    elif name == 'space':
+        hop.space_mb = max(hop.space_mb or 0, float(args[0]))
+    elif name == 'extract':
+        hop.end('transfer', ts)
+        hop.begin('extract', ts)
+    elif name == 'prepared':
+        hop.end('transfer', ts)
+        hop.end('extract', ts)
+    elif name == 'install':
+        hop.begin('install', ts)
+    elif name == 'reboot':
+        hop.begin('reboot', ts)
+    elif name == 'reconnected':
+        hop.end('reboot', ts)
+    elif name == 'installed':
+        if not hop.completed:
+            hop.end('install', ts)
+            hop.phases['total'] = ts - hop.start
+            hop.completed = True
+            state.version = hop.target
+    elif name == 'hop_failed':
+        state.hop = None
+    elif name in ('run_ok', 'run_failed'):
+        if hop.completed:
+            yield hop
+        state.hop = None
+        if state.run_start is not None:
+            yield RunRecord(state.ip, state.model, state.version, state.run_start, ts - state.run_start,
+                            args[0] if args else None, name == 'run_ok')
+            state.run_start = None
+
+
+class TimingHistory:
+    """Percentiles of historical hop phases per (model, target version, upload mode) and run durations per model"""
+
+    def __init__(self):
+        self.hops = {}  # {(model, target, mode): {phase: [seconds]}}
+        self.space = {}  # {(model, target, mode): [MB]}
+        self.rates = {}  # {mode: [bytes per second]}
+        self.runs = {}  # {model: [seconds]}
+        self._seen = set()
+
+    @classmethod
+    def load(cls, paths):
+        history = cls()
+        for record in scan_logs(paths):
+            history.add(record)
+        return history
+
+    def add(self, record):
+        # The same run can appear both in the main log and in a per-gateway fleet log
+        key = (type(record).__name__, record.ip, round(record.start))
+        if key in self._seen:
+            return
+        self._seen.add(key)
+
+        if isinstance(record, RunRecord):
+            if record.ok:
+                self.runs.setdefault(record.model, []).append(record.seconds)
+            return
+        hop_key = (record.model, record.target, record.mode)
+        phases = self.hops.setdefault(hop_key, {})
+        for phase, seconds in record.phases.items():
+            phases.setdefault(phase, []).append(seconds)
+        if record.space_mb:
+            self.space.setdefault(hop_key, []).append(record.space_mb)
+        self.rates.setdefault(record.mode, []).extend(record.rates)
+
+    def _matching(self, table, model, target, mode):
+        for (m, t, md), values in table.items():
+            if m == model and t == target and (mode is None or md == mode):
+                yield values
+
+    def hop_count(self, model, target, mode=None):
+        return sum(len(phases.get('total', [])) for phases in self._matching(self.hops, model, target, mode))
+
+    def phase_seconds(self, model, target, phase, mode=None, q=50):
+        """q-th percentile of a phase of upgrades of model to target (any upload mode when mode is None)"""
+        values = [v for phases in self._matching(self.hops, model, target, mode) for v in phases.get(phase, [])]
+        return percentile(values, q)
+
+    def space_mb(self, model, target, mode=None, q=90):
+        values = [v for space in self._matching(self.space, model, target, mode) for v in space]
+        return percentile(values, q)
+
+    def transfer_rate(self, mode=None, q=50):
+        """q-th percentile of the observed transfer rate in bytes per second"""
+        if mode is None:
+            values = [v for rates in self.rates.values() for v in rates]
+        else:
+            values = self.rates.get(mode, [])
+        return percentile(values, q)
+
+    def run_seconds(self, model=None, q=50):
+        """q-th percentile of successful run durations of model (all models when None)"""
+        if model is None:
+            values = [v for runs in self.runs.values() for v in runs]
+        else:
+            values = self.runs.get(model, [])
+        return percentile(values, q)
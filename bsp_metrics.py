@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+
+METRICS_FLUSH_INTERVAL = 15  # Minimum seconds between rewrites of the Prometheus textfile during a run
+
+# Type and help text of every metric; counters are per gateway, histograms are fleet-wide per model
+METRICS = {
+    'bsp_runs_total': ('counter', "Finished upgrade runs by status"),
+    'bsp_failures_total': ('counter', "Failed upgrade runs by the pipeline phase the error was raised in"),
+    'bsp_upload_bytes_total': ('counter', "Bytes of BSP archives transferred to gateways by transfer path"),
+    'bsp_reconnect_attempts_total': ('counter', "SSH handshakes attempted to reconnect to a gateway"),
+    'bsp_reboots_total': ('counter', "Gateway reboots seen while monitoring upgrades"),
+    'bsp_space_reclaimed_bytes_total': ('counter', "Flash freed by cleaning up before uploads"),
+    'bsp_upload_throughput_bytes_per_second': ('histogram', "Rate of each archive transfer by transfer path"),
+    'bsp_hop_duration_seconds': ('histogram', "Duration of upgrade hops, upload to stabilization"),
+    'bsp_reboot_duration_seconds': ('histogram', "Time from losing a gateway to reconnecting after a reboot"),
+    'bsp_run_duration_seconds': ('histogram', "Duration of upgrade runs by status"),
+}
+
+HISTOGRAM_BUCKETS = {
+    'bsp_upload_throughput_bytes_per_second': (65536, 262144, 1048576, 4194304, 16777216, 67108864),
+    'bsp_hop_duration_seconds': (300, 600, 900, 1200, 1800, 2700, 3600, 5400),
+    'bsp_reboot_duration_seconds': (30, 60, 90, 120, 180, 300, 600),
+    'bsp_run_duration_seconds': (600, 1200, 1800, 3600, 5400, 7200, 10800),
+}
+
+
+def _labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+
+class FleetMetrics:
+    """
+    Counters and histograms of a fleet run, written to a Prometheus textfile (rewritten at most
+    every flush_interval seconds and on close) and/or appended to a JSON-lines file, one line per
+    update. Counters are kept per gateway; histograms are kept per model in the textfile while
+    their JSON lines still name the gateway. Updates are a dict operation under a lock.
+    """
+
+    def __init__(self, textfile=None, jsonl=None, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.textfile = textfile
+        self.flush_interval = flush_interval
+        self.counters = {}  # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): [cumulative bucket counts..., sum, count]}
+        self._jsonl = open(jsonl, 'a', buffering=1) if jsonl else None
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _event(self, name, value, gateway, labels):
+        if self._jsonl:
+            event = {'ts': round(time.time(), 3), 'metric': name, 'value': value, 'gateway': gateway}
+            event.update(labels)
+            self._jsonl.write(json.dumps(event) + '\n')
+
+    def inc(self, name, value=1, gateway=None, **labels):
+        """Add value to the counter name of gateway"""
+        key = (name, tuple(sorted((dict(labels, gateway=gateway) if gateway else labels).items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._event(name, value, gateway, labels)
+        self._maybe_flush()
+
+    def observe(self, name, value, gateway=None, **labels):
+        """Add one observation to the histogram name"""
+        buckets = HISTOGRAM_BUCKETS[name]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+            self._event(name, value, gateway, labels)
+        self._maybe_flush()
+
+    def totals(self):
+        """{counter name: sum over all gateways and labels}"""
+        with self._lock:
+            totals = {}
+            for (name, _), value in self.counters.items():
+                totals[name] = totals.get(name, 0) + value
+            return totals
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        with self._lock:
+            series = {}
+            for (name, labels), value in self.counters.items():
+                series.setdefault(name, []).append((labels, value))
+            for (name, labels), values in self.histograms.items():
+                series.setdefault(name, []).append((labels, list(values)))
+
+        lines = []
+        for name in sorted(series):
+            kind, help_text = METRICS.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series[name]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(HISTOGRAM_BUCKETS[name], value):
+                    lines.append(f"{name}_bucket{_labels(labels, ('le', bound))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels, ('le', '+Inf'))} {value[-1]}")
+                lines.append(f"{name}_sum{_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{_labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+    def _maybe_flush(self):
+        if self.textfile and time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush(wait=False)
+
+    def flush(self, wait=True):
+        """Rewrite the textfile atomically, so the collector never reads half of it"""
+        if not self.textfile or not self._write_lock.acquire(blocking=wait):
+            return
+        try:
+            self._flushed = time.monotonic()
+            tmp = f"{self.textfile}.tmp"
+            with open(tmp, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp, self.textfile)
+        finally:
+            self._write_lock.release()
+
+    def close(self):
+        """Write the final textfile and a JSON line with the fleet-wide counter totals"""
+        self.flush()
+        if self._jsonl:
+            self._jsonl.write(json.dumps({'ts': round(time.time(), 3), 'metric': 'totals',
+                                          'value': self.totals()}) + '\n')
+            self._jsonl.close()
+            self._jsonl = None
@@ -0,0 +1,143 @@
+import heapq
+import itertools
+import re
+
+
+def parse_version(version):
+    """'5.1.2' -> (5, 1, 2); wildcard parts ('x') become None"""
+    parts = []
+    for part in version.split('.'):
+        if part == 'x':
+            parts.append(None)
+        else:
+            match = re.match(r'\d+', part)
+            parts.append(int(match.group()) if match else 0)
+    return tuple(parts)
+
+
+def version_matches(version, pattern):
+    """True when a concrete version matches a pattern such as '5.1.x' or '7.x.x'"""
+    concrete, wanted = parse_version(version), parse_version(pattern)
+    return len(concrete) == len(wanted) and all(w is None or c == w for c, w in zip(concrete, wanted))
+
+
+class UpgradeStep:
+    """One direct upgrade (an edge of the version graph)"""
+
+    def __init__(self, source, target, seconds, transfer_bytes, flash_mb, cost):
+        self.source = source
+        self.target = target
+        self.seconds = seconds
+        self.transfer_bytes = transfer_bytes
+        self.flash_mb = flash_mb
+        self.cost = cost
+
+
+class UpgradePlan:
+    """Cheapest sequence of direct upgrades from a version to a target"""
+
+    def __init__(self, source, steps):
+        self.source = source
+        self.steps = steps
+
+    @property
+    def path(self):
+        return [step.target for step in self.steps]
+
+    @property
+    def seconds(self):
+        return sum(step.seconds for step in self.steps)
+
+    @property
+    def transfer_bytes(self):
+        return sum(step.transfer_bytes for step in self.steps)
+
+    @property
+    def flash_mb(self):
+        """Flash needed by the most demanding hop"""
+        return max((step.flash_mb for step in self.steps), default=0)
+
+    @property
+    def cost(self):
+        return sum(step.cost for step in self.steps)
+
+
+class UpgradeGraph:
+    """
+    Version graph of one gateway model. Nodes are the concrete BSP versions with an archive,
+    edges the supported direct upgrades between them, weighted by a cost model.
+    rules are (source pattern, target pattern) pairs; a None target allows any newer version.
+    versions maps each version to (seconds, transfer bytes, flash MB) of upgrading to it.
+    cost(seconds, transfer_bytes, flash_mb) turns an edge's figures into one weight.
+    """
+
+    def __init__(self, model, rules, versions, cost):
+        self.model = model
+        self.rules = list(rules)
+        self.versions = dict(versions)
+        self.cost = cost
+        self._plans = {}
+        self._edges = {version: self._direct_targets(version) for version in self.versions}
+
+    def _direct_targets(self, source):
+        source_key = parse_version(source)
+        targets = set()
+        for source_pattern, target_pattern in self.rules:
+            if not version_matches(source, source_pattern):
+                continue
+            for version in self.versions:
+                if parse_version(version) <= source_key:
+                    continue
+                if target_pattern is None or version_matches(version, target_pattern):
+                    targets.add(version)
+        return sorted(targets, key=parse_version)
+
+    def edges(self, source):
+        """Direct upgrades from source as UpgradeSteps"""
+        targets = self._edges.get(source)
+        if targets is None:
+            targets = self._edges[source] = self._direct_targets(source)
+        steps = []
+        for target in targets:
+            seconds, transfer_bytes, flash_mb = self.versions[target]
+            steps.append(UpgradeStep(source, target, seconds, transfer_bytes, flash_mb,
+                                     self.cost(seconds, transfer_bytes, flash_mb)))
+        return steps
+
+    def plan(self, current, target):
+        """
+        Cheapest UpgradePlan from current to any version matching target (concrete or pattern),
+        or None when no target is reachable. Ties go to the newest target. Results are memoized.
+        """
+        key = (current, target)
+        if key not in self._plans:
+            self._plans[key] = self._search(current, target)
+        return self._plans[key]
+
+    def _search(self, current, target):
+        if version_matches(current, target):
+            return UpgradePlan(current, [])
+
+        # Dijkstra ordered by cost, then newest version; the graph is small so a plain heap is enough
+        order = itertools.count()
+        best = {current: 0}
+        queue = [(0, (), next(order), current, [])]
+        found = None
+        while queue:
+            cost, _, _, version, steps = heapq.heappop(queue)
+            if cost > best.get(version, float('inf')):
+                continue
+            if found and cost > found[0]:
+                break
+            if steps and version_matches(version, target):
+                rank = tuple(-part for part in parse_version(version))
+                if found is None or (cost, rank) < found[:2]:
+                    found = (cost, rank, steps)
+                continue
+            for step in self.edges(version):
+                next_cost = cost + step.cost
+                if next_cost < best.get(step.target, float('inf')):
+                    best[step.target] = next_cost
+                    rank = tuple(-part for part in parse_version(step.target))
+                    heapq.heappush(queue, (next_cost, rank, next(order), step.target, steps + [step]))
+        return UpgradePlan(current, found[2]) if found else None
@@ -0,0 +1,118 @@
+import os
+import shlex
+import threading
+
+from bsp_upgrade import (
+    GatewayContext, UploadDigest, archive_digests, check_available_space, connect_gateway, current_gateway,
+    execute_command, gateway_context, get_bsp_manifest, get_sftp_session, upload_file_resumable,
+    verify_remote_file, logger,
+)
+
+RELAY_DIR = '/lib/firmware/bsp_relay/'  # Archives served by a relay, outside REMOTE_BSP_DIR so its own hops keep them
+RELAY_HTTP_PORT = 8081  # Port of the relay's busybox httpd on the site LAN
+RELAY_KEEP_ARCHIVES = 2  # Archives kept on a relay (the current hop and the next one)
+RELAY_RESERVE_MB = 64  # Flash a relay keeps free for its own upgrade after receiving an archive
+
+
+class SiteRelay:
+    """
+    One gateway per site that receives each BSP archive over the WAN once and serves it to the
+    other gateways of the site over the LAN with busybox httpd. Shared by the fleet workers of the site.
+    """
+
+    def __init__(self, site, entry):
+        self.site = site
+        self.ip = entry['ip']
+        self.lan_ip = entry.get('lan_ip') or entry['ip']
+        self._context = GatewayContext(entry['ip'], entry['username'], entry['password'],
+                                       sudo_password=entry.get('sudo_password'), port=entry.get('port'))
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"SiteRelay({self.site!r}, {self.lan_ip})"
+
+    def url(self, name):
+        return f"http://{self.lan_ip}:{RELAY_HTTP_PORT}/{name}"
+
+    def archive_url(self, bsp_file):
+        """
+        URL the site's gateways can download bsp_file from, uploading it to the relay first
+        if it does not hold a verified copy yet. Raises when the relay cannot serve it.
+        """
+        requester = current_gateway()
+        with self._lock, gateway_context(self._context):
+            # Relay work is logged to the gateway that needed it and uses its transfer settings;
+            # its WAN upload is paced by the rollout's upload budget like any other, counted in the
+            # fleet metrics and in the timings of the gateway whose run it belongs to. Set under
+            # the lock: the other gateways of the site share this context
+            self._context.logger = requester.logger
+            self._context.transfer = requester.transfer
+            self._context.throttle = requester.throttle
+            self._context.metrics = requester.metrics
+            self._context.timings = requester.timings
+            ssh = connect_gateway()
+            try:
+                self._seed(ssh, bsp_file)
+                self._serve(ssh, os.path.basename(bsp_file))
+            finally:
+                if self._context.shell:
+                    self._context.shell.close()
+                    self._context.shell = None
+                ssh.close()
+        return self.url(os.path.basename(bsp_file))
+
+    def _seed(self, ssh, bsp_file):
+        name = os.path.basename(bsp_file)
+        relay_file = os.path.join(RELAY_DIR, name)
+        manifest = get_bsp_manifest(bsp_file)
+        if execute_command(ssh, f'test -f {relay_file} && echo present; true', use_sudo=True).strip() == 'present':
+            try:
+                verify_remote_file(ssh, relay_file, *archive_digests(ssh, bsp_file))
+                return
+            except Exception as e:
+                logger.info(f"Copy of {name} on site relay {self.ip} is stale ({str(e)}), replacing it")
+
+        available = check_available_space(ssh, '/')
+        needed = manifest.size / (1024 * 1024) + RELAY_RESERVE_MB
+        if available < needed:
+            raise Exception(f"Site relay {self.ip} has {available:.1f}MB free, needs {needed:.1f}MB")
+
+        logger.info(f"Seeding site relay {self.ip} ({self.site}) with {name}")
+        execute_command(ssh, f'mkdir -p {RELAY_DIR}', use_sudo=True)
+        # Keep the most recent archives only; the relay's flash also has to hold its own upgrades
+        execute_command(ssh, f'cd {RELAY_DIR} && ls -t *.zip 2>/dev/null | grep -v -x {shlex.quote(name)} '
+                             f'| tail -n +{RELAY_KEEP_ARCHIVES} | xargs -r rm -f', use_sudo=True)
+        digest = UploadDigest(current_gateway().transfer.chunk_size)
+        ssh, _ = upload_file_resumable(ssh, get_sftp_session(ssh), bsp_file, relay_file, digest=digest)
+        sha256, md5 = digest.finish(bsp_file, max(1, -(-os.path.getsize(bsp_file) // digest.chunk_size)))
+        verify_remote_file(ssh, relay_file, sha256, md5)
+
+    def _serve(self, ssh, name):
+        # The relay's own upgrades reboot it, so the server is checked (and restarted) every time
+        probe = f'wget -q -O /dev/null http://127.0.0.1:{RELAY_HTTP_PORT}/{name} && echo serving; true'
+        if execute_command(ssh, probe, timeout=30) == 'serving':
+            return
+        logger.info(f"Starting busybox httpd on site relay {self.ip}:{RELAY_HTTP_PORT}")
+        execute_command(ssh, f'busybox httpd -p {RELAY_HTTP_PORT} -h {RELAY_DIR}', use_sudo=True)
+        if execute_command(ssh, probe, timeout=30) != 'serving':
+            raise Exception(f"Site relay {self.ip} does not serve {name} on port {RELAY_HTTP_PORT}")
+
+
+def build_site_relays(gateways):
+    """
+    Group inventory entries by site and pick each site's relay: the entry marked relay=yes,
+    else the first one listed. Sites with a single gateway get no relay. Returns {site: SiteRelay}
+    """
+    sites = {}
+    for entry in gateways:
+        if entry.get('site'):
+            sites.setdefault(entry['site'], []).append(entry)
+
+    relays = {}
+    for site, entries in sites.items():
+        if len(entries) < 2:
+            continue
+        relay = next((entry for entry in entries if entry.get('relay')), entries[0])
+        relays[site] = SiteRelay(site, relay)
+        logger.info(f"Site {site}: {len(entries)} gateways, relay {relays[site].lan_ip}")
+    return relays
@@ -0,0 +1,123 @@
+import math
+import threading
+import time
+
+
+class TokenBucket:
+    """Paces a shared byte stream to rate bytes per second, allowing bursts of up to burst bytes"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Block until nbytes may be sent. Requests larger than the burst are let through in debt"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= nbytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class UploadBudget:
+    """
+    Upload limits shared by every gateway of a fleet rollout: concurrent uploads overall and per site,
+    and an aggregate bandwidth. Gateways hold a slot for the whole transfer of an archive and pace
+    every chunk they send through consume().
+    """
+
+    def __init__(self, max_uploads=None, max_site_uploads=None, bandwidth=None):
+        self.max_uploads = max_uploads
+        self.max_site_uploads = max_site_uploads
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.active = 0
+        self.sites = {}
+        self._condition = threading.Condition()
+
+    def _free(self, site):
+        if self.max_uploads and self.active >= self.max_uploads:
+            return False
+        return not (site and self.max_site_uploads and self.sites.get(site, 0) >= self.max_site_uploads)
+
+    def acquire(self, site, blocking=True):
+        """Take an upload slot for a gateway of site (None for no site); False if none is free and not blocking"""
+        with self._condition:
+            while not self._free(site):
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self.active += 1
+            if site:
+                self.sites[site] = self.sites.get(site, 0) + 1
+            return True
+
+    def release(self, site):
+        with self._condition:
+            self.active -= 1
+            if site:
+                self.sites[site] -= 1
+            self._condition.notify_all()
+
+    def consume(self, nbytes):
+        if self.bucket:
+            self.bucket.consume(nbytes)
+
+    def seconds_for(self, nbytes):
+        """Time nbytes take at the bandwidth budget, or None when it is unlimited"""
+        return nbytes / self.bucket.rate if self.bucket else None
+
+    def throttle(self, factor=0.5):
+        """Scale the concurrency and bandwidth budgets down, keeping at least one upload"""
+        with self._condition:
+            if self.max_uploads:
+                self.max_uploads = max(1, int(self.max_uploads * factor))
+            if self.max_site_uploads:
+                self.max_site_uploads = max(1, int(self.max_site_uploads * factor))
+            if self.bucket:
+                self.bucket.rate *= factor
+                self.bucket.burst *= factor
+
+
+def parse_waves(spec):
+    """
+    Wave sizes from a spec like '1,10%,50%': plain numbers are gateway counts, percentages are
+    cumulative shares of the fleet. Whatever remains after the last one forms the final wave.
+    """
+    waves = []
+    for part in spec.split(','):
+        part = part.strip()
+        if part.endswith('%'):
+            value = float(part[:-1])
+            if not 0 < value <= 100:
+                raise ValueError(f"Wave percentage out of range: {part}")
+            waves.append(('percent', value))
+        else:
+            value = int(part)
+            if value < 1:
+                raise ValueError(f"Wave size must be at least 1: {part}")
+            waves.append(('count', value))
+    return waves
+
+
+def plan_waves(gateways, waves):
+    """Split gateways (in rollout order) into waves as parsed by parse_waves, dropping empty ones"""
+    result = []
+    start = 0
+    for kind, value in waves:
+        if kind == 'count':
+            end = start + value
+        else:
+            end = max(start + 1, math.ceil(len(gateways) * value / 100))
+        end = min(end, len(gateways))
+        if end > start:
+            result.append(gateways[start:end])
+            start = end
+    if start < len(gateways):
+        result.append(gateways[start:])
+    return result
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import sys
+
+from bsp_upgrade import (
+    VERSION_INDEX_TTL, GatewayContext, analyze_upgrade_path, connect_gateway, gateway_context, get_version_index,
+    parse_bsp_version, parse_system_version, logger,
+)
+from bsp_async import async_execute_command, run_async, run_blocking
+from bsp_fleet import INVENTORY_FIELDS, load_inventory
+
+DEFAULT_SCAN_CONCURRENCY = 200
+DEFAULT_SCAN_TIMEOUT = 10  # Seconds for connecting and for system_version to answer
+
+# Columns of the scan table besides IP, model and release: (title, system_version field)
+SCAN_COLUMNS = [('u-boot', 'u-boot'), ('Kernel', 'Linux kernel'), ('Upgrade tool', 'BSP upgrade tool')]
+
+
+async def scan_one(entry, timeout=DEFAULT_SCAN_TIMEOUT):
+    """
+    Connect to one inventory entry, run system_version once and store what it reports in the
+    version index. Read-only. Returns the GatewayVersion, or None when the scan failed.
+    """
+    index = get_version_index()
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'],
+                         sudo_password=entry['sudo_password'], model_hint=entry['model'], port=entry.get('port'),
+                         connect_timeout=timeout)
+    ssh = None
+    with gateway_context(ctx):
+        try:
+            ssh = await run_blocking(connect_gateway)
+            output = await async_execute_command(ssh, 'system_version', use_sudo=not ctx.is_root, timeout=timeout)
+            version, model, upgrading = parse_bsp_version(output)
+            if entry['model'] and entry['model'] != model:
+                logger.warning(f"[{entry['ip']}] inventory says {entry['model']}, gateway reports {model}")
+            await run_blocking(index.record, entry['ip'], model, version, upgrading, parse_system_version(output))
+            return await run_blocking(index.get, entry['ip'])
+        except Exception as e:
+            error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            logger.warning(f"[{entry['ip']}] scan failed: {error}")
+            await run_blocking(index.record_error, entry['ip'], error)
+            return None
+        finally:
+            if ssh:
+                ssh.close()
+            ctx.close()
+
+
+async def scan_fleet(gateways, concurrency=DEFAULT_SCAN_CONCURRENCY, timeout=DEFAULT_SCAN_TIMEOUT,
+                     max_age=VERSION_INDEX_TTL):
+    """
+    Scan every gateway whose entry in the version index is older than max_age seconds (all of them
+    when max_age is 0), at most `concurrency` at once. Returns {ip: GatewayVersion or None}.
+    """
+    index = get_version_index()
+    results = {}
+    stale = []
+    for entry in gateways:
+        cached = index.get(entry['ip'], max_age) if max_age else None
+        if cached:
+            results[entry['ip']] = cached
+        else:
+            stale.append(entry)
+    logger.info(f"Scanning {len(stale)} gateways ({len(results)} cached within {max_age}s)")
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(entry):
+        async with semaphore:
+            results[entry['ip']] = await scan_one(entry, timeout)
+
+    await asyncio.gather(*(worker(entry) for entry in stale))
+    return results
+
+
+def print_scan(gateways, results):
+    """Print the scanned gateways and a count of each model and release"""
+    index = {record.ip: record for record in get_version_index().all()}
+    columns = ['IP', 'Model', 'Release'] + [title for title, _ in SCAN_COLUMNS] + ['Scanned']
+    rows = []
+    for entry in gateways:
+        record = results.get(entry['ip'])
+        if record:
+            rows.append([record.ip, record.model, record.version + (' (upgrading)' if record.upgrading else '')]
+                        + [record.fields.get(field, '-').split()[0] for _, field in SCAN_COLUMNS]
+                        + [f"{record.age / 60:.0f}m ago"])
+        else:
+            failed = index.get(entry['ip'])
+            rows.append([entry['ip'], '?', '?'] + ['-'] * len(SCAN_COLUMNS)
+                        + [f"FAILED: {failed.error if failed else 'no answer'}"])
+
+    widths = [max([len(title)] + [len(row[i]) for row in rows]) for i, title in enumerate(columns)]
+    print('  '.join(title.ljust(widths[i]) for i, title in enumerate(columns)).rstrip())
+    for row in rows:
+        print('  '.join(value.ljust(widths[i]) for i, value in enumerate(row)).rstrip())
+
+    releases = get_version_index().releases({entry['ip'] for entry in gateways if results.get(entry['ip'])})
+    print()
+    for (model, version), count in sorted(releases.items(), key=lambda item: -item[1]):
+        print(f"{count:6d}  {model} {version}")
+    failed = sum(1 for entry in gateways if not results.get(entry['ip']))
+    print(f"Scanned: {len(gateways) - failed}  Failed: {failed}")
+
+
+def print_plans(gateways, results, target_version=None):
+    """Plan the upgrade of each model and release found, without connecting to any gateway"""
+    releases = get_version_index().releases({entry['ip'] for entry in gateways if results.get(entry['ip'])})
+    with gateway_context(GatewayContext.from_globals()) as ctx:
+        if target_version:
+            ctx.target_version = target_version
+        print()
+        for (model, version), count in sorted(releases.items()):
+            try:
+                path, minutes, space = analyze_upgrade_path(version, model)
+                print(f"{model} {version} ({count} gateways): {' -> '.join(path) or 'at target'}, "
+                      f"~{minutes} min, {space} MB")
+            except Exception as e:
+                print(f"{model} {version} ({count} gateways): no plan: {str(e)}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Scan the BSP release of a fleet of Tektelic gateways (read-only)")
+    parser.add_argument('inventory', help="CSV inventory with columns: " + ', '.join(INVENTORY_FIELDS))
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_SCAN_CONCURRENCY,
+                        help=f"Maximum gateways scanned at once (default {DEFAULT_SCAN_CONCURRENCY})")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_SCAN_TIMEOUT,
+                        help=f"Seconds to connect and to get system_version (default {DEFAULT_SCAN_TIMEOUT})")
+    parser.add_argument('--max-age', type=int, default=VERSION_INDEX_TTL,
+                        help=f"Reuse scans younger than this many seconds (default {VERSION_INDEX_TTL})")
+    parser.add_argument('--rescan', action='store_true', help="Scan every gateway, ignoring cached results")
+    parser.add_argument('--plan', action='store_true', help="Also print the upgrade path of each release found")
+    parser.add_argument('--target', default=None, help="Target BSP version for --plan (default TARGET_BSP_VERSION)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Scan entry point"""
+    args = parse_args(argv)
+    if args.concurrency < 1:
+        raise ValueError("Concurrency must be at least 1")
+
+    gateways = load_inventory(args.inventory)
+    max_age = 0 if args.rescan else args.max_age
+    # Every scan holds an executor thread during its SSH handshake
+    results = run_async(scan_fleet(gateways, args.concurrency, args.timeout, max_age),
+                        blocking_workers=args.concurrency)
+    print_scan(gateways, results)
+    if args.plan:
+        print_plans(gateways, results, args.target)
+    return 1 if any(not results.get(entry['ip']) for entry in gateways) else 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        logger.error(f"Scan failed: {str(e)}")
+        sys.exit(1)
@@ -0,0 +1,116 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILERS = ('cprofile', 'pyinstrument')
+PROFILE_TOP = 30  # Functions listed in a printed cProfile report
+
+
+class PhaseTimings:
+    """
+    Where one gateway run spends its time: wall time per pipeline phase, remote command
+    round trips, bytes sent and time spent in fixed sleeps. Phases may nest (the upload
+    phase runs inside the prepare phase), so their totals overlap.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}  # {name: [count, seconds]}, in the order phases first finished
+        self.commands = 0
+        self.command_seconds = 0.0
+        self.command_max = 0.0
+        self.bytes_sent = 0
+        self.sleep_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block as phase name. An error raised in it is tagged with the innermost phase it left"""
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if not hasattr(e, 'bsp_phase'):
+                e.bsp_phase = name
+            raise
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += 1
+            phase[1] += seconds
+
+    def command(self, seconds):
+        """Count one remote command round trip"""
+        with self._lock:
+            self.commands += 1
+            self.command_seconds += seconds
+            self.command_max = max(self.command_max, seconds)
+
+    def sent(self, nbytes):
+        with self._lock:
+            self.bytes_sent += nbytes
+
+    def slept(self, seconds):
+        with self._lock:
+            self.sleep_seconds += seconds
+
+    def report(self):
+        """Lines of an end-of-run breakdown"""
+        total = max(time.monotonic() - self.started, 1e-6)
+        width = max([len(name) for name in self.phases] + [5])
+        lines = [f"Timing breakdown ({total / 60:.1f} min):"]
+        for name, (count, seconds) in self.phases.items():
+            lines.append(f"  {name.ljust(width)}  {count:4d}x  {seconds:8.1f}s  {seconds / total:6.1%}")
+        if self.commands:
+            lines.append(f"  Remote commands: {self.commands} round trips, "
+                         f"{self.command_seconds / self.commands * 1000:.0f}ms average, "
+                         f"{self.command_max:.1f}s longest, {self.command_seconds:.1f}s in total")
+        lines.append(f"  Sent {self.bytes_sent / (1024 * 1024):.2f}MB; fixed sleeps {self.sleep_seconds:.1f}s "
+                     f"({self.sleep_seconds / total:.1%}), everything else {total - self.sleep_seconds:.1f}s")
+        return lines
+
+
+@contextmanager
+def profiled(kind, output=None):
+    """
+    Profile the controller side of the enclosed code with cProfile or pyinstrument (optional
+    dependency). The report goes to output (pstats dump or HTML) when given, else it is printed.
+    Both profile the thread they start in: the event loop with the async engine, not fleet worker threads.
+    """
+    if kind == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output:
+                profiler.dump_stats(output)
+            else:
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP)
+                print(report.getvalue())
+    elif kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise RuntimeError("pyinstrument is not installed (pip install pyinstrument)")
+        profiler = Profiler(async_mode='enabled')
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            if output:
+                with open(output, 'w') as f:
+                    f.write(profiler.output_html())
+            else:
+                print(profiler.output_text())
+    else:
+        raise ValueError(f"Unknown profiler {kind}, expected one of {', '.join(PROFILERS)}")
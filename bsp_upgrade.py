@@ -4,9 +4,34 @@ import paramiko
 import os
 import time
 import select
+import shutil
 import re
+import shlex
+import uuid
 import logging
 import sys
+import contextvars
+import hashlib
+import json
+import random
+import socket
+import tarfile
+import tempfile
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from paramiko.sftp import CMD_STATUS, CMD_WRITE, int64
+
+from bsp_cache import BSPManifest, BSPStore
+from bsp_delta import build_delta_archive, parse_installed_packages, parse_md5sum_output, plan_delta
+from bsp_feed_server import FeedServer
+from bsp_index import VersionIndex
+from bsp_journal import UpgradeJournal
+from bsp_logstats import TimingHistory
+from bsp_planner import UpgradeGraph, parse_version, version_matches
+from bsp_timing import PhaseTimings, profiled
 
 # Configure logging
 logging.basicConfig(
@@ -17,21 +42,84 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
-logger = logging.getLogger(__name__)
-
 # Configuration details
 GATEWAY_IP = '10.7.7.249'
 GATEWAY_USERNAME = 'root'  # Use 'admin' if not root
 GATEWAY_PASSWORD = 'your_password'
+GATEWAY_SSH_PORT = 22
 SUDO_PASSWORD = GATEWAY_PASSWORD  # Use gateway password for sudo
 TARGET_BSP_VERSION = "5.1.1"  # Target BSP version to upgrade to
 BSP_DIR = '/Users/r2d2/Downloads/'  # Directory with BSP archives
 STABILIZATION_WAIT = 30  # Seconds to wait after reboot
+PAUSE_SCALE = 1  # Multiplier of every fixed wait; benchmarks against the gateway simulator shorten them
 
 # Paths configuration
 REMOTE_BSP_DIR = '/lib/firmware/bsp/'
 REMOTE_SNMP_CONF_DIR = '/etc/opkg/snmpManaged-feed.conf'
 
+# Chunked upload configuration
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # Bytes per checkpointed chunk
+UPLOAD_MAX_RETRIES = 5  # Reconnect-and-resume attempts per archive
+UPLOAD_CHECKPOINT_DIR = '.bsp_checkpoints'  # Local directory for upload checkpoints
+UPLOAD_STREAMS = 1  # Parallel SFTP channels per upload (all on the same SSH connection)
+UPLOAD_MAX_REQUESTS = 64  # Outstanding SFTP write requests per channel
+UPLOAD_REQUEST_SIZE = 32768  # Bytes per SFTP write request
+UPLOAD_WINDOW_SIZE = 8 * 1024 * 1024  # SSH window of transfer channels
+UPLOAD_MAX_PACKET_SIZE = 32768  # SSH max packet size of transfer channels
+UPLOAD_MODE = 'full'  # 'full': upload the whole BSP archive, 'delta': only packages the gateway is missing,
+                     # 'http': serve the feeds over HTTP and let opkg download what it needs,
+                     # 'stream': extract on the fly through a tar pipe, never storing the zip on the gateway,
+                     # 'relay': like 'full', but gateways of a site pull the archive from their site relay (fleet)
+RELAY_PULL_TIMEOUT = 1800  # Seconds a gateway may take to download an archive from its site relay
+
+# HTTP feed server ('http' upload mode)
+FEED_SERVER_URL = None  # Base URL of an existing server publishing BSP_<version>/<feed>/; None starts a local one
+FEED_SERVER_PORT = 8080  # Port of the local feed server
+FEED_SERVER_DIR = '.bsp_feeds'  # Local directory the BSP archives are extracted into for serving
+
+BSP_CACHE_DIR = '.bsp_cache'  # Content-addressed store of imported BSP archives and their manifests
+
+COMMAND_BACKEND = 'shell'  # 'shell': one persistent (elevated) shell per gateway, 'exec': one channel per command
+COMMAND_OUTPUT_LIMIT = 256 * 1024  # Bytes of each output stream of a command kept in memory (the latest ones)
+COMMAND_ARGS_LIMIT = 64 * 1024  # Bytes of file names passed on one remote command line (Linux caps one argument at 128KB)
+
+# Reconnection after reboots
+RECONNECT_PROBE_MIN = 0.5  # First delay between TCP/banner probes of the SSH port (seconds)
+RECONNECT_PROBE_MAX = 4  # Longest delay between probes, however long the gateway stays down
+RECONNECT_PROBE_TIMEOUT = 2  # Timeout of one probe (seconds)
+RECONNECT_DOWN_GRACE = 15  # How long to wait for the SSH port to go down after losing the connection
+REBOOT_STATS_FILE = '.bsp_reboot_stats.json'  # Observed reboot durations per gateway model
+REBOOT_STATS_KEEP = 20  # Durations kept per model (and per upgrade hop)
+
+# Upgrade path planner
+PLANNER_HOP_MINUTES = 20  # Assumed install and reboot time of a hop until one has been measured
+PLANNER_LINK_RATE = 1024 * 1024  # Assumed transfer rate to a gateway (bytes/s) when costing a hop
+PLANNER_FLASH_WEIGHT = 0  # Extra cost (seconds) per MB of flash a hop needs; raise it for gateways short on space
+HOP_STATS_FILE = '.bsp_hop_stats.json'  # Observed install and reboot time per model and target version
+TIMING_LOG_PATHS = ['bsp_upgrade.log', 'fleet_logs']  # Logs (rotated copies included) mined for past hop timings
+JOURNAL_FILE = '.bsp_journal.sqlite'  # Completed phases of each gateway's hops, so reruns resume mid-path
+VERSION_INDEX_FILE = '.bsp_versions.sqlite'  # Last scanned model and release of each gateway (bsp_scan.py)
+VERSION_INDEX_TTL = 3600  # Seconds a scanned release is trusted before the gateway is scanned again
+
+# Pre-staging: upload the next hop's archive while the gateway stabilizes after the current one (full uploads)
+PRESTAGE_NEXT_HOP = True
+PRESTAGE_RAM_DIR = '/tmp/bsp_next/'  # Used when flash is short and /tmp is a tmpfs
+PRESTAGE_FLASH_RESERVE_MB = 16  # Flash left free after the staged archive and its later extraction
+PRESTAGE_RAM_RESERVE_MB = 32  # RAM left free in the tmpfs after the staged archive
+
+# Upgrade progress monitoring
+PROGRESS_STREAMING = True  # Follow the kernel log and upgrade log on one channel; False polls dmesg instead
+PROGRESS_STATUS_INTERVAL = 60  # Seconds between system_version checks while progress is streamed
+PROGRESS_PATTERN = re.compile(r'BSP upgrade progress:\s*(\d+)')
+# Kernel messages as they are logged (dmesg -w, or syslog where dmesg cannot follow) and the
+# upgrade log; the followers are stopped when the channel's stdin closes
+PROGRESS_STREAM_COMMAND = (
+    'dmesg -w 2>/dev/null & k=$!; '
+    'tail -n 0 -F /var/log/tektelic-dist-upgrade-*.log 2>/dev/null & t=$!; '
+    'sleep 1; kill -0 $k 2>/dev/null || { tail -n 0 -F /var/log/messages 2>/dev/null & k=$!; }; '
+    'cat >/dev/null; kill $k $t 2>/dev/null'
+)
+
 # Direct upgrade paths for each model
 DIRECT_UPGRADE_VERSIONS = {
     'Micro': ['4.0.2', '5.1.x', '6.1.x'],
@@ -66,6 +154,138 @@ OPTIMAL_UPGRADE_PATHS = {
         "6.1.x": ["7.x.x"]
     }
 }
+
+class GatewayContext:
+    """Per-gateway connection settings, logger and upgrade state"""
+
+    def __init__(self, ip, username, password, sudo_password=None,
+                 target_version=None, model_hint=None, log_file=None, transfer=None, upload_mode=None,
+                 feed_url=None, port=None, site=None, relay=None, throttle=None, connect_timeout=None,
+                 metrics=None):
+        self.ip = ip
+        self.port = port or GATEWAY_SSH_PORT
+        self.connect_timeout = connect_timeout  # Seconds for TCP connect, banner and auth; None waits as paramiko does
+        self.username = username
+        self.password = password
+        self.sudo_password = password if sudo_password is None else sudo_password
+        self.target_version = target_version or TARGET_BSP_VERSION
+        self.model_hint = model_hint
+        self.log_file = log_file
+        self.transfer = transfer or TransferSettings()
+        self.upload_mode = upload_mode or UPLOAD_MODE
+        self.feed_url = feed_url or FEED_SERVER_URL
+        self.site = site
+        self.relay = relay  # Serves archives to the site's gateways ('relay' upload mode), see bsp_relay
+        self.throttle = throttle  # Upload budget shared by a fleet rollout (bsp_rollout.UploadBudget), or None
+        self.metrics = metrics  # Counters and histograms shared by a fleet run (bsp_metrics.FleetMetrics), or None
+        self.hash_tool = None  # 'sha256sum' or 'md5sum', detected on first use
+        self.command_backend = COMMAND_BACKEND
+        self.connection = GatewayConnection()  # The one SSH connection every phase uses, see connect_gateway()
+        self.shell = None
+
+        # Filled in by upgrade_gateway() as the pipeline progresses
+        self.model = None
+        self.start_version = None
+        self.upgrade_path = []
+        self.final_version = None
+        self.upgrade_in_progress = False
+        self.hop = None  # (version, archive sha256) of the hop being run, for the journal
+        self.hop_payload = None  # sha256 of the delta archive sent for the hop instead of the full one
+        self.timings = PhaseTimings()  # Where this run's time goes, logged when upgrade_gateway ends
+
+        self.logger = self._create_logger()
+
+    @classmethod
+    def from_globals(cls):
+        """Build a context from the module-level configuration constants"""
+        return cls(GATEWAY_IP, GATEWAY_USERNAME, GATEWAY_PASSWORD,
+                   sudo_password=SUDO_PASSWORD, target_version=TARGET_BSP_VERSION)
+
+    @property
+    def is_root(self):
+        return self.username == 'root'
+
+    def _create_logger(self):
+        if not self.log_file:
+            return logging.getLogger(__name__)
+
+        gw_logger = logging.getLogger(f"{__name__}.{self.ip.replace('.', '_')}")
+        handler = logging.FileHandler(self.log_file)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        gw_logger.addHandler(handler)
+        return _GatewayLogAdapter(gw_logger, {'ip': self.ip})
+
+    def close(self):
+        """Release the per-gateway connection, shell and log file"""
+        if self.shell:
+            self.shell.close()
+            self.shell = None
+        self.connection.close()
+        if isinstance(self.logger, _GatewayLogAdapter):
+            for handler in list(self.logger.logger.handlers):
+                self.logger.logger.removeHandler(handler)
+                handler.close()
+
+
+class TransferSettings:
+    """Tunables of the SFTP transfer engine, defaulting to the UPLOAD_* constants"""
+
+    def __init__(self, chunk_size=None, streams=None, max_requests=None, request_size=None,
+                 window_size=None, max_packet_size=None):
+        self.chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+        self.streams = streams or UPLOAD_STREAMS
+        self.max_requests = max_requests or UPLOAD_MAX_REQUESTS
+        self.request_size = request_size or UPLOAD_REQUEST_SIZE
+        self.window_size = window_size or UPLOAD_WINDOW_SIZE
+        self.max_packet_size = max_packet_size or UPLOAD_MAX_PACKET_SIZE
+
+    def __repr__(self):
+        return (f"TransferSettings(chunk_size={self.chunk_size}, streams={self.streams}, "
+                f"max_requests={self.max_requests}, request_size={self.request_size}, "
+                f"window_size={self.window_size}, max_packet_size={self.max_packet_size})")
+
+
+class _GatewayLogAdapter(logging.LoggerAdapter):
+    """Prefix messages with the gateway IP so interleaved fleet output stays readable"""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['ip']}] {msg}", kwargs
+
+
+_current_gateway = contextvars.ContextVar('current_gateway', default=None)
+_default_gateway = None
+
+
+def current_gateway():
+    """Return the gateway context of the running worker (or the single-gateway default)"""
+    global _default_gateway
+    ctx = _current_gateway.get()
+    if ctx is None:
+        if _default_gateway is None:
+            _default_gateway = GatewayContext.from_globals()
+        ctx = _default_gateway
+    return ctx
+
+
+@contextmanager
+def gateway_context(ctx):
+    """Make ctx the active gateway for the current thread or task"""
+    token = _current_gateway.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _current_gateway.reset(token)
+
+
+class _ContextLogger:
+    """Module logger that forwards to the logger of the active gateway context"""
+
+    def __getattr__(self, name):
+        return getattr(current_gateway().logger, name)
+
+
+logger = _ContextLogger()
+
 class SSHConnectionError(Exception):
     """Custom exception for SSH connection issues"""
     pass
@@ -78,47 +298,519 @@ class SFTPError(Exception):
     """Custom exception for SFTP related issues"""
     pass
 
-def ensure_sftp_session(ssh):
-    """Ensure an active SFTP session is available"""
+@contextmanager
+def timed(name):
+    """Add the time spent in the enclosed block (or decorated function) to a phase of the active gateway"""
+    with current_gateway().timings.span(name):
+        yield
+
+def pause_seconds(seconds):
+    """How long a fixed wait of seconds actually lasts (see PAUSE_SCALE)"""
+    return seconds * PAUSE_SCALE
+
+def pause(seconds):
+    """time.sleep that the active gateway's timings count as fixed waiting"""
+    start = time.monotonic()
+    time.sleep(pause_seconds(seconds))
+    current_gateway().timings.slept(time.monotonic() - start)
+
+def log_timings():
+    """Log the breakdown of the active gateway's run"""
+    for line in current_gateway().timings.report():
+        logger.info(line)
+
+def count_metric(name, value=1, **labels):
+    """Add value to a counter of the active gateway in the fleet metrics, if any"""
+    gw = current_gateway()
+    if gw.metrics:
+        gw.metrics.inc(name, value, gateway=gw.ip, **labels)
+
+def observe_metric(name, value, **labels):
+    """Add an observation of the active gateway, labelled with its model, to a fleet metrics histogram"""
+    gw = current_gateway()
+    if gw.metrics:
+        gw.metrics.observe(name, value, gateway=gw.ip, model=gw.model or gw.model_hint or 'unknown', **labels)
+
+def record_run_metrics(error=None):
+    """Count the active gateway's finished run, and the phase it failed in, in the fleet metrics"""
+    gw = current_gateway()
+    status = 'failed' if error else 'ok'
+    count_metric('bsp_runs_total', status=status)
+    observe_metric('bsp_run_duration_seconds', time.monotonic() - gw.timings.started, status=status)
+    if error:
+        count_metric('bsp_failures_total', phase=getattr(error, 'bsp_phase', 'other'))
+
+class OutputTail:
+    """
+    One output stream of a remote command as it arrives. Only the latest `limit` bytes are kept
+    (older chunks are dropped and counted; None keeps everything); complete lines are passed to on_line(name, line) as
+    soon as they are received, so callers can parse long outputs without holding them.
+    """
+
+    def __init__(self, name, limit=COMMAND_OUTPUT_LIMIT, on_line=None):
+        self.name = name
+        self.limit = limit
+        self.on_line = on_line
+        self.chunks = deque()
+        self.size = 0
+        self.total = 0
+        self._partial = b''
+
+    @property
+    def dropped(self):
+        """Bytes received but no longer kept"""
+        return self.total - (self.size if self.limit is None else min(self.size, self.limit))
+
+    def write(self, data):
+        if not data:
+            return
+        self.total += len(data)
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.limit is not None and self.size - len(self.chunks[0]) >= self.limit:
+            self.size -= len(self.chunks.popleft())
+
+        if self.on_line:
+            *lines, self._partial = (self._partial + data).split(b'\n')
+            if self.limit is not None and len(self._partial) > self.limit:
+                # A line longer than the limit is passed on in pieces
+                lines.append(self._partial)
+                self._partial = b''
+            for line in lines:
+                self.on_line(self.name, line.rstrip(b'\r').decode(errors='replace'))
+
+    def close(self):
+        """Pass on the last line when the output did not end with a newline"""
+        if self.on_line and self._partial:
+            self.on_line(self.name, self._partial.rstrip(b'\r').decode(errors='replace'))
+        self._partial = b''
+
+    def text(self):
+        data = b''.join(self.chunks)
+        if self.limit is not None and len(data) > self.limit:
+            data = data[-self.limit:]
+        return data.decode(errors='replace')
+
+class CommandResult:
+    """Exit status of a remote command (None when unknown) and the kept tail of its stdout and stderr"""
+
+    def __init__(self, command, exit_status, out, err):
+        self.command = command
+        self.exit_status = exit_status
+        self.out = out.text()
+        self.err = err.text()
+        self.out_dropped = out.dropped
+        self.err_dropped = err.dropped
+
+    @property
+    def ok(self):
+        return self.exit_status == 0
+
+class ShellReply:
+    """Output of one RemoteShell command, up to the sentinels that end it on stdout and stderr"""
+
+    def __init__(self, sentinel, out, err):
+        self.marker = sentinel.encode()
+        self.out = out
+        self.err = err
+        # Received bytes not yet passed on, which may hold the start of the marker; None once it was seen
+        self.pending = {out: b'', err: b''}
+        self.status = b''
+
+    @property
+    def done(self):
+        return self.pending[self.out] is None and self.pending[self.err] is None and b'\n' in self.status
+
+    def receive(self, tail, data):
+        if self.pending[tail] is None:
+            if tail is self.out:
+                self.status += data
+            return
+        data = self.pending[tail] + data
+        found = data.find(self.marker)
+        if found >= 0:
+            tail.write(data[:found])
+            self.pending[tail] = None
+            if tail is self.out:
+                self.status = data[found + len(self.marker):]
+        else:
+            keep = max(len(data) - len(self.marker) + 1, 0)
+            tail.write(data[:keep])
+            self.pending[tail] = data[keep:]
+
+    def finish(self):
+        """(stdout, stderr, exit_code) once done"""
+        self.out.close()
+        self.err.close()
+        exit_code = int(self.status.split()[0]) if self.status.split() else -1
+        return self.out.text(), self.err.text(), exit_code
+
+class RemoteShell:
+    """
+    One long-lived shell on the gateway (root, or elevated once through sudo) that runs
+    commands one after another. Each command runs in its own `sh -c` with stdin closed,
+    followed by a sentinel carrying its exit code on stdout and a sentinel on stderr.
+    """
+
+    def __init__(self, transport, sudo_password=None, timeout=15):
+        self.transport = transport
+        self.sentinel = f"__BSP_{uuid.uuid4().hex}__"
+        self.lock = threading.Lock()
+        self.chan = transport.open_session(timeout=timeout)
+        if sudo_password is None:
+            self.chan.exec_command('sh')
+        else:
+            self.chan.exec_command("sudo -S -k -p '' sh")
+            self.chan.sendall(f"{sudo_password}\n".encode())
+        self.chan.fileno()  # lets select() wait on stdout and stderr together
+        try:
+            out, _, _ = self.run('id -u', timeout)
+        except Exception:
+            self.close()
+            raise
+        if sudo_password is not None and out.strip() != '0':
+            self.close()
+            raise SSHConnectionError("Remote shell did not get root privileges")
+
+    @property
+    def active(self):
+        return self.transport.is_active() and not self.chan.closed and not self.chan.exit_status_ready()
+
+    def run(self, command, timeout=30, out=None, err=None):
+        """
+        Run command and return (stdout, stderr, exit_code). timeout applies to output inactivity.
+        Output goes through the OutputTail out and err when given, else it is all kept.
+        """
+        with self.lock:
+            reply = self.start(command, out, err)
+            deadline = time.monotonic() + timeout
+            while not reply.done:
+                if self.receive(reply):
+                    deadline = time.monotonic() + timeout
+                    continue
+                self.check_alive()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.close()
+                    raise TimeoutError(f"No output for {timeout} seconds")
+                select.select([self.chan], [], [], min(remaining, 1.0))
+            return reply.finish()
+
+    def start(self, command, out=None, err=None):
+        """Send command to the shell and return its ShellReply; the caller holds self.lock"""
+        self.chan.sendall((f"sh -c {shlex.quote(command)} </dev/null; "
+                           f"echo \"{self.sentinel} $?\"; echo {self.sentinel} >&2\n").encode())
+        return ShellReply(self.sentinel, out or OutputTail('stdout', limit=None),
+                          err or OutputTail('stderr', limit=None))
+
+    def receive(self, reply):
+        """Pass the output available on the channel to reply without waiting. True if there was any"""
+        got_data = False
+        while self.chan.recv_ready():
+            reply.receive(reply.out, self.chan.recv(65536))
+            got_data = True
+        while self.chan.recv_stderr_ready():
+            reply.receive(reply.err, self.chan.recv_stderr(65536))
+            got_data = True
+        return got_data
+
+    def check_alive(self):
+        if self.chan.closed or self.chan.exit_status_ready():
+            self.close()
+            raise paramiko.SSHException("Remote shell exited")
+
+    def close(self):
+        try:
+            self.chan.close()
+        except Exception:
+            pass
+
+def get_remote_shell(ssh):
+    """
+    Return the active gateway's persistent shell on this SSH connection, opening it if needed,
+    or None when commands should use one exec channel each
+    """
+    gw = current_gateway()
+    if gw.command_backend != 'shell':
+        return None
+
+    transport = ssh.get_transport()
+    if transport is None or not transport.is_active():
+        raise paramiko.SSHException("SSH session not active")
+    if gw.shell and gw.shell.transport is transport and gw.shell.active:
+        return gw.shell
+
+    if gw.shell:
+        gw.shell.close()
+        gw.shell = None
     try:
-        sftp = ssh.open_sftp()
-        return sftp
+        gw.shell = RemoteShell(transport, None if gw.is_root else gw.sudo_password)
+        logger.debug("Opened persistent remote shell")
     except Exception as e:
-        logger.error(f"Error opening SFTP session: {str(e)}")
-        raise SFTPError(f"Failed to open SFTP session: {str(e)}")
-    
-def execute_command(ssh, command, use_sudo=False, timeout=30):
-    """Execute command on remote gateway with timeout and sudo support"""
-    try:
-        if 'tektelic-dist' in command:
-            command = f'PATH=$PATH:/usr/sbin {command}'
-            
-        if use_sudo and GATEWAY_USERNAME != 'root':
-            command = f"echo {SUDO_PASSWORD} | sudo -S bash -c '{command}'"
-        
-        logger.debug(f"Executing command: {command}")
-        stdin, stdout, stderr = ssh.exec_command(command, timeout=timeout)
-        
-        err = stderr.read().decode()
-        out = stdout.read().decode()
-        
+        if not transport.is_active():
+            raise
+        logger.warning(f"Persistent shell unavailable ({str(e)}), using one channel per command")
+        gw.command_backend = 'exec'
+        return None
+    return gw.shell
+
+def build_remote_command(command, use_sudo=False):
+    """Add PATH and sudo wrapping required by the active gateway to a command"""
+    if 'tektelic-dist' in command:
+        command = f'PATH=$PATH:/usr/sbin {command}'
+
+    gw = current_gateway()
+    if use_sudo and not gw.is_root:
+        command = f"echo {gw.sudo_password} | sudo -S bash -c '{command}'"
+    return command
+
+def check_command_output(command, out, err, exit_status=None):
+    """
+    Raise if a command failed: by its exit status when it is known, else following the
+    gateway's stderr conventions (any error output but sudo's counts as a failure)
+    """
+    if exit_status is None:
         if err and not err.startswith('sudo:'):
             logger.error(f"Command error output: {err}")
             raise Exception(f"Command failed: {command}\nError: {err}")
-            
-        if out:
-            logger.debug(f"Command output: {out}")
-            
-        return out.strip()
+    elif exit_status != 0:
+        logger.error(f"Command exited with status {exit_status}: {err}")
+        raise Exception(f"Command failed with exit status {exit_status}: {command}\nError: {err}")
+    elif err:
+        logger.debug(f"Command error output: {err}")
+
+    if out:
+        logger.debug(f"Command output: {out}")
+
+def read_channel(chan, out, err, timeout=30):
+    """
+    Read stdout and stderr of an exec channel together as they arrive, into the OutputTail
+    out and err, until the command exits. timeout applies to output inactivity.
+    Returns the exit status, -1 when the channel closed without one.
+    """
+    chan.fileno()  # lets select() wait on stdout and stderr together
+    deadline = time.monotonic() + timeout
+    while True:
+        got_data = False
+        while chan.recv_ready():
+            out.write(chan.recv(65536))
+            got_data = True
+        while chan.recv_stderr_ready():
+            err.write(chan.recv_stderr(65536))
+            got_data = True
+        if got_data:
+            deadline = time.monotonic() + timeout
+            continue
+        if chan.exit_status_ready() or chan.closed:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"No output for {timeout} seconds")
+        select.select([chan], [], [], min(remaining, 1.0))
+    out.close()
+    err.close()
+    return chan.recv_exit_status() if chan.exit_status_ready() else -1
+
+def stream_command(ssh, command, use_sudo=False, timeout=30, on_line=None, limit=COMMAND_OUTPUT_LIMIT):
+    """
+    Run command on the active gateway, reading its stdout and stderr together as they arrive.
+    Each line is passed to on_line(stream, line) as soon as it is received and only the latest
+    `limit` bytes of each stream are kept. Returns a CommandResult; a failed command does not raise.
+    """
+    start = time.monotonic()
+    out = OutputTail('stdout', limit, on_line)
+    err = OutputTail('stderr', limit, on_line)
+    try:
+        shell = get_remote_shell(ssh)
+        if shell:
+            # The persistent shell is already elevated, so no per-command sudo
+            command = build_remote_command(command, use_sudo=False)
+            logger.debug(f"Executing command: {command}")
+            _, _, exit_status = shell.run(command, timeout, out, err)
+        else:
+            command = build_remote_command(command, use_sudo)
+            logger.debug(f"Executing command: {command}")
+            chan = ssh.open_channel(timeout=timeout)
+            try:
+                chan.exec_command(command)
+                exit_status = read_channel(chan, out, err, timeout)
+            finally:
+                chan.close()
+            if exit_status == -1:
+                # The connection dropped (e.g. a reboot) before the command finished
+                raise paramiko.SSHException("Channel closed before the command exited")
+        return CommandResult(command, None if exit_status == -1 else exit_status, out, err)
+    finally:
+        current_gateway().timings.command(time.monotonic() - start)
+
+def execute_command(ssh, command, use_sudo=False, timeout=30, on_line=None):
+    """
+    Execute command on remote gateway with timeout and sudo support and return its stdout.
+    Raises when it exits with a non-zero status. on_line receives output lines as they arrive.
+    """
+    try:
+        result = stream_command(ssh, command, use_sudo, timeout, on_line)
+        check_command_output(result.command, result.out, result.err, result.exit_status)
+        return result.out.strip()
     except Exception as e:
         logger.error(f"Error executing command: {command}\nError: {str(e)}")
         raise
 
+def log_output_line(stream, line):
+    """on_line callback that logs the output of a long-running command as it arrives"""
+    if line.strip():
+        logger.info(f"  {line}" if stream == 'stdout' else f"  [{stream}] {line}")
+
+def run_remote_script(ssh, script, use_sudo=False, timeout=60):
+    """Run a multi-line sh script on the gateway in one round trip and return (stdout, stderr)"""
+    gw = current_gateway()
+    start = time.monotonic()
+    try:
+        shell = get_remote_shell(ssh)
+        if shell:
+            out, err, _ = shell.run(script, timeout)
+            return out, err
+
+        # The script goes through stdin, so it may contain any quoting
+        sudo = use_sudo and not gw.is_root
+        stdin, stdout, stderr = ssh.exec_command("sudo -S -k -p '' sh" if sudo else 'sh', timeout=timeout)
+        if sudo:
+            stdin.write(f"{gw.sudo_password}\n")
+        stdin.write(script)
+        stdin.flush()
+        stdin.channel.shutdown_write()
+        out, err = OutputTail('stdout', limit=None), OutputTail('stderr', limit=None)
+        read_channel(stdin.channel, out, err, timeout)
+        return out.text(), err.text()
+    finally:
+        gw.timings.command(time.monotonic() - start)
+
+class BatchResult:
+    """Outcome of one step of a RemoteBatch. exit_code is None when the step did not run"""
+
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command
+        self.exit_code = None
+        self.output = ''
+        self.error = ''
+        self.available = None  # MB free after the step, when the batch measures space
+
+    @property
+    def skipped(self):
+        return self.exit_code is None
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+class RemoteBatch:
+    """
+    Commands of one phase composed into a single remote script.
+    Every step runs in its own subshell; its stdout, stderr, exit code and (optionally) the free
+    space afterwards are reported back between marker lines, so the phase costs one round trip.
+    """
+
+    def __init__(self, name, stop_on_error=True, space_partition=None, stop_when_free_mb=None):
+        self.name = name
+        self.stop_on_error = stop_on_error
+        self.space_partition = space_partition
+        self.stop_when_free_mb = stop_when_free_mb
+        self.steps = []
+
+    def add(self, name, command):
+        self.steps.append((name, command))
+        return self
+
+    def script(self, marker):
+        space = f"df -P -k {self.space_partition} | awk 'NR==2 {{print $4}}'" if self.space_partition else None
+        lines = [f'm={marker}', 'e=/tmp/.bsp_batch.$$', 'stop=']
+        if space:
+            lines += [f'avail=$({space})', 'printf "\\n%s space %s\\n" "$m" "$avail"']
+            if self.stop_when_free_mb is not None:
+                lines.append(f'[ -n "$avail" ] && [ "$avail" -ge {int(self.stop_when_free_mb * 1024)} ] && stop=1')
+        for index, (_, command) in enumerate(self.steps):
+            lines += [
+                'if [ -z "$stop" ]; then',
+                f'printf "\\n%s begin {index}\\n" "$m"',
+                # The newline before ")" terminates here-documents in the command
+                f'( {build_remote_command(command)}\n) 2>"$e" </dev/null',
+                'rc=$?',
+                f'printf "\\n%s stderr {index}\\n" "$m"',
+                'cat "$e"',
+                f'avail=$({space})' if space else 'avail=',
+                f'printf "\\n%s end {index} %s %s\\n" "$m" "$rc" "$avail"',
+            ]
+            if self.stop_on_error:
+                lines.append('[ "$rc" -ne 0 ] && stop=1')
+            if space and self.stop_when_free_mb is not None:
+                lines.append(f'[ -n "$avail" ] && [ "$avail" -ge {int(self.stop_when_free_mb * 1024)} ] && stop=1')
+            lines.append('fi')
+        lines.append('rm -f "$e"')
+        return '\n'.join(lines) + '\n'
+
+    def run(self, ssh, use_sudo=False, timeout=60, check=False):
+        """
+        Run all steps in one round trip, log each outcome and return the list of BatchResult.
+        With check=True the first failed step raises.
+        """
+        marker = f"__BSP_BATCH_{uuid.uuid4().hex}__"
+        results = [BatchResult(name, command) for name, command in self.steps]
+        logger.debug(f"Running {self.name} batch: {[name for name, _ in self.steps]}")
+        try:
+            out, err = run_remote_script(ssh, self.script(marker), use_sudo, timeout)
+            check_command_output(f"{self.name} batch", '', err)
+        except Exception as e:
+            logger.error(f"Error running {self.name} batch: {str(e)}")
+            raise
+
+        available = None
+        for part in ('\n' + out).split(f'\n{marker} ')[1:]:
+            header, _, body = part.partition('\n')
+            fields = header.split()
+            if fields[0] == 'space':
+                available = int(fields[1]) / 1024 if len(fields) > 1 else None
+                continue
+            result = results[int(fields[1])]
+            if fields[0] == 'begin':
+                result.output = body.strip()
+            elif fields[0] == 'stderr':
+                result.error = body.strip()
+            elif fields[0] == 'end':
+                result.exit_code = int(fields[2])
+                result.available = int(fields[3]) / 1024 if len(fields) > 3 else None
+
+        for result in results:
+            if result.skipped:
+                logger.debug(f"{result.name}: skipped")
+                continue
+            space = ''
+            if result.available is not None:
+                if available is not None:
+                    space = f", {result.available - available:.2f}MB reclaimed"
+                space += f", {result.available:.2f}MB available"
+                available = result.available
+            if result.ok:
+                logger.info(f"{result.name}: done{space}")
+                if result.output:
+                    logger.debug(f"Command output: {result.output}")
+            else:
+                logger.warning(f"{result.name}: failed with exit code {result.exit_code}{space}: {result.error}")
+
+        if check:
+            for result in results:
+                if not result.skipped and not result.ok:
+                    raise Exception(f"{result.name} failed: {result.command}\nError: {result.error}")
+        return results
+
 def get_sftp_session(ssh):
-    """Get new SFTP session"""
+    """
+    The connection's SFTP session (GatewayConnection caches it), opened again only when
+    the last one was closed or the transport was replaced
+    """
     try:
         sftp = ssh.open_sftp()
-        logger.info("New SFTP session opened")
+        logger.debug("SFTP session ready")
         return sftp
     except Exception as e:
         logger.error(f"Error opening SFTP session: {str(e)}")
@@ -132,51 +824,300 @@ def verify_ssh_connection(ssh):
     except:
         return False
 
+class GatewayConnection:
+    """
+    The single SSH connection of a gateway, shared by every hop and phase and passed around
+    wherever functions take `ssh`. It hands out channels and one cached SFTP client on its
+    transport. After a reboot renew_connection() swaps in a new transport in place, so every
+    holder keeps a working connection instead of a stale one.
+    """
+
+    def __init__(self):
+        self.client = None
+        self._sftp = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        transport = self.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get_transport(self):
+        return self.client.get_transport() if self.client else None
+
+    def open_channel(self, timeout=None, window_size=None, max_packet_size=None):
+        """A new session channel on the current transport"""
+        if not self.active:
+            raise paramiko.SSHException("SSH session not active")
+        return self.get_transport().open_session(window_size=window_size, max_packet_size=max_packet_size,
+                                                 timeout=timeout)
+
+    def exec_command(self, command, timeout=None):
+        if not self.active:
+            raise paramiko.SSHException("SSH session not active")
+        return self.client.exec_command(command, timeout=timeout)
+
+    def open_sftp(self):
+        """The cached SFTP client, opened again only when it was closed or the transport was replaced"""
+        with self._lock:
+            if not self.active:
+                raise paramiko.SSHException("SSH session not active")
+            transport = self.get_transport()
+            sftp = self._sftp
+            if sftp is None or sftp.sock.closed or sftp.sock.get_transport() is not transport:
+                self._sftp = paramiko.SFTPClient.from_transport(transport)
+                logger.debug("Opened SFTP session")
+            return self._sftp
+
+    def replace(self, client):
+        """Continue on client, closing the old transport and everything opened on it"""
+        with self._lock:
+            old, self.client, self._sftp = self.client, client, None
+        if old:
+            old.close()
+
+    def close(self):
+        self.replace(None)
+
+def open_ssh_client():
+    """Open a new SSHClient to the active gateway (a full handshake and password authentication)"""
+    gw = current_gateway()
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(gw.ip, port=gw.port, username=gw.username, password=gw.password, timeout=gw.connect_timeout,
+                banner_timeout=gw.connect_timeout, auth_timeout=gw.connect_timeout)
+    return ssh
+
+def renew_connection():
+    """Replace the transport of the active gateway's connection with a new handshake. Returns the connection"""
+    connection = current_gateway().connection
+    connection.replace(open_ssh_client())
+    return connection
+
+def connect_gateway():
+    """The active gateway's shared connection, connected first unless it already is"""
+    connection = current_gateway().connection
+    if not connection.active:
+        renew_connection()
+    return connection
+
+def probe_ssh_port(host, port, timeout=RECONNECT_PROBE_TIMEOUT):
+    """True when host accepts a TCP connection on port and greets with an SSH banner"""
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            return sock.recv(4).startswith(b'SSH-')
+    except OSError:
+        return False
+
+def backoff_delays(initial=RECONNECT_PROBE_MIN, maximum=30):
+    """Endless jittered exponential backoff: each delay is drawn from the upper half of its step"""
+    step = initial
+    while True:
+        yield random.uniform(step / 2, step)
+        step = min(step * 2, maximum)
+
+def wait_for_ssh_port(timeout, max_delay=RECONNECT_PROBE_MAX):
+    """Probe the active gateway's SSH port until it answers. Returns False if it stays silent for timeout seconds"""
+    gw = current_gateway()
+    deadline = time.time() + timeout
+    delays = backoff_delays(RECONNECT_PROBE_MIN, max_delay)
+    while not probe_ssh_port(gw.ip, gw.port):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        pause(min(next(delays), remaining))
+    return True
+
+def wait_for_ssh_down(timeout=RECONNECT_DOWN_GRACE):
+    """
+    Probe the active gateway's SSH port until it stops answering, so that a gateway that is
+    about to reboot is not reconnected to. Returns False if it kept answering for timeout seconds
+    """
+    gw = current_gateway()
+    deadline = time.time() + timeout
+    while probe_ssh_port(gw.ip, gw.port):
+        if time.time() >= deadline:
+            return False
+        pause(RECONNECT_PROBE_MIN)
+    return True
+
+@timed('reconnect')
 def reconnect_ssh(max_attempts=10, delay=30):
-    """Attempt to reconnect to SSH with retries"""
+    """
+    Reconnect the active gateway's shared connection in place and return it. The SSH port is
+    probed cheaply with jittered exponential backoff and a full SSH handshake is only attempted
+    once it answers; failed handshakes are retried with the same backoff capped at delay seconds.
+    Gives up after max_attempts failed handshakes or max_attempts * delay seconds.
+    """
+    deadline = time.time() + max_attempts * delay
+    delays = backoff_delays(RECONNECT_PROBE_MIN, delay)
     for attempt in range(max_attempts):
         try:
+            if not wait_for_ssh_port(max(deadline - time.time(), 0)):
+                raise SSHConnectionError(f"SSH port {current_gateway().port} not answering")
+
             logger.info(f"Attempting to reconnect (attempt {attempt + 1}/{max_attempts})")
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(GATEWAY_IP, username=GATEWAY_USERNAME, password=GATEWAY_PASSWORD)
-            
+            count_metric('bsp_reconnect_attempts_total')
+            ssh = renew_connection()
+
             if verify_ssh_connection(ssh):
                 logger.info("SSH reconnection successful")
                 return ssh
             else:
+                ssh.close()
                 raise SSHConnectionError("Connection established but not responding")
-                
+
         except Exception as e:
-            if attempt == max_attempts - 1:
-                raise SSHConnectionError(f"Failed to reconnect after {max_attempts} attempts: {str(e)}")
-            logger.warning(f"Reconnection failed, retrying in {delay} seconds: {str(e)}")
-            time.sleep(delay)
+            wait = next(delays)
+            if attempt == max_attempts - 1 or time.time() + wait >= deadline:
+                raise SSHConnectionError(f"Failed to reconnect after {attempt + 1} attempts: {str(e)}")
+            logger.warning(f"Reconnection failed, retrying in {wait:.1f} seconds: {str(e)}")
+            pause(wait)
+
+class DurationStats:
+    """Observed durations (reboots per model, upgrade hops per model and version) kept in a local JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def record(self, key, seconds):
+        with self._lock:
+            stats = self._load()
+            durations = stats.setdefault(key or 'unknown', [])
+            durations.append(round(seconds, 1))
+            del durations[:-REBOOT_STATS_KEEP]
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(stats, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def durations(self, key):
+        with self._lock:
+            return list(self._load().get(key or 'unknown', []))
+
+    def typical(self, key):
+        """Median observed duration in seconds, or None"""
+        durations = sorted(self.durations(key))
+        return durations[len(durations) // 2] if durations else None
+
+_reboot_stats = None
+_hop_stats = None
+_duration_stats_lock = threading.Lock()
+
+def get_reboot_stats():
+    """Open the shared reboot statistics (keyed by model) on first use"""
+    global _reboot_stats
+    with _duration_stats_lock:
+        if _reboot_stats is None:
+            _reboot_stats = DurationStats(REBOOT_STATS_FILE)
+        return _reboot_stats
+
+def get_hop_stats():
+    """Open the shared upgrade hop statistics (keyed by '<model> <version>') on first use"""
+    global _hop_stats
+    with _duration_stats_lock:
+        if _hop_stats is None:
+            _hop_stats = DurationStats(HOP_STATS_FILE)
+        return _hop_stats
+
+_journal = None
+_journal_lock = threading.Lock()
+
+def get_journal():
+    """Open the shared upgrade journal on first use"""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = UpgradeJournal(JOURNAL_FILE)
+        return _journal
+
+_version_index = None
+_version_index_lock = threading.Lock()
+
+def get_version_index():
+    """Open the shared fleet version index on first use"""
+    global _version_index
+    with _version_index_lock:
+        if _version_index is None:
+            _version_index = VersionIndex(VERSION_INDEX_FILE)
+        return _version_index
+
+def journal_phase(phase):
+    """Record that the active gateway's current hop completed phase"""
+    gw = current_gateway()
+    if gw.hop:
+        get_journal().record(gw.ip, gw.hop[0], gw.hop[1], phase, gw.hop_payload)
+
+def journal_entry():
+    """Journal entry of the active gateway's current hop, or None"""
+    gw = current_gateway()
+    return get_journal().entry(gw.ip, gw.hop[1]) if gw.hop else None
+
+def journal_reached(phase):
+    """True when the journal shows the active gateway's current hop already completed phase"""
+    entry = journal_entry()
+    return bool(entry) and entry.reached(phase)
+
+def journal_resume_point(upgrade_path, model):
+    """Unfinished journal entry for the first hop of upgrade_path with the same archive, or None"""
+    entry = get_journal().pending(current_gateway().ip)
+    if not entry or not upgrade_path or entry.version != upgrade_path[0]:
+        return None
+    if get_bsp_manifest(get_bsp_file_for_version(entry.version, model)).sha256 != entry.archive:
+        return None
+    return entry
+
+def parse_system_version(output):
+    """
+    Every 'Name: value' line of system_version output as {name: value}, e.g. Release, u-boot,
+    Linux kernel, BSP upgrade tool and the other component versions
+    """
+    fields = {}
+    for line in output.split('\n'):
+        name, sep, value = line.partition(':')
+        if sep and name.strip() and value.strip():
+            fields[name.strip()] = value.strip()
+    return fields
+
+def parse_bsp_version(output):
+    """Extract (version, model, upgrade_in_progress) from system_version output"""
+    version = None
+    model = None
+    upgrade_in_progress = False
+
+    fields = parse_system_version(output)
+    description = fields.get('Description', '')
+    for gw_type in ['Micro', 'Macro', 'Mega', 'Enterprise']:
+        if gw_type in description:
+            model = gw_type
+            break
+    if fields.get('Release'):
+        version = fields['Release']
+        if 'upgrade-in-progress' in version:
+            upgrade_in_progress = True
+            version = version.replace('upgrade-in-progress', '').strip()
+
+    if not version or not model:
+        raise BSPVersionError("Could not determine gateway version or model")
+
+    return version, model, upgrade_in_progress
 
 def check_bsp_version(ssh):
     """Check current BSP version and determine gateway model"""
     try:
-        output = execute_command(ssh, 'system_version', use_sudo=(GATEWAY_USERNAME != 'root')).strip()
+        output = execute_command(ssh, 'system_version', use_sudo=not current_gateway().is_root).strip()
         logger.info(f"System Version Output:\n{output}")
         
-        version = None
-        model = None
-        upgrade_in_progress = False
-        
-        for line in output.split('\n'):
-            if line.startswith('Description:'):
-                for gw_type in ['Micro', 'Macro', 'Mega', 'Enterprise']:
-                    if gw_type in line:
-                        model = gw_type
-                        break
-            elif line.startswith('Release:'):
-                version = line.split(':')[1].strip()
-                if 'upgrade-in-progress' in version:
-                    upgrade_in_progress = True
-                    version = version.replace('upgrade-in-progress', '').strip()
-        
-        if not version or not model:
-            raise BSPVersionError("Could not determine gateway version or model")
+        version, model, upgrade_in_progress = parse_bsp_version(output)
             
         logger.info(f"Gateway Model: {model}")
         logger.info(f"Current BSP Version: {version}")
@@ -187,22 +1128,54 @@ def check_bsp_version(ssh):
         logger.error(f"Error checking BSP version: {str(e)}")
         raise
 
+_bsp_store = None
+_bsp_store_lock = threading.Lock()
+
+def get_bsp_store():
+    """Open the shared local BSP store on first use"""
+    global _bsp_store
+    with _bsp_store_lock:
+        if _bsp_store is None:
+            _bsp_store = BSPStore(BSP_CACHE_DIR)
+        return _bsp_store
+
+def get_bsp_manifest(bsp_file):
+    """Manifest of an archive, from the store when it is a stored archive"""
+    return get_bsp_store().manifest(bsp_file) or BSPManifest.build(bsp_file)
+
+def archive_space_required(archive_file, include_archive=True):
+    """MB needed on the gateway to hold an archive (unless streamed) and its extracted contents at the same time"""
+    manifest = get_bsp_store().manifest(archive_file)
+    if manifest:
+        uncompressed = manifest.uncompressed_size
+    else:
+        with zipfile.ZipFile(archive_file) as zf:
+            uncompressed = sum(info.file_size for info in zf.infolist())
+    archive_size = os.path.getsize(archive_file) if include_archive else 0
+    return (archive_size + uncompressed) / (1024 * 1024)
+
 def get_bsp_file_for_version(version, model):
     """Get BSP file path for specific version"""
     try:
         if version == "7.x.x":
             version = "7.1.2"
             
-        bsp_file = os.path.join(BSP_DIR, f"BSP_{version}.zip")
-        
-        if not os.path.exists(bsp_file):
-            raise FileNotFoundError(
-                f"BSP file not found: {bsp_file}\n"
-                f"Please ensure you have BSP_{version}.zip in {BSP_DIR}"
-            )
-        
-        file_size = os.path.getsize(bsp_file) / (1024 * 1024)  # Size in MB
-        logger.info(f"Found BSP package: {bsp_file} (Size: {file_size:.2f}MB)")
+        source_file = os.path.join(BSP_DIR, f"BSP_{version}.zip")
+        store = get_bsp_store()
+
+        if os.path.exists(source_file):
+            bsp_file = store.import_archive(source_file)
+        else:
+            bsp_file = store.find(f"BSP_{version}.zip")
+            if not bsp_file:
+                raise FileNotFoundError(
+                    f"BSP file not found: {source_file}\n"
+                    f"Please ensure you have BSP_{version}.zip in {BSP_DIR}"
+                )
+
+        manifest = store.manifest(bsp_file)
+        file_size = manifest.size / (1024 * 1024)  # Size in MB
+        logger.info(f"Found BSP package: {bsp_file} (Size: {file_size:.2f}MB, sha256 {manifest.sha256[:12]})")
         return bsp_file
         
     except Exception as e:
@@ -237,10 +1210,12 @@ def cleanup_old_files(ssh):
     """Clean up old BSP files and backups to free space"""
     try:
         logger.info("Cleaning up old upgrade files and backups...")
-        execute_command(ssh, 'rm -rf /lib/firmware/bsp/*', use_sudo=True)
-        execute_command(ssh, 'rm -rf /backup/*', use_sudo=True)
-        execute_command(ssh, 'rm -f /var/log/tektelic-dist-upgrade-*.log', use_sudo=True)
-        execute_command(ssh, 'rm -rf /tmp/bsp_*', use_sudo=True)
+        batch = RemoteBatch('cleanup', stop_on_error=False, space_partition='/')
+        batch.add('Old BSP files', 'rm -rf /lib/firmware/bsp/*')
+        batch.add('Old backups', 'rm -rf /backup/*')
+        batch.add('Log files', 'rm -f /var/log/tektelic-dist-upgrade-*.log')
+        batch.add('Temporary files', 'rm -rf /tmp/bsp_*')
+        batch.run(ssh, use_sudo=True, check=True)
         logger.info("Cleanup completed")
     except Exception as e:
         logger.error(f"Error during cleanup: {str(e)}")
@@ -255,56 +1230,64 @@ def get_extracted_folders(ssh):
         logger.error(f"Error getting extracted folders: {str(e)}")
         raise
 
-def create_snmp_feed(ssh):
-    """Create or overwrite snmpManaged-feed.conf using paths from extracted BSP folders"""
+def create_snmp_feed(ssh, feed_sources=None, folders=None):
+    """
+    Create or overwrite snmpManaged-feed.conf using paths from extracted BSP folders
+    (listed on the gateway unless given), or the given (name, url) feed sources.
+    Returns the verified feed file content.
+    """
     try:
         logger.info("Creating/Updating snmpManaged-feed.conf...")
-        
-        folders = get_extracted_folders(ssh)
-        if not folders:
-            raise Exception("No folders found in BSP directory")
-        
-        logger.info(f"Found folders: {folders}")
-        
+
+        if feed_sources is None:
+            if folders is None:
+                folders = get_extracted_folders(ssh)
+            if not folders:
+                raise Exception("No folders found in BSP directory")
+
+            logger.info(f"Found folders: {folders}")
+            feed_sources = [(os.path.basename(folder.rstrip('/')), f"file://{folder.rstrip('/')}")
+                            for folder in folders]
+
         feed_lines = [
             "# This file is auto-generated by BSP upgrade script",
             "# Please do not edit manually",
             f"# Generated at: {time.strftime('%Y-%m-%d %H:%M:%S')}"
         ]
         
-        for folder in folders:
-            folder = folder.rstrip('/')
-            folder_name = os.path.basename(folder)
-            feed_line = f"src/gz {folder_name} file://{folder}"
+        for feed_name, feed_url in feed_sources:
+            feed_line = f"src/gz {feed_name} {feed_url}"
             feed_lines.append(feed_line)
             
         feed_content = '\n'.join(feed_lines) + '\n'
         logger.info(f"Generated feed content:\n{feed_content}")
         
-        execute_command(ssh, 'mkdir -p /etc/opkg', use_sudo=True)
         temp_feed_file = '/tmp/snmpManaged-feed.conf.tmp'
-        
-        echo_cmd = f"echo '{feed_content}' > {temp_feed_file}"
-        execute_command(ssh, echo_cmd, use_sudo=True)
-        
-        execute_command(ssh, f'mv {temp_feed_file} {REMOTE_SNMP_CONF_DIR}', use_sudo=True)
-        execute_command(ssh, f'chmod 644 {REMOTE_SNMP_CONF_DIR}', use_sudo=True)
-        
+        batch = RemoteBatch('feed file')
+        batch.add('Create /etc/opkg', 'mkdir -p /etc/opkg')
+        # A quoted here-document keeps the content literal whatever the sudo wrapping
+        batch.add('Write feed file', f"cat > {temp_feed_file} <<'BSP_FEED_EOF'\n{feed_content}BSP_FEED_EOF")
+        batch.add('Install feed file', f'mv {temp_feed_file} {REMOTE_SNMP_CONF_DIR}')
+        batch.add('Set feed file permissions', f'chmod 644 {REMOTE_SNMP_CONF_DIR}')
+        batch.add('Read back feed file', f'cat {REMOTE_SNMP_CONF_DIR}')
+        actual_content = batch.run(ssh, use_sudo=True, check=True)[-1].output
+
         # Verify content
-        actual_content = execute_command(ssh, f'cat {REMOTE_SNMP_CONF_DIR}', use_sudo=True)
         if feed_content.strip() != actual_content.strip():
             raise Exception("Feed file content verification failed")
-        
+
         logger.info("snmpManaged-feed.conf updated and verified successfully")
-        
+        return actual_content
+
     except Exception as e:
         logger.error(f"Error updating snmpManaged-feed.conf: {str(e)}")
         raise
 
-def verify_feed_file(ssh, expected_folders):
-    """Verify feed file contains all required folders"""
+def verify_feed_file(ssh, expected_folders, feed_content=None):
+    """Verify feed file (read from the gateway unless its content is given) contains all required folders"""
     try:
-        feed_content = execute_command(ssh, f'cat {REMOTE_SNMP_CONF_DIR}', use_sudo=True)
+        if feed_content is None:
+            feed_content = execute_command(ssh, f'cat {REMOTE_SNMP_CONF_DIR}', use_sudo=True)
         
         feed_folders = [line.split('file://')[1].strip() 
                        for line in feed_content.splitlines() 
@@ -331,8 +1314,690 @@ def verify_feed_file(ssh, expected_folders):
         logger.error(f"Feed file verification failed: {str(e)}")
         raise
 
+def get_remote_hash_tool(ssh):
+    """Return the strongest checksum tool on the gateway: sha256sum, or md5sum on old busybox"""
+    gw = current_gateway()
+    if gw.hash_tool is None:
+        try:
+            execute_command(ssh, 'echo | sha256sum')
+            gw.hash_tool = 'sha256sum'
+        except Exception:
+            logger.warning("sha256sum not available on gateway, falling back to md5sum")
+            gw.hash_tool = 'md5sum'
+    return gw.hash_tool
+
+def _hash_algorithm(hash_tool):
+    return 'sha256' if hash_tool == 'sha256sum' else 'md5'
+
+class UploadDigest:
+    """
+    Whole-file SHA-256 and MD5 computed from the chunks as they are read for upload.
+    Chunks must be added in read order; chunks skipped because they were uploaded by an
+    earlier run are read from disk when the digest reaches them.
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.next_chunk = 0
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5()
+
+    def _update(self, data):
+        self._sha256.update(data)
+        self._md5.update(data)
+        self.next_chunk += 1
+
+    def _catch_up(self, local, index):
+        while self.next_chunk < index:
+            local.seek(self.next_chunk * self.chunk_size)
+            self._update(local.read(self.chunk_size))
+
+    def add(self, local, index, data):
+        """Account for chunk index whose data was just read from the open local file"""
+        if index < self.next_chunk:
+            return
+        self._catch_up(local, index)
+        self._update(data)
+
+    def finish(self, local_file, total_chunks):
+        """Hash any chunks not yet seen and return (sha256, md5) hex digests"""
+        with open(local_file, 'rb') as local:
+            self._catch_up(local, total_chunks)
+        return self._sha256.hexdigest(), self._md5.hexdigest()
+
+def verify_remote_file(ssh, remote_file, sha256, md5):
+    """Compare a whole remote file with the digests computed while uploading it"""
+    hash_tool = get_remote_hash_tool(ssh)
+    expected = sha256 if hash_tool == 'sha256sum' else md5
+    output = execute_command(ssh, f'{hash_tool} "{remote_file}"', use_sudo=True, timeout=300)
+    actual = output.split()[0] if output else ''
+    if actual != expected:
+        raise SFTPError(f"{hash_tool} mismatch after upload of {remote_file}: local {expected}, remote {actual}")
+    logger.info(f"Upload verified with {hash_tool}: {expected}")
+
+def batch_file_names(names):
+    """Split names into quoted argument lists of at most COMMAND_ARGS_LIMIT bytes each"""
+    batch, size = [], 0
+    for name in names:
+        quoted = f'"{name}"'
+        if batch and size + len(quoted) + 1 > COMMAND_ARGS_LIMIT:
+            yield ' '.join(batch)
+            batch, size = [], 0
+        batch.append(quoted)
+        size += len(quoted) + 1
+    if batch:
+        yield ' '.join(batch)
+
+def remote_extracted_digests(ssh, manifest):
+    """
+    Hash the manifest's files under REMOTE_BSP_DIR, in one round trip unless the file list is
+    longer than one command line may be. Returns (hash_tool, {name: digest})
+    """
+    hash_tool = get_remote_hash_tool(ssh)
+    digests = {}
+    for file_list in batch_file_names(sorted(manifest.files)):
+        output = execute_command(ssh, f'cd {REMOTE_BSP_DIR} 2>/dev/null && {hash_tool} {file_list} 2>/dev/null; true',
+                                 use_sudo=True, timeout=600)
+        digests.update(parse_md5sum_output(output))
+    return hash_tool, digests
+
+def verify_extracted_files(ssh, manifest):
+    """Hash every extracted archive file on the gateway in one round trip and compare with the manifest"""
+    hash_tool, remote = remote_extracted_digests(ssh, manifest)
+    key = _hash_algorithm(hash_tool)
+    names = sorted(manifest.files)
+
+    missing = [name for name in names if name not in remote]
+    corrupt = [name for name in names if name in remote and remote[name] != manifest.files[name][key]]
+    if missing or corrupt:
+        for name in (missing + corrupt)[:10]:
+            logger.error(f"Extracted file {'missing' if name in missing else 'corrupt'}: {name}")
+        raise Exception(f"Extracted BSP does not match manifest: {len(missing)} missing, {len(corrupt)} corrupt")
+    logger.info(f"Verified {len(names)} extracted files against manifest ({hash_tool})")
+
+def _upload_checkpoint_file(local_file):
+    name = f"{current_gateway().ip}_{os.path.basename(local_file)}.json"
+    return os.path.join(UPLOAD_CHECKPOINT_DIR, name)
+
+def load_upload_checkpoint(local_file, remote_file, chunk_size, hash_tool='sha256sum'):
+    """Load the checkpoint of a previous upload, or start a new one if it does not match"""
+    stat = os.stat(local_file)
+    fresh = {
+        'local_size': stat.st_size,
+        'local_mtime': int(stat.st_mtime),
+        'remote_file': remote_file,
+        'chunk_size': chunk_size,
+        'hash_tool': hash_tool,
+        'chunks': {},
+    }
+    try:
+        with open(_upload_checkpoint_file(local_file)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return fresh
+
+    if any(checkpoint.get(key, 'sha256sum' if key == 'hash_tool' else None) != fresh[key]
+           for key in ('local_size', 'local_mtime', 'remote_file', 'chunk_size', 'hash_tool')):
+        logger.info("Upload checkpoint does not match local archive, starting from scratch")
+        return fresh
+    return checkpoint
+
+def save_upload_checkpoint(local_file, checkpoint):
+    """Atomically persist upload progress"""
+    os.makedirs(UPLOAD_CHECKPOINT_DIR, exist_ok=True)
+    path = _upload_checkpoint_file(local_file)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+def remove_upload_checkpoint(local_file):
+    try:
+        os.remove(_upload_checkpoint_file(local_file))
+    except OSError:
+        pass
+
+def remote_chunk_digests(ssh, remote_file, chunk_size, indices, hash_tool='sha256sum'):
+    """Hash the given chunks of a remote file in a single round trip"""
+    if not indices:
+        return {}
+    index_list = ' '.join(str(i) for i in sorted(indices))
+    command = (f'for i in {index_list}; do '
+               f'echo "$i $(dd if="{remote_file}" bs={chunk_size} skip=$i count=1 2>/dev/null | {hash_tool})"; '
+               f'done')
+    output = execute_command(ssh, command, use_sudo=True, timeout=300)
+
+    digests = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].isdigit():
+            digests[int(fields[0])] = fields[1]
+    return digests
+
+def verify_uploaded_chunks(ssh, sftp, remote_file, checkpoint):
+    """Drop checkpointed chunks that are missing or differ on the gateway. Returns verified count"""
+    chunk_size = checkpoint['chunk_size']
+    try:
+        remote_size = sftp.stat(remote_file).st_size
+    except IOError:
+        remote_size = 0
+
+    committed = {int(i): digest for i, digest in checkpoint['chunks'].items()}
+    present = {i for i in committed
+               if min((i + 1) * chunk_size, checkpoint['local_size']) <= remote_size}
+    remote = remote_chunk_digests(ssh, remote_file, chunk_size, present,
+                                  checkpoint.get('hash_tool', 'sha256sum'))
+
+    verified = {i: committed[i] for i in present if remote.get(i) == committed[i]}
+    dropped = len(committed) - len(verified)
+    if dropped:
+        logger.warning(f"{dropped} uploaded chunk(s) of {remote_file} missing or corrupt, will resend")
+    checkpoint['chunks'] = {str(i): digest for i, digest in verified.items()}
+    return len(verified)
+
+def _ensure_upload_session(ssh, sftp):
+    """Reopen the SFTP session, reconnecting first if the SSH transport is gone"""
+    transport = ssh.get_transport()
+    if transport is None or not transport.is_active():
+        logger.warning("SSH connection lost during upload, reconnecting...")
+        ssh = reconnect_ssh()
+    try:
+        sftp.close()
+    except Exception:
+        pass
+    return ssh, get_sftp_session(ssh)
+
+def open_transfer_channels(ssh, settings):
+    """Open settings.streams SFTP channels with the configured window on the existing transport"""
+    transport = ssh.get_transport()
+    if transport is None or not transport.is_active():
+        raise paramiko.SSHException("SSH session not active")
+    return [paramiko.SFTPClient.from_transport(transport, window_size=settings.window_size,
+                                               max_packet_size=settings.max_packet_size)
+            for _ in range(settings.streams)]
+
+def pace_upload(nbytes):
+    """Count nbytes as sent to the gateway, first waiting until they fit the rollout's bandwidth budget if any"""
+    gw = current_gateway()
+    if gw.throttle:
+        gw.throttle.consume(nbytes)
+    gw.timings.sent(nbytes)
+
+def record_transfer_metrics(path, nbytes, seconds):
+    """Count a finished archive transfer ('sftp', 'stream' or 'relay') and its rate in the fleet metrics"""
+    count_metric('bsp_upload_bytes_total', nbytes, path=path)
+    observe_metric('bsp_upload_throughput_bytes_per_second', nbytes / seconds, path=path)
+
+@contextmanager
+def upload_slot(bsp_file, blocking=True):
+    """
+    Hold one of the rollout's upload slots (when the gateway has a budget) while bsp_file is sent.
+    Yields whether a slot is held; without blocking it yields False at once if none is free.
+    """
+    gw = current_gateway()
+    if gw.throttle is None:
+        yield True
+        return
+    if not gw.throttle.acquire(gw.site, blocking):
+        yield False
+        return
+    try:
+        size = get_bsp_manifest(bsp_file).size
+        seconds = gw.throttle.seconds_for(size)
+        logger.info(f"Upload slot granted for {size / (1024 * 1024):.1f}MB"
+                    + (f" (at least {seconds:.0f}s at the fleet bandwidth budget)" if seconds else ""))
+        yield True
+    finally:
+        gw.throttle.release(gw.site)
+
+def write_remote_range(sftp, handle, offset, data, settings):
+    """
+    Write data at offset keeping up to settings.max_requests write requests in flight.
+    Returns once the gateway has acknowledged every request, raising on any error status.
+    """
+    # paramiko's own pipelined SFTPFile only drains acks every 100 requests and loses track
+    # of them if another request is issued in between, so the window is managed here.
+    view = memoryview(data)
+    pending = deque()
+    position = 0
+    while position < len(view) or pending:
+        while position < len(view) and len(pending) < settings.max_requests:
+            piece = view[position:position + settings.request_size]
+            pending.append(sftp._async_request(type(None), CMD_WRITE, handle,
+                                               int64(offset + position), bytes(piece)))
+            position += len(piece)
+        response_type, _ = sftp._read_response(pending.popleft())
+        if response_type != CMD_STATUS:
+            raise SFTPError("Unexpected response to SFTP write")
+
+def transfer_chunks(channels, local_file, remote_file, chunk_size, indices, settings, on_chunk=None,
+                    digest=None):
+    """
+    Upload the given chunks of local_file into an existing remote_file, spreading them
+    over the SFTP channels. on_chunk(index, data) is called after each acknowledged chunk.
+    Chunks are read in order, so an UploadDigest sees the file as one stream.
+    """
+    work = deque(indices)
+    lock = threading.Lock()
+    failed = threading.Event()
+
+    def stream(sftp):
+        with open(local_file, 'rb') as local, sftp.open(remote_file, 'r+b') as remote:
+            while not failed.is_set():
+                with lock:
+                    if not work:
+                        return
+                    index = work.popleft()
+                    local.seek(index * chunk_size)
+                    data = local.read(chunk_size)
+                    if digest:
+                        digest.add(local, index, data)
+                pace_upload(len(data))
+                try:
+                    write_remote_range(sftp, remote.handle, index * chunk_size, data, settings)
+                except Exception:
+                    failed.set()
+                    raise
+                if on_chunk:
+                    with lock:
+                        on_chunk(index, data)
+
+    if len(channels) == 1:
+        stream(channels[0])
+        return
+
+    with ThreadPoolExecutor(max_workers=len(channels)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, stream, sftp) for sftp in channels]
+        for future in futures:
+            future.result()
+
+def upload_file_resumable(ssh, sftp, local_file, remote_file, settings=None,
+                          max_retries=UPLOAD_MAX_RETRIES, digest=None):
+    """
+    Upload a file in fixed-size chunks, checkpointing each chunk's digest locally.
+    After a dropped connection the upload resumes from the chunks verified on the gateway.
+    If an UploadDigest is given it is fed with the file while it is read for sending.
+    Returns the (ssh, sftp) pair in use at the end, which may differ after a reconnect.
+    """
+    settings = settings or current_gateway().transfer
+    chunk_size = settings.chunk_size
+    hash_tool = get_remote_hash_tool(ssh)
+    checkpoint = load_upload_checkpoint(local_file, remote_file, chunk_size, hash_tool)
+    local_size = checkpoint['local_size']
+    total_chunks = max(1, -(-local_size // chunk_size))
+
+    def commit(index, data):
+        checkpoint['chunks'][str(index)] = hashlib.new(_hash_algorithm(hash_tool), data).hexdigest()
+        save_upload_checkpoint(local_file, checkpoint)
+        logger.debug(f"Uploaded chunk {index + 1}/{total_chunks}")
+
+    for attempt in range(max_retries + 1):
+        try:
+            if checkpoint['chunks']:
+                verified = verify_uploaded_chunks(ssh, sftp, remote_file, checkpoint)
+                save_upload_checkpoint(local_file, checkpoint)
+                if verified:
+                    logger.info(f"Resuming upload: {verified}/{total_chunks} chunks already on gateway")
+
+            missing = [i for i in range(total_chunks) if str(i) not in checkpoint['chunks']]
+            if not checkpoint['chunks']:
+                sftp.open(remote_file, 'wb').close()
+
+            if missing:
+                start_time = time.time()
+                channels = open_transfer_channels(ssh, settings)
+                try:
+                    transfer_chunks(channels, local_file, remote_file, chunk_size, missing, settings, commit,
+                                    digest)
+                finally:
+                    for channel in channels:
+                        channel.close()
+                sent = min(len(missing) * chunk_size, local_size)
+                elapsed = max(time.time() - start_time, 1e-6)
+                logger.info(f"Transferred {sent / (1024 * 1024):.2f}MB in {elapsed:.1f}s "
+                            f"({sent / (1024 * 1024) / elapsed:.2f}MB/s, {settings.streams} stream(s))")
+                record_transfer_metrics('sftp', sent, elapsed)
+
+            if sftp.stat(remote_file).st_size > local_size:
+                sftp.truncate(remote_file, local_size)
+
+            # Final proof: every chunk on the gateway hashes to what we sent
+            if verify_uploaded_chunks(ssh, sftp, remote_file, checkpoint) != total_chunks:
+                save_upload_checkpoint(local_file, checkpoint)
+                raise SFTPError("Uploaded file failed chunk verification")
+
+            remove_upload_checkpoint(local_file)
+            return ssh, sftp
+
+        except (socket.error, EOFError, paramiko.SSHException, SFTPError, IOError) as e:
+            if attempt == max_retries:
+                raise SFTPError(f"Upload failed after {max_retries + 1} attempts: {str(e)}")
+            logger.warning(f"Upload interrupted ({str(e)}), resuming (attempt {attempt + 2}/{max_retries + 1})")
+            ssh, sftp = _ensure_upload_session(ssh, sftp)
+
+def get_installed_packages(ssh):
+    """Return {package: version} for the packages installed on the gateway"""
+    output = execute_command(ssh, 'opkg list-installed', use_sudo=True, timeout=120)
+    return parse_installed_packages(output)
+
+def get_remote_package_digests(ssh):
+    """Return {feed/file: md5} for the package files already extracted under REMOTE_BSP_DIR"""
+    output = execute_command(ssh, f'cd {REMOTE_BSP_DIR} && find . -name "*.ipk" | xargs md5sum',
+                             use_sudo=True, timeout=300)
+    return {os.path.normpath(path): digest for path, digest in parse_md5sum_output(output).items()}
+
+def prepare_delta_archive(ssh, bsp_file, work_dir):
+    """
+    Build an archive with only the packages the gateway is missing, plus regenerated feed indexes.
+    Falls back to the full archive if the gateway cannot be inventoried.
+    """
+    try:
+        installed = get_installed_packages(ssh)
+        remote_digests = get_remote_package_digests(ssh)
+        manifest = get_bsp_manifest(bsp_file)
+        file_md5s = {name: entry['md5'] for name, entry in manifest.files.items()}
+        plan = plan_delta(bsp_file, installed, remote_digests, file_md5s)
+    except Exception as e:
+        logger.warning(f"Cannot build delta upload, sending full archive: {str(e)}")
+        return bsp_file
+
+    delta_file = build_delta_archive(bsp_file, os.path.join(work_dir, os.path.basename(bsp_file)), plan)
+    full_size = os.path.getsize(bsp_file) / (1024 * 1024)
+    delta_size = os.path.getsize(delta_file) / (1024 * 1024)
+    logger.info(f"Delta upload: {len(plan.upload)} packages to send, {len(plan.present)} already on gateway, "
+                f"{len(plan.skipped)} installed at the same version "
+                f"({plan.upload_bytes / (1024 * 1024):.2f}MB of {plan.total_bytes / (1024 * 1024):.2f}MB of packages)")
+    if plan.whole_feeds:
+        logger.info(f"Feeds sent whole (no usable or signed index): {', '.join(plan.whole_feeds)}")
+    logger.info(f"Delta archive {delta_size:.2f}MB instead of {full_size:.2f}MB")
+    return delta_file
+
+def get_archive_feeds(bsp_file):
+    """Names of the feed folders at the top level of a BSP archive"""
+    return get_bsp_manifest(bsp_file).feeds
+
+def remove_stale_feeds(ssh, bsp_file):
+    """Remove feed folders left by earlier archives that the current one does not contain"""
+    feeds = get_archive_feeds(bsp_file)
+    for folder in get_extracted_folders(ssh):
+        if os.path.basename(folder.rstrip('/')) not in feeds:
+            logger.info(f"Removing stale feed folder {folder}")
+            execute_command(ssh, f'rm -rf {folder}', use_sudo=True)
+
+_feed_server = None
+_feed_server_lock = threading.Lock()
+
+def get_feed_server():
+    """Start the shared local feed server on first use"""
+    global _feed_server
+    with _feed_server_lock:
+        if _feed_server is None:
+            _feed_server = FeedServer(FEED_SERVER_DIR, FEED_SERVER_PORT).start()
+            logger.info(f"Feed server serving {os.path.abspath(FEED_SERVER_DIR)} on port {_feed_server.port}")
+        return _feed_server
+
+def publish_bsp_feeds(ssh, bsp_file):
+    """Return the base URL under which the gateway can download the feeds of bsp_file"""
+    gw = current_gateway()
+    name = os.path.splitext(os.path.basename(bsp_file))[0]
+    if gw.feed_url:
+        return f"{gw.feed_url.rstrip('/')}/{name}"
+
+    server = get_feed_server()
+    path = server.publish(bsp_file, get_bsp_manifest(bsp_file).sha256)
+    # The address this host uses to reach the gateway is the one the gateway can reach us on
+    local_address = ssh.get_transport().sock.getsockname()[0]
+    return f"{server.url(local_address)}/{path}"
+
+def prepare_http_feeds(ssh, bsp_file):
+    """Point the gateway's opkg feeds at the HTTP feed server instead of uploading the archive"""
+    base_url = publish_bsp_feeds(ssh, bsp_file)
+    feeds = get_archive_feeds(bsp_file)
+    if not feeds:
+        raise Exception(f"No feed folders found in {bsp_file}")
+
+    logger.info(f"Using HTTP feeds from {base_url}")
+    execute_command(ssh, f'wget -q -O /dev/null {base_url}/{feeds[0]}/Packages.gz', use_sudo=True, timeout=60)
+    create_snmp_feed(ssh, [(feed, f"{base_url}/{feed}") for feed in feeds])
+    logger.info("HTTP feeds configured successfully")
+
+def bsp_dir_cleanup_commands():
+    """Commands that reset REMOTE_BSP_DIR before the first hop of an upgrade"""
+    if current_gateway().upload_mode == 'delta':
+        # Extracted feeds from an earlier run are reused by delta uploads
+        return [f'mkdir -p {REMOTE_BSP_DIR}', f'rm -f {REMOTE_BSP_DIR}*.zip']
+    return [f'rm -rf {REMOTE_BSP_DIR}', f'mkdir -p {REMOTE_BSP_DIR}']
+
+def ensure_space_for_upload(ssh, required_space):
+    """Make sure required_space MB are free on the gateway, cleaning up if needed"""
+    logger.info(f"Checking space requirements. Need {required_space:.2f}MB")
+    available_space = check_available_space(ssh)
+    logger.info(f"Initially available space: {available_space:.2f}MB")
+
+    if available_space < required_space:
+        if not check_and_ensure_space(ssh, required_space, auto_cleanup=True):
+            raise Exception(f"Cannot proceed: insufficient space after cleanup. Need {required_space:.2f}MB")
+
+class _ChannelWriter:
+    """File-like wrapper so tarfile can write straight into an SSH channel"""
+
+    def __init__(self, chan):
+        self.chan = chan
+        self.bytes_written = 0
+
+    def write(self, data):
+        pace_upload(len(data))
+        self.chan.sendall(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+def _tar_info(info):
+    tar_info = tarfile.TarInfo(info.filename)
+    tar_info.mtime = time.mktime(info.date_time + (0, 0, -1))
+    mode = (info.external_attr >> 16) & 0o7777
+    if info.is_dir():
+        tar_info.type = tarfile.DIRTYPE
+        tar_info.mode = mode or 0o755
+    else:
+        tar_info.size = info.file_size
+        tar_info.mode = mode or 0o644
+    return tar_info
+
+def stream_archive_entries(ssh, archive_file, skip=()):
+    """
+    Extract archive_file into REMOTE_BSP_DIR by piping its entries as a tar stream into a
+    remote `tar x`, so the archive itself never lands on the gateway. Entries named in
+    skip are left out. Returns the number of bytes sent.
+    """
+    gw = current_gateway()
+    settings = gw.transfer
+    extract_cmd = f'mkdir -p {REMOTE_BSP_DIR} && cd {REMOTE_BSP_DIR} && tar xf -'
+    chan = ssh.open_channel(window_size=settings.window_size, max_packet_size=settings.max_packet_size)
+    out, err = OutputTail('stdout'), OutputTail('stderr')
+    # tar's output is read while the stream is written, so a chatty tar cannot fill the
+    # channel window and stop reading its stdin; there is no output timeout while sending
+    reader = ThreadPoolExecutor(max_workers=1)
+    try:
+        if gw.is_root:
+            chan.exec_command(extract_cmd)
+        else:
+            # The password goes down the same stdin as the tar stream; -k makes sudo always read it
+            chan.exec_command(f"sudo -S -k -p '' sh -c '{extract_cmd}'")
+            chan.sendall(f"{gw.sudo_password}\n".encode())
+        exited = reader.submit(read_channel, chan, out, err, float('inf'))
+
+        writer = _ChannelWriter(chan)
+        with zipfile.ZipFile(archive_file) as zf, \
+                tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT, bufsize=256 * 1024) as tar:
+            for info in zf.infolist():
+                if info.filename in skip:
+                    continue
+                if info.is_dir():
+                    tar.addfile(_tar_info(info))
+                else:
+                    with zf.open(info) as entry:
+                        tar.addfile(_tar_info(info), entry)
+        chan.shutdown_write()
+
+        status = exited.result()
+        if status != 0:
+            raise SFTPError(f"Remote tar exited with status {status}: {err.text().strip()}")
+        return writer.bytes_written
+    finally:
+        chan.close()
+        reader.shutdown()
+
+def archive_digests(ssh, archive_file):
+    """(sha256, md5) of a local archive; md5 is only computed (else None) when the gateway lacks sha256sum"""
+    md5 = None
+    if get_remote_hash_tool(ssh) != 'sha256sum':
+        md5 = hashlib.md5()
+        with open(archive_file, 'rb') as f:
+            for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                md5.update(block)
+        md5 = md5.hexdigest()
+    return get_bsp_manifest(archive_file).sha256, md5
+
+def pull_from_relay(ssh, archive_file, remote_file):
+    """Have the gateway download archive_file from its site relay over the LAN"""
+    url = current_gateway().relay.archive_url(archive_file)
+    logger.info(f"Pulling BSP file from site relay {url} to {remote_file}")
+    start_time = time.time()
+    # wget -q says nothing when it fails, so a failed download names itself
+    execute_command(ssh, f'wget -q -O {remote_file}.part {url} && mv {remote_file}.part {remote_file} '
+                         f'|| {{ rm -f {remote_file}.part; echo "Download of {url} failed" >&2; false; }}',
+                    use_sudo=True, timeout=RELAY_PULL_TIMEOUT)
+    size = os.path.getsize(archive_file) / (1024 * 1024)
+    elapsed = max(time.time() - start_time, 1e-6)
+    logger.info(f"Transferred {size:.2f}MB in {elapsed:.1f}s ({size / elapsed:.2f}MB/s from site relay)")
+    record_transfer_metrics('relay', os.path.getsize(archive_file), elapsed)
+
+def transfer_archive(ssh, sftp, archive_file, remote_file):
+    """
+    Put archive_file on the gateway at remote_file: pulled from the site relay in 'relay' mode
+    (uploading it instead if that fails), else uploaded.
+    Returns (ssh, sftp, sha256, md5) in use at the end and the digests to verify the copy against.
+    """
+    gw = current_gateway()
+    if gw.upload_mode == 'relay' and gw.relay:
+        try:
+            pull_from_relay(ssh, archive_file, remote_file)
+            sha256, md5 = archive_digests(ssh, archive_file)
+            return ssh, sftp, sha256, md5
+        except Exception as e:
+            logger.warning(f"Pulling from site relay failed ({str(e)}), uploading over the WAN instead")
+
+    logger.info(f"Uploading BSP file to {remote_file}")
+    digest = UploadDigest(gw.transfer.chunk_size)
+    ssh, sftp = upload_file_resumable(ssh, sftp, archive_file, remote_file, digest=digest)
+    sha256, md5 = digest.finish(archive_file, max(1, -(-os.path.getsize(archive_file) // digest.chunk_size)))
+    return ssh, sftp, sha256, md5
+
+def bsp_already_prepared(ssh, bsp_file):
+    """
+    True when the journal says this hop's feeds were written and the gateway still matches
+    the archive that was sent (the delta one, if the journal names it)
+    """
+    entry = journal_entry()
+    if not entry or not entry.reached('feed_written'):
+        return False
+    manifest = get_bsp_store().manifest_by_sha256(entry.payload) if entry.payload else get_bsp_manifest(bsp_file)
+    if manifest is None:
+        logger.info("Journal says a delta archive was prepared but its manifest is gone, preparing again")
+        return False
+    try:
+        verify_extracted_files(ssh, manifest)
+        verify_feed_file(ssh, get_extracted_folders(ssh))
+    except Exception as e:
+        logger.info(f"Journal says BSP was prepared but the gateway no longer matches ({str(e)}), preparing again")
+        return False
+    current_gateway().hop_payload = entry.payload
+    return True
+
+def find_uploaded_archive(ssh, bsp_file):
+    """
+    Remote path of an upload (or pre-staged copy) of bsp_file that the journal marks verified
+    and that still hashes the same, or None
+    """
+    if not journal_reached('verified'):
+        return None
+    sha256, md5 = archive_digests(ssh, bsp_file)
+    name = os.path.basename(bsp_file)
+    for remote_file in (os.path.join(REMOTE_BSP_DIR, name), os.path.join(PRESTAGE_RAM_DIR, name)):
+        try:
+            verify_remote_file(ssh, remote_file, sha256, md5)
+            return remote_file
+        except Exception as e:
+            logger.debug(f"No verified upload at {remote_file}: {str(e)}")
+    logger.info("Journal says archive was uploaded but it is gone or differs, uploading again")
+    return None
+
+def stream_and_prepare_bsp(ssh, bsp_file, max_retries=UPLOAD_MAX_RETRIES):
+    """
+    Stream the BSP archive's files straight into their feed folders and prepare for upgrade.
+    After an interruption only files that are missing or differ on the gateway are sent again.
+    Returns the SSH client in use at the end.
+    """
+    manifest = get_bsp_manifest(bsp_file)
+    with timed('space check'):
+        ensure_space_for_upload(ssh, archive_space_required(bsp_file, include_archive=False))
+
+    for attempt in range(max_retries + 1):
+        try:
+            hash_tool, present = remote_extracted_digests(ssh, manifest)
+            key = _hash_algorithm(hash_tool)
+            skip = {name for name, entry in manifest.files.items() if present.get(name) == entry[key]}
+            if skip:
+                logger.info(f"{len(skip)}/{len(manifest.files)} files already extracted on gateway")
+
+            logger.info(f"Streaming {len(manifest.files) - len(skip)} files of {os.path.basename(bsp_file)} "
+                        f"into {REMOTE_BSP_DIR}")
+            start_time = time.time()
+            with timed('upload'):
+                sent = stream_archive_entries(ssh, bsp_file, skip)
+            elapsed = max(time.time() - start_time, 1e-6)
+            logger.info(f"Streamed {sent / (1024 * 1024):.2f}MB in {elapsed:.1f}s "
+                        f"({sent / (1024 * 1024) / elapsed:.2f}MB/s)")
+            record_transfer_metrics('stream', sent, elapsed)
+            break
+        except (socket.error, EOFError, paramiko.SSHException, SFTPError, IOError) as e:
+            if attempt == max_retries:
+                raise SFTPError(f"Streaming upload failed after {max_retries + 1} attempts: {str(e)}")
+            logger.warning(f"Streaming upload interrupted ({str(e)}), resuming (attempt {attempt + 2}/{max_retries + 1})")
+            transport = ssh.get_transport()
+            if transport is None or not transport.is_active():
+                ssh = reconnect_ssh()
+
+    with timed('verify'):
+        verify_extracted_files(ssh, manifest)
+    journal_phase('extracted')
+
+    extracted_folders = get_extracted_folders(ssh)
+    if not extracted_folders:
+        raise Exception("No folders found after extraction")
+    logger.info(f"Extracted folders: {extracted_folders}")
+
+    with timed('feed generation'):
+        feed_content = create_snmp_feed(ssh, folders=extracted_folders)
+        verify_feed_file(ssh, extracted_folders, feed_content)
+    journal_phase('feed_written')
+    logger.info("BSP package prepared successfully")
+    return ssh
+
+@timed('prepare')
 def upload_and_prepare_bsp(ssh, sftp, bsp_file):
-    """Upload BSP file and prepare for upgrade"""
+    """Upload BSP file and prepare for upgrade. Returns the SSH client in use at the end"""
+    if current_gateway().upload_mode == 'http':
+        prepare_http_feeds(ssh, bsp_file)
+        journal_phase('feed_written')
+        return ssh
+    if bsp_already_prepared(ssh, bsp_file):
+        logger.info("BSP package already prepared on gateway (journal), skipping upload and extraction")
+        return ssh
+    if current_gateway().upload_mode == 'stream':
+        return stream_and_prepare_bsp(ssh, bsp_file)
+
+    uploading = False
+    delta_dir = None
     try:
         # Verify SFTP session is active
         try:
@@ -342,50 +2007,73 @@ def upload_and_prepare_bsp(ssh, sftp, bsp_file):
             sftp = get_sftp_session(ssh)
 
         execute_command(ssh, f'mkdir -p {REMOTE_BSP_DIR}', use_sudo=True)
-        
-        # Verify space before upload
-        file_size = os.path.getsize(bsp_file) / (1024 * 1024)
-        required_space = file_size * 1.5
-        
-        logger.info(f"Checking space requirements. Need {required_space:.2f}MB")
-        available_space = check_available_space(ssh)
-        logger.info(f"Initially available space: {available_space:.2f}MB")
-        
-        if available_space < required_space:
-            if not check_and_ensure_space(ssh, required_space, auto_cleanup=True):
-                raise Exception(f"Cannot proceed: insufficient space after cleanup. Need {required_space:.2f}MB")
-        
+
+        archive_file = bsp_file
+        current_gateway().hop_payload = None
+        if current_gateway().upload_mode == 'delta':
+            delta_dir = tempfile.mkdtemp(prefix='bsp_delta_')
+            archive_file = prepare_delta_archive(ssh, bsp_file, delta_dir)
+
+        if archive_file != bsp_file:
+            # The delta is only built for this gateway and this run; its manifest is kept and its
+            # hash journaled so that a rerun can check the gateway against what was actually sent
+            manifest = BSPManifest.build(archive_file)
+            get_bsp_store().add_manifest(manifest)
+            current_gateway().hop_payload = manifest.sha256
+        else:
+            manifest = get_bsp_store().manifest(archive_file)
+        uploaded_file = find_uploaded_archive(ssh, bsp_file) if archive_file == bsp_file else None
+
+        # Verify space before upload (an archive already on the gateway only needs room to extract)
+        with timed('space check'):
+            ensure_space_for_upload(ssh, archive_space_required(archive_file, include_archive=uploaded_file is None))
+
         # Upload file
-        remote_file = os.path.join(REMOTE_BSP_DIR, os.path.basename(bsp_file))
-        logger.info(f"Uploading BSP file to {remote_file}")
-        try:
-            sftp.put(bsp_file, remote_file)
-        except Exception as e:
-            raise Exception(f"Failed to upload BSP file: {str(e)}")
-        
-        # Verify upload
-        try:
-            remote_size = int(execute_command(ssh, f'stat -c%s "{remote_file}"', use_sudo=True))
-            local_size = os.path.getsize(bsp_file)
-            if remote_size != local_size:
-                raise Exception(f"Size mismatch after upload: local={local_size}, remote={remote_size}")
-        except Exception as e:
-            logger.error(f"Upload verification failed: {str(e)}")
-            raise
+        if uploaded_file:
+            remote_file = uploaded_file
+            logger.info(f"BSP file already uploaded to {remote_file} (journal), skipping upload")
+            sha256 = manifest.sha256 if manifest else None
+        else:
+            remote_file = os.path.join(REMOTE_BSP_DIR, os.path.basename(bsp_file))
+            uploading = True
+            with timed('upload'):
+                ssh, sftp, sha256, md5 = transfer_archive(ssh, sftp, archive_file, remote_file)
+            uploading = False
+            journal_phase('uploaded')
+
+            # Verify upload end to end with the digests computed while sending
+            try:
+                if manifest and sha256 != manifest.sha256:
+                    raise Exception(f"Local archive {archive_file} changed while uploading "
+                                    f"(sha256 {sha256}, manifest {manifest.sha256})")
+                with timed('verify'):
+                    verify_remote_file(ssh, remote_file, sha256, md5)
+            except Exception as e:
+                logger.error(f"Upload verification failed: {str(e)}")
+                raise
+            journal_phase('verified')
         
         # Extract BSP
         logger.info("Unzipping BSP package...")
-        try:
-            unzip_cmd = f'cd {REMOTE_BSP_DIR} && busybox unzip -o {os.path.basename(bsp_file)}'
-            execute_command(ssh, unzip_cmd, use_sudo=True)
-        except Exception as e:
-            logger.warning(f"busybox unzip failed: {e}, trying standard unzip")
+        with timed('unzip'):
             try:
-                unzip_cmd = f'cd {REMOTE_BSP_DIR} && unzip -o {os.path.basename(bsp_file)}'
+                unzip_cmd = f'cd {REMOTE_BSP_DIR} && busybox unzip -o {remote_file}'
                 execute_command(ssh, unzip_cmd, use_sudo=True)
-            except Exception as e2:
-                raise Exception(f"Both unzip attempts failed: {str(e2)}")
-        
+            except Exception as e:
+                logger.warning(f"busybox unzip failed: {e}, trying standard unzip")
+                try:
+                    unzip_cmd = f'cd {REMOTE_BSP_DIR} && unzip -o {remote_file}'
+                    execute_command(ssh, unzip_cmd, use_sudo=True)
+                except Exception as e2:
+                    raise Exception(f"Both unzip attempts failed: {str(e2)}")
+
+        with timed('verify'):
+            verify_extracted_files(ssh, manifest or BSPManifest.build(archive_file, sha256=sha256))
+        journal_phase('extracted')
+
+        if archive_file != bsp_file:
+            remove_stale_feeds(ssh, bsp_file)
+
         # Verify extraction
         extracted_folders = get_extracted_folders(ssh)
         if not extracted_folders:
@@ -399,85 +2087,62 @@ def upload_and_prepare_bsp(ssh, sftp, bsp_file):
             logger.warning(f"Failed to remove zip file: {str(e)}")
         
         # Create and verify feed file
-        create_snmp_feed(ssh)
-        verify_feed_file(ssh, extracted_folders)
+        with timed('feed generation'):
+            feed_content = create_snmp_feed(ssh, folders=extracted_folders)
+            verify_feed_file(ssh, extracted_folders, feed_content)
+        journal_phase('feed_written')
         
         logger.info("BSP package prepared successfully")
+        return ssh
         
     except Exception as e:
         logger.error(f"Error preparing BSP package: {str(e)}")
+        if uploading:
+            logger.info("Keeping partial upload on gateway so the next attempt can resume")
+            raise
         try:
             execute_command(ssh, f'rm -rf {REMOTE_BSP_DIR}/*', use_sudo=True)
         except Exception as cleanup_error:
             logger.error(f"Failed to cleanup after error: {str(cleanup_error)}")
         raise
+    finally:
+        if delta_dir:
+            shutil.rmtree(delta_dir, ignore_errors=True)
 
+@timed('initiation')
 def initiate_bsp_upgrade(ssh, is_admin_user=False, dry_run=False):
     """Initiate the BSP upgrade process"""
     print("Initiating BSP upgrade...")
     env_vars = 'export PATH=/usr/sbin:$PATH && '
 
     print("Running opkg update...")
-    execute_command(ssh, 'opkg update', use_sudo=(GATEWAY_USERNAME != 'root'))
-    time.sleep(5)
-    print("!!! {dry_run} value 0s for dry_run")
-    if dry_run:
-        print("Skipping actual upgrade initiation (dry-run mode)")
-        return
-
-    # Запускаем обновление
-    print("Starting tektelic-dist-upgrade...")
-    execute_command(ssh, f'{env_vars} tektelic-dist-upgrade -Ddu', use_sudo=(GATEWAY_USERNAME != 'root'))
-    print("BSP upgrade initiated.")
-
-    # Задержка для того, чтобы система успела запустить процесс обновления
-    time.sleep(20)
-
-    # Проверяем, появилось ли состояние "upgrade-in-progress"
-    for attempt in range(10):  # 10 попыток с интервалом в 10 секунд
-        try:
-            current_version_output = execute_command(ssh, 'system_version', use_sudo=(GATEWAY_USERNAME != 'root'))
-            if "upgrade-in-progress" in current_version_output:
-                print("Upgrade process detected. Upgrade in progress.")
-                return
-        except Exception as e:
-            logger.warning(f"Error checking BSP version during upgrade initiation: {str(e)}")
-            time.sleep(10)
-            ssh = reconnect_ssh(max_attempts=20)
-
-    # Если после 10 попыток состояние не обновилось, считаем, что обновление не началось
-    raise Exception("Upgrade did not start properly after multiple checks.")
-
-    """Initiate the BSP upgrade process"""
-    print("Initiating BSP upgrade...")
-    env_vars = 'export PATH=/usr/sbin:$PATH && '
-
-    print("Running opkg update...")
-    execute_command(ssh, 'opkg update', use_sudo=(GATEWAY_USERNAME != 'root'))
-    time.sleep(5)
-
+    with timed('opkg update'):
+        execute_command(ssh, 'opkg update', use_sudo=not current_gateway().is_root, on_line=log_output_line)
+    pause(5)
+    logger.debug(f"dry_run={dry_run}")
     if dry_run:
         print("Skipping actual upgrade initiation (dry-run mode)")
         return
 
     # Запускаем обновление
     print("Starting tektelic-dist-upgrade...")
-    execute_command(ssh, f'{env_vars} tektelic-dist-upgrade -Ddu', use_sudo=(GATEWAY_USERNAME != 'root'))
+    execute_command(ssh, f'{env_vars} tektelic-dist-upgrade -Ddu', use_sudo=not current_gateway().is_root,
+                    on_line=log_output_line)
     print("BSP upgrade initiated.")
 
     # Задержка для того, чтобы система успела запустить процесс обновления
-    time.sleep(20)
+    pause(20)
 
     # Проверяем, появилось ли состояние "upgrade-in-progress"
     for attempt in range(10):  # 10 попыток с интервалом в 10 секунд
         try:
-            current_version_output = execute_command(ssh, 'system_version', use_sudo=(GATEWAY_USERNAME != 'root'))
+            current_version_output = execute_command(ssh, 'system_version', use_sudo=not current_gateway().is_root)
             if "upgrade-in-progress" in current_version_output:
                 print("Upgrade process detected. Upgrade in progress.")
                 return
         except Exception as e:
             logger.warning(f"Error checking BSP version during upgrade initiation: {str(e)}")
-            time.sleep(10)
+            wait_for_ssh_down()
             ssh = reconnect_ssh(max_attempts=20)
 
     # Если после 10 попыток состояние не обновилось, считаем, что обновление не началось
@@ -485,20 +2150,80 @@ def initiate_bsp_upgrade(ssh, is_admin_user=False, dry_run=False):
 
 def process_upgrade_progress_messages(ssh):
     """
-    Process and log the upgrade progress messages sent by the gateway.
+    Read the latest upgrade progress message from the kernel log once (polling fallback).
+    Returns the progress percentage, or None when there is none.
     """
     try:
-        while True:
-            # Check for new progress messages
-            progress_output = execute_command(ssh, 'dmesg | grep "BSP upgrade progress:" | tail -n 1', use_sudo=True)
-            if progress_output:
-                progress = int(progress_output.split("progress: ")[1])
-                logger.info(f"Upgrade progress: {progress}%")
-            else:
-                break
-            time.sleep(1)
+        progress_output = execute_command(ssh, 'dmesg | grep "BSP upgrade progress:" | tail -n 1', use_sudo=True)
+        match = PROGRESS_PATTERN.search(progress_output)
+        return int(match.group(1)) if match else None
     except Exception as e:
         logger.error(f"Error processing upgrade progress messages: {str(e)}")
+        return None
+
+class UpgradeProgressStream:
+    """
+    One long-lived channel following the gateway's kernel log and upgrade log.
+    Lines are parsed as they arrive instead of re-reading the whole kernel ring buffer.
+    """
+
+    def __init__(self, ssh, timeout=15):
+        gw = current_gateway()
+        self.chan = ssh.open_channel(timeout=timeout)
+        if gw.is_root:
+            self.chan.exec_command(f"sh -c {shlex.quote(PROGRESS_STREAM_COMMAND)}")
+        else:
+            # dmesg may be restricted to root; sudo reads the password from the first stdin line
+            self.chan.exec_command(f"sudo -S -k -p '' sh -c {shlex.quote(PROGRESS_STREAM_COMMAND)}")
+            self.chan.sendall(f"{gw.sudo_password}\n".encode())
+        self.chan.fileno()
+        self.progress = None
+        self.lines = OutputTail('log', on_line=self._parse_line)
+        self.last_activity = time.time()
+
+    @property
+    def active(self):
+        return not self.chan.closed and not self.chan.exit_status_ready()
+
+    def read(self, timeout):
+        """Wait up to timeout seconds for log lines and return the latest progress among them, or None"""
+        select.select([self.chan], [], [], timeout)
+        self.progress = None
+        got_data = False
+        while self.chan.recv_ready():
+            chunk = self.chan.recv(65536)
+            if not chunk:
+                break
+            self.lines.write(chunk)
+            got_data = True
+        while self.chan.recv_stderr_ready():
+            self.chan.recv_stderr(65536)
+        if got_data:
+            self.last_activity = time.time()
+        return self.progress
+
+    def _parse_line(self, stream, line):
+        match = PROGRESS_PATTERN.search(line)
+        if match:
+            self.progress = int(match.group(1))
+
+    def close(self):
+        try:
+            self.chan.close()
+        except Exception:
+            pass
+
+def open_progress_stream(ssh):
+    """Start streaming upgrade progress, or return None so that the monitor polls instead"""
+    if not PROGRESS_STREAMING:
+        return None
+    try:
+        stream = UpgradeProgressStream(ssh)
+        logger.debug("Streaming upgrade progress from the gateway logs")
+        return stream
+    except Exception as e:
+        logger.warning(f"Progress streaming unavailable ({str(e)}), polling instead")
+        return None
 
 def check_and_ensure_space(ssh, required_space, auto_cleanup=True):
     """
@@ -521,7 +2246,7 @@ def check_and_ensure_space(ssh, required_space, auto_cleanup=True):
             if cleanup != 'yes':
                 return False
         
-        # Try cleaning steps one by one and check space after each
+        # Cleaning steps run in order in one remote batch that stops once enough space is free
         cleanup_steps = [
             {
                 'name': 'Old BSP files',
@@ -545,22 +2270,19 @@ def check_and_ensure_space(ssh, required_space, auto_cleanup=True):
             }
         ]
         
+        batch = RemoteBatch('space cleanup', stop_on_error=False, space_partition='/',
+                            stop_when_free_mb=required_space)
         for step in cleanup_steps:
-            logger.info(f"Attempting to clean {step['name']}...")
-            try:
-                execute_command(ssh, step['command'], use_sudo=True)
-                available_space = check_available_space(ssh)
-                logger.info(f"Available space after cleaning {step['name']}: {available_space:.2f}MB")
-                
-                if available_space >= required_space:
-                    logger.info("Sufficient space now available")
-                    return True
-            except Exception as e:
-                logger.warning(f"Failed to clean {step['name']}: {str(e)}")
-        
-        # Final space check
-        available_space = check_available_space(ssh)
+            batch.add(step['name'], step['command'])
+        logger.info(f"Cleaning {', '.join(step['name'] for step in cleanup_steps)} until enough space is free...")
+        measured = [result.available for result in batch.run(ssh, use_sudo=True) if result.available is not None]
+
+        before_cleanup = available_space
+        available_space = measured[-1] if measured else check_available_space(ssh)
+        if available_space > before_cleanup:
+            count_metric('bsp_space_reclaimed_bytes_total', int((available_space - before_cleanup) * 1024 * 1024))
         if available_space >= required_space:
+            logger.info("Sufficient space now available")
             return True
             
         logger.error(f"Could not free up enough space. Available: {available_space:.2f}MB, Required: {required_space:.2f}MB")
@@ -579,7 +2301,7 @@ def print_upgrade_plan(current_version, model, upgrade_path, estimated_time, spa
     print("="*50)
     print(f"Gateway Model: {model}")
     print(f"Current Version: {current_version}")
-    print(f"Target Version: {TARGET_BSP_VERSION}")
+    print(f"Target Version: {current_gateway().target_version}")
     print("\nUpgrade Path:")
     for i, version in enumerate(upgrade_path, 1):
         print(f"  {i}. {version_in_progress} → {version}")
@@ -593,7 +2315,8 @@ def print_upgrade_plan(current_version, model, upgrade_path, estimated_time, spa
 
  
 
-def monitor_upgrade_progress(ssh, timeout=1800, check_interval=15):
+@timed('monitor')
+def monitor_upgrade_progress(ssh, timeout=1800, check_interval=15, stabilize=True):
     """Monitor the upgrade process and show progress"""
     start_time = time.time()
     upgrade_completed = False
@@ -604,6 +2327,8 @@ def monitor_upgrade_progress(ssh, timeout=1800, check_interval=15):
     MAX_REBOOTS = 5
     last_activity = time.time()
     MAX_INACTIVITY = 120
+    stream = None
+    lost_at = None
 
     try:
         # Wait for upgrade to start
@@ -613,69 +2338,93 @@ def monitor_upgrade_progress(ssh, timeout=1800, check_interval=15):
                 if in_progress:
                     upgrade_started = True
                     break
-                time.sleep(1)
+                pause(1)
             except Exception as e:
                 logger.warning(f"Error checking BSP version during startup: {str(e)}")
-                time.sleep(1)
+                pause(1)
 
         if not upgrade_started:
             raise Exception("Upgrade did not start within 30 seconds")
 
+        stream = open_progress_stream(ssh)
+        last_status_check = 0
+
         while time.time() - start_time < timeout:
             try:
                 current_time = time.time()
+                if stream:
+                    last_activity = max(last_activity, stream.last_activity)
 
                 if current_time - last_activity > MAX_INACTIVITY:
                     raise Exception(f"No activity detected for {MAX_INACTIVITY} seconds")
 
-                # Check system version
-                try:
-                    version_output = execute_command(ssh, 'system_version', use_sudo=True)
-                    last_activity = current_time
-
-                    if 'upgrade-in-progress' in version_output:
-                        logger.info("Upgrade is in progress...")
-                    elif upgrade_started:
-                        logger.info("System appears to have completed upgrade")
-                        upgrade_completed = True
-                        break
-
-                except Exception as e:
-                    if upgrade_started and not reboot_detected:
-                        logger.info("Lost connection - system might be rebooting...")
-                        reboot_detected = True
-                        reboot_count += 1
-                        if reboot_count > MAX_REBOOTS:
-                            raise Exception(f"Too many reboots detected ({reboot_count})")
-
-                    time.sleep(30)
+                # With a live progress stream, system_version is only checked now and then;
+                # a closed stream (e.g. the gateway rebooting) triggers a check right away
+                streaming = stream is not None and stream.active
+                if not streaming or current_time - last_status_check >= PROGRESS_STATUS_INTERVAL:
+                    last_status_check = current_time
                     try:
-                        ssh = reconnect_ssh(max_attempts=20)
-                        if reboot_detected:
-                            logger.info("Successfully reconnected after reboot")
-                            reboot_detected = False
-                            last_activity = time.time()
-                    except Exception as reconnect_error:
-                        logger.error(f"Failed to reconnect: {str(reconnect_error)}")
-                        continue
-
-                # Check progress
-                try:
-                    progress_output = execute_command(ssh, 'dmesg | grep "BSP upgrade progress:" | tail -n 1', use_sudo=True)
-                    if progress_output:
-                        progress = int(progress_output.split("progress: ")[1])
-                        if progress != last_progress:
-                            last_progress = progress
-                            last_activity = current_time
-                            logger.info(f"Upgrade progress: {progress}%")
-                            print(f'\rProgress: {progress}%', end='', flush=True)
-                except Exception as progress_error:
-                    logger.debug(f"Error checking progress: {str(progress_error)}")
-
-                # Process upgrade progress messages
-                process_upgrade_progress_messages(ssh)
-
-                time.sleep(check_interval)
+                        version_output = execute_command(ssh, 'system_version', use_sudo=True)
+                        # A gateway going down may answer with nothing; that is not a completed upgrade
+                        _, _, in_progress = parse_bsp_version(version_output)
+                        last_activity = current_time
+
+                        if in_progress:
+                            logger.info("Upgrade is in progress...")
+                        elif upgrade_started:
+                            logger.info("System appears to have completed upgrade")
+                            upgrade_completed = True
+                            break
+
+                    except Exception as e:
+                        if upgrade_started and not reboot_detected:
+                            logger.info("Lost connection - system might be rebooting...")
+                            reboot_detected = True
+                            reboot_count += 1
+                            count_metric('bsp_reboots_total')
+                            if reboot_count > MAX_REBOOTS:
+                                raise Exception(f"Too many reboots detected ({reboot_count})")
+
+                            # Let the gateway go down, then skip probing for half its usual reboot time
+                            lost_at = time.time()
+                            wait_for_ssh_down()
+                            typical = get_reboot_stats().typical(current_gateway().model)
+                            if typical:
+                                pause(max(0, typical / 2 - (time.time() - lost_at)))
+
+                        if stream:
+                            stream.close()
+                            stream = None
+                        try:
+                            ssh = reconnect_ssh(max_attempts=20)
+                            if reboot_detected:
+                                reboot_seconds = time.time() - lost_at
+                                get_reboot_stats().record(current_gateway().model, reboot_seconds)
+                                current_gateway().timings.add('reboot gap', reboot_seconds)
+                                observe_metric('bsp_reboot_duration_seconds', reboot_seconds)
+                                logger.info(f"Successfully reconnected after reboot ({reboot_seconds:.0f}s)")
+                                journal_phase('rebooted')
+                                reboot_detected = False
+                                last_activity = time.time()
+                            stream = open_progress_stream(ssh)
+                            last_status_check = 0
+                        except Exception as reconnect_error:
+                            logger.error(f"Failed to reconnect: {str(reconnect_error)}")
+                            continue
+
+                # Check progress: as it is logged when streaming, otherwise once per interval
+                if stream is not None and stream.active:
+                    progress = stream.read(timeout=min(check_interval, PROGRESS_STATUS_INTERVAL))
+                else:
+                    progress = process_upgrade_progress_messages(ssh)
+                if progress is not None and progress != last_progress:
+                    last_progress = progress
+                    last_activity = time.time()
+                    logger.info(f"Upgrade progress: {progress}%")
+                    print(f'\rProgress: {progress}%', end='', flush=True)
+
+                if stream is None or not stream.active:
+                    pause(check_interval)
 
             except Exception as loop_error:
                 logger.error(f"Error in monitoring loop: {str(loop_error)}")
@@ -686,64 +2435,260 @@ def monitor_upgrade_progress(ssh, timeout=1800, check_interval=15):
         if not upgrade_completed:
             raise TimeoutError("Upgrade process timed out")
 
-        logger.info(f"Waiting {STABILIZATION_WAIT} seconds for system to stabilize...")
-        time.sleep(STABILIZATION_WAIT * 2)  # Increase stabilization time
+        if stabilize:
+            logger.info(f"Waiting {STABILIZATION_WAIT} seconds for system to stabilize...")
+            pause(STABILIZATION_WAIT * 2)  # Increase stabilization time
 
         print("\nUpgrade process completed!")
+        return ssh
 
     except Exception as e:
         logger.error(f"Error monitoring upgrade: {str(e)}")
         raise
+    finally:
+        if stream:
+            stream.close()
 
 
 
-def upgrade_to_version(ssh, sftp, version, model):
-    """Upgrade the system to the specified version"""
+def prestage_location(ssh, bsp_file):
+    """
+    Where the next hop's archive can wait on the gateway: REMOTE_BSP_DIR when flash also has room
+    to extract it next to the current feeds, else PRESTAGE_RAM_DIR when /tmp is a tmpfs with room
+    for it, else None
+    """
+    name = os.path.basename(bsp_file)
+    archive_mb = os.path.getsize(bsp_file) / (1024 * 1024)
+
+    flash_free = check_available_space(ssh, REMOTE_BSP_DIR)
+    if flash_free >= archive_space_required(bsp_file) + PRESTAGE_FLASH_RESERVE_MB:
+        return os.path.join(REMOTE_BSP_DIR, name)
+
+    ram_mount = os.path.dirname(PRESTAGE_RAM_DIR.rstrip('/'))
+    output = execute_command(ssh, f'df -P -k {ram_mount} | tail -n 1')
+    fields = output.split()
+    if len(fields) >= 4 and fields[0] == 'tmpfs':
+        ram_free = int(fields[3]) / 1024
+        if ram_free >= archive_mb + PRESTAGE_RAM_RESERVE_MB:
+            return os.path.join(PRESTAGE_RAM_DIR, name)
+    logger.info(f"Not pre-staging {name}: {flash_free:.1f}MB flash free and no tmpfs with "
+                f"{archive_mb + PRESTAGE_RAM_RESERVE_MB:.1f}MB free")
+    return None
+
+@timed('prestage')
+def prestage_next_hop(ssh, version, model):
+    """
+    Upload and verify the archive of the next hop ahead of time and journal it as verified,
+    so that hop skips its upload. Best effort: failures only cost the overlap. Returns the SSH client.
+    """
+    gw = current_gateway()
+    if not PRESTAGE_NEXT_HOP or gw.upload_mode not in ('full', 'relay'):
+        return ssh
+    try:
+        bsp_file = get_bsp_file_for_version(version, model)
+        remote_file = prestage_location(ssh, bsp_file)
+        if not remote_file:
+            return ssh
+
+        with upload_slot(bsp_file, blocking=False) as granted:
+            if not granted:
+                logger.info(f"Not pre-staging BSP {version}: no upload slot free in the rollout budget")
+                return ssh
+            logger.info(f"Pre-staging BSP {version} to {remote_file} while the gateway stabilizes")
+            execute_command(ssh, f'mkdir -p {os.path.dirname(remote_file)}', use_sudo=True)
+            ssh, _, sha256, md5 = transfer_archive(ssh, get_sftp_session(ssh), bsp_file, remote_file)
+            verify_remote_file(ssh, remote_file, sha256, md5)
+        get_journal().record(gw.ip, version, get_bsp_manifest(bsp_file).sha256, 'verified')
+    except Exception as e:
+        logger.warning(f"Pre-staging BSP {version} failed, it will be uploaded in its own hop: {str(e)}")
+    return ssh
+
+@timed('stabilization')
+def stabilize_and_prestage(ssh, next_version, model):
+    """Wait out the post-upgrade stabilization, pre-staging the next hop meanwhile. Returns the SSH client"""
+    deadline = time.time() + STABILIZATION_WAIT * 3
+    if next_version:
+        ssh = prestage_next_hop(ssh, next_version, model)
+    pause(max(0, deadline - time.time()))
+    return ssh
+
+@timed('hop')
+def upgrade_to_version(ssh, sftp, version, model, dry_run=False, next_version=None):
+    """Upgrade the system to the specified version, pre-staging next_version while it stabilizes"""
     logger.info(f"Starting upgrade to version {version}")
 
+    gw = current_gateway()
+    hop_start = time.time()
     try:
         bsp_file = get_bsp_file_for_version(version, model)
-        upload_and_prepare_bsp(ssh, sftp, bsp_file)
-        initiate_bsp_upgrade(ssh)
-        monitor_upgrade_progress(ssh)
+        gw.hop = (version, get_bsp_manifest(bsp_file).sha256)
+        install_start = time.time()
+        if gw.upgrade_in_progress and journal_reached('initiated'):
+            logger.info(f"Upgrade to {version} was already initiated (journal), resuming monitoring")
+        else:
+            with upload_slot(bsp_file):
+                ssh = upload_and_prepare_bsp(ssh, sftp, bsp_file)
+            install_start = time.time()
+            initiate_bsp_upgrade(ssh, dry_run=dry_run)
+            if dry_run:
+                return
+            journal_phase('initiated')
+        gw.upgrade_in_progress = False
+        ssh = monitor_upgrade_progress(ssh, stabilize=False)
 
         logger.info("Waiting for system to stabilize...")
-        time.sleep(STABILIZATION_WAIT)
+        ssh = stabilize_and_prestage(ssh, next_version, model)
+        get_hop_stats().record(f"{model} {version}", time.time() - install_start)
+        observe_metric('bsp_hop_duration_seconds', time.time() - hop_start, target=version)
+        journal_phase('confirmed')
 
     except Exception as e:
         logger.error(f"Error during upgrade to version {version}: {str(e)}")
         raise
+    finally:
+        gw.hop = gw.hop_payload = None
+
+def available_bsp_versions():
+    """{version: archive path} of the BSP archives in BSP_DIR and the local store"""
+    pattern = re.compile(r'BSP_(\d+(?:\.\d+)*)\.zip$')
+    versions = {}
+    store = get_bsp_store()
+    for name in store.names():
+        match = pattern.match(name)
+        if match:
+            versions[match.group(1)] = store.find(name)
+    if os.path.isdir(BSP_DIR):
+        for name in os.listdir(BSP_DIR):
+            match = pattern.match(name)
+            if match:
+                versions[match.group(1)] = os.path.join(BSP_DIR, name)
+    return versions
+
+def upgrade_rules(model):
+    """(source pattern, target pattern) pairs of the supported direct upgrades of a model"""
+    rules = []
+    for source, path in OPTIMAL_UPGRADE_PATHS.get(model, {}).items():
+        for target in path:
+            rules.append((source, target))
+            source = target
+    # From these versions the gateway can go straight to any newer BSP
+    rules.extend((version, None) for version in DIRECT_UPGRADE_VERSIONS.get(model, []))
+    return rules
+
+_log_history = None
+_log_history_lock = threading.Lock()
+
+def get_log_history():
+    """Phase timings mined from TIMING_LOG_PATHS, read once per process"""
+    global _log_history
+    with _log_history_lock:
+        if _log_history is None:
+            _log_history = TimingHistory.load(TIMING_LOG_PATHS)
+        return _log_history
+
+def hop_figures(model, version, archive_file, upload_mode):
+    """
+    (seconds, transfer bytes, flash MB) of upgrading a gateway to version with archive_file.
+    Install time comes from the hop statistics, else the median in the historical logs, else
+    PLANNER_HOP_MINUTES; transfer time from past transfers of that archive, else its size at the
+    observed (or PLANNER_LINK_RATE) rate.
+    """
+    history = get_log_history()
+    install = history.phase_seconds(model, version, 'install', upload_mode)
+    if install is None:
+        install = history.phase_seconds(model, version, 'install')
+    if install is not None:
+        install += STABILIZATION_WAIT
+    install = get_hop_stats().typical(f"{model} {version}") or install or PLANNER_HOP_MINUTES * 60
+
+    manifest = get_bsp_store().manifest(archive_file)
+    if upload_mode == 'stream':
+        if manifest:
+            transfer_bytes = manifest.uncompressed_size
+        else:
+            with zipfile.ZipFile(archive_file) as zf:
+                transfer_bytes = sum(info.file_size for info in zf.infolist())
+    else:
+        transfer_bytes = manifest.size if manifest else os.path.getsize(archive_file)
+    if upload_mode == 'http':
+        flash_mb = 0
+    else:
+        # Extracted feeds stay on the gateway between hops while each archive is unzipped next to them
+        flash_mb = round(archive_space_required(archive_file, include_archive=upload_mode != 'stream'), 1)
+
+    transfer = history.phase_seconds(model, version, 'transfer', upload_mode)
+    if transfer is None:
+        transfer = transfer_bytes / (history.transfer_rate(upload_mode) or PLANNER_LINK_RATE)
+    transfer += history.phase_seconds(model, version, 'extract', upload_mode) or 0
+    return install + transfer, transfer_bytes, flash_mb
+
+def hop_cost(seconds, transfer_bytes, flash_mb):
+    """Weight of one hop in the upgrade graph: expected seconds, plus the configured flash penalty"""
+    return seconds + flash_mb * PLANNER_FLASH_WEIGHT
+
+_upgrade_graphs = {}
+_upgrade_graphs_lock = threading.Lock()
+
+def _file_signature(path):
+    """(size, mtime) of a file, or None when it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def get_upgrade_graph(model, upload_mode):
+    """
+    Version graph of a model, compiled once per set of archives and measured hop times.
+    The cache key only stats files: the archives and the hop statistics file, which changes
+    whenever a hop time is recorded
+    """
+    archives = available_bsp_versions()
+    signature = tuple(sorted((version, path, _file_signature(path)) for version, path in archives.items()))
+    key = (model, upload_mode, signature, _file_signature(get_hop_stats().path))
+    with _upgrade_graphs_lock:
+        graph = _upgrade_graphs.get(key)
+        if graph is None:
+            versions = {version: hop_figures(model, version, path, upload_mode) for version, path in archives.items()}
+            graph = _upgrade_graphs[key] = UpgradeGraph(model, upgrade_rules(model), versions, hop_cost)
+        return graph
 
 def analyze_upgrade_path(current_version, model):
-    """Analyze and determine the optimal upgrade path"""
-    logger.info(f"Analyzing upgrade path for {model} gateway from version {current_version} to {TARGET_BSP_VERSION}")
-    
-    base_version = f"{current_version.split('.')[0]}.x.x"
-    logger.info(f"Base version for upgrade path: {base_version}")
-    
-    if any(current_version.startswith(ver.split('.')[0]) for ver in DIRECT_UPGRADE_VERSIONS[model]):
-        upgrade_path = [TARGET_BSP_VERSION]
-        logger.info("Direct upgrade is possible!")
-        estimated_time = 20
-        space_required = 40
-    elif base_version == "3.x.x":
-        # Special handling for 3.x.x to 5.1.x upgrade
-        upgrade_path = ["4.0.2", TARGET_BSP_VERSION]
-        logger.info("Upgrading from 3.x.x to 5.1.x")
-        estimated_time = 40
-        space_required = 80
-    else:
-        upgrade_path = OPTIMAL_UPGRADE_PATHS[model].get(base_version)
-        if not upgrade_path:
-            raise ValueError(f"No upgrade path found for {model} gateway version {current_version}")
-        estimated_time = 20 * len(upgrade_path)
-        space_required = 40 * 2
-
-    logger.info(f"Upgrade path: {' -> '.join(upgrade_path)}")
-    logger.info(f"Estimated time: {estimated_time} minutes")
+    """Find the cheapest upgrade path to the target version through the BSP archives at hand"""
+    gw = current_gateway()
+    target_version = gw.target_version
+    logger.info(f"Analyzing upgrade path for {model} gateway from version {current_version} to {target_version}")
+    if model not in OPTIMAL_UPGRADE_PATHS:
+        raise ValueError(f"Unknown gateway model {model}")
+
+    graph = get_upgrade_graph(model, gw.upload_mode)
+    plan = graph.plan(current_version, target_version)
+    if plan is None:
+        listed = {target for _, target in upgrade_rules(model) if target} | {target_version}
+        missing = sorted((version for version in listed
+                          if not any(version_matches(available, version) for available in graph.versions)),
+                         key=parse_version)
+        message = f"No upgrade path found for {model} gateway version {current_version} to {target_version}"
+        if missing:
+            message += f"; no BSP archive in {BSP_DIR} for: {', '.join(missing)}"
+        raise ValueError(message)
+
+    estimated_time = round(plan.seconds / 60)
+    space_required = plan.flash_mb
+    logger.info(f"Upgrade path: {' -> '.join(plan.path) or '(already at target)'}")
+    history = get_log_history()
+    for step in plan.steps:
+        runs = history.hop_count(model, step.target)
+        if runs:
+            p50 = history.phase_seconds(model, step.target, 'total', q=50) / 60
+            p90 = history.phase_seconds(model, step.target, 'total', q=90) / 60
+            logger.info(f"  {step.source} -> {step.target}: {p50:.0f} min typical, {p90:.0f} min p90 "
+                        f"over {runs} past upgrades")
+    logger.info(f"Estimated time: {estimated_time} minutes, transfer {plan.transfer_bytes / (1024 * 1024):.1f} MB")
     logger.info(f"Required space: {space_required} MB")
-    
-    return upgrade_path, estimated_time, space_required
+
+    return plan.path, estimated_time, space_required
+
 def verify_upgrade_path(upgrade_path, model):
     """Verify all required BSP files exist"""
     missing_files = []
@@ -752,80 +2697,118 @@ def verify_upgrade_path(upgrade_path, model):
             get_bsp_file_for_version(version, model)
         except FileNotFoundError as e:
             missing_files.append(version)
-    
+
     if missing_files:
         raise ValueError(f"Missing BSP files for versions: {', '.join(missing_files)}")
 
-def main():
-    """Main function to orchestrate the upgrade process"""
-    dry_run = '--dry-run' in sys.argv
-    if dry_run:
-        print("*** Dry-run mode active. No actual upgrade will be performed. ***")
-
+def plan_gateway_upgrade(ssh):
+    """Detect the active gateway's version and model and work out its upgrade path"""
+    gw = current_gateway()
+    current_version, model, upgrade_in_progress = check_bsp_version(ssh)
+    gw.model = model
+    gw.start_version = current_version
+    gw.upgrade_in_progress = upgrade_in_progress
+    pending = get_journal().pending(gw.ip)
+    if upgrade_in_progress and not (pending and pending.reached('initiated')):
+        raise Exception("Gateway is currently in upgrade state. Please wait for it to complete.")
+    if gw.model_hint and gw.model_hint != model:
+        raise BSPVersionError(f"Detected model {model} does not match inventory model {gw.model_hint}")
+
+    upgrade_path, estimated_time, space_required = analyze_upgrade_path(current_version, model)
+    gw.upgrade_path = upgrade_path
+    verify_upgrade_path(upgrade_path, model)
+    return current_version, model, upgrade_path, estimated_time, space_required
+
+def upgrade_gateway(dry_run=False, interactive=True):
+    """Run the full upgrade pipeline against the active gateway context"""
+    gw = current_gateway()
     ssh = None
-    sftp = None
+    error = None
 
     try:
-        logger.info(f"Connecting to gateway {GATEWAY_IP}")
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(GATEWAY_IP, username=GATEWAY_USERNAME, password=GATEWAY_PASSWORD)
-
-        current_version, model, upgrade_in_progress = check_bsp_version(ssh)
-        if upgrade_in_progress:
-            raise Exception("Gateway is currently in upgrade state. Please wait for it to complete.")
+        logger.info(f"Connecting to gateway {gw.ip}")
+        with timed('connect'):
+            ssh = connect_gateway()
 
-        upgrade_path, estimated_time, space_required = analyze_upgrade_path(current_version, model)
-        verify_upgrade_path(upgrade_path, model)
+        with timed('plan'):
+            current_version, model, upgrade_path, estimated_time, space_required = plan_gateway_upgrade(ssh)
 
-        if not print_upgrade_plan(current_version, model, upgrade_path, estimated_time, space_required):
+        if interactive and not print_upgrade_plan(current_version, model, upgrade_path, estimated_time, space_required):
             logger.info("Upgrade cancelled by user")
-            return
-
-        logger.info("Cleaning up BSP directory...")
-        execute_command(ssh, f'rm -rf {REMOTE_BSP_DIR}', use_sudo=True)
-        execute_command(ssh, f'mkdir -p {REMOTE_BSP_DIR}', use_sudo=True)
+            return None
 
-        for version in upgrade_path:
-            if sftp:
-                sftp.close()
-            sftp = ensure_sftp_session(ssh)
+        resume = journal_resume_point(upgrade_path, model)
+        if resume:
+            logger.info(f"Resuming upgrade to {resume.version} after phase '{resume.phase}' (journal), "
+                        f"keeping BSP directory")
+        else:
+            logger.info("Cleaning up BSP directory...")
+            batch = RemoteBatch('BSP directory cleanup')
+            for command in bsp_dir_cleanup_commands():
+                batch.add(command, command)
+            with timed('cleanup'):
+                batch.run(ssh, use_sudo=True, check=True)
+
+        for i, version in enumerate(upgrade_path):
+            # Every hop shares the connection's SFTP session, reopened only after a reboot
+            sftp = get_sftp_session(ssh)
 
+            next_version = upgrade_path[i + 1] if i + 1 < len(upgrade_path) else None
             try:
-                upgrade_to_version(ssh, sftp, version, model)
-                initiate_bsp_upgrade(ssh, dry_run=dry_run)
+                upgrade_to_version(ssh, sftp, version, model, dry_run=dry_run, next_version=next_version)
             except Exception as e:
                 logger.error(f"Error during upgrade to version {version}: {str(e)}")
                 raise
-            finally:
-                if sftp:
-                    sftp.close()
+
+        if dry_run:
+            logger.info("Dry-run completed, skipping final version check")
+            return None
 
         final_version, _, _ = check_bsp_version(ssh)
-        if final_version == TARGET_BSP_VERSION:
+        gw.final_version = final_version
+        if version_matches(final_version, gw.target_version):
+            get_journal().forget(gw.ip)
             logger.info(f"Upgrade successful! Final BSP version is {final_version}")
         else:
-            raise Exception(f"Upgrade failed! Final version is {final_version}, expected {TARGET_BSP_VERSION}")
+            raise Exception(f"Upgrade failed! Final version is {final_version}, expected {gw.target_version}")
+        return final_version
 
     except Exception as e:
+        error = e
         logger.error(f"Upgrade process failed: {str(e)}")
         raise
     finally:
-        if sftp:
-            try:
-                sftp.close()
-            except Exception as e:
-                logger.error(f"Error closing SFTP connection: {str(e)}")
-
+        log_timings()
+        record_run_metrics(error)
         if ssh:
             try:
                 ssh.close()
             except Exception as e:
                 logger.error(f"Error closing SSH connection: {str(e)}")
 
+def main():
+    """Main function to orchestrate the upgrade process"""
+    dry_run = '--dry-run' in sys.argv
+    if dry_run:
+        print("*** Dry-run mode active. No actual upgrade will be performed. ***")
+    if '--delta' in sys.argv:
+        current_gateway().upload_mode = 'delta'
+    elif '--http-feeds' in sys.argv:
+        current_gateway().upload_mode = 'http'
+    elif '--stream' in sys.argv:
+        current_gateway().upload_mode = 'stream'
+
+    # --profile profiles this side of the run with cProfile, --profile=pyinstrument with pyinstrument
+    profiler = next((arg.partition('=')[2] or 'cprofile' for arg in sys.argv if arg.startswith('--profile')), None)
+    if profiler:
+        with profiled(profiler):
+            upgrade_gateway(dry_run=dry_run)
+    else:
+        upgrade_gateway(dry_run=dry_run)
+
 if __name__ == '__main__':
     try:
         main()
     except Exception as e:
         logger.error(f"Script execution failed: {str(e)}")
-        exit(1)
\ No newline at end of file
+        exit(1)
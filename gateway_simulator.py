@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import zipfile
+
+import paramiko
+
+SIM_DIR = '.sim'  # Simulator state inside a gateway's root directory
+# Server-side paramiko logs; port probes and reboots make them report dropped handshakes all the time
+SERVER_LOG_CHANNEL = 'gateway_simulator.ssh'
+logging.getLogger(SERVER_LOG_CHANNEL).setLevel(logging.CRITICAL)
+SIM_USERNAME = 'root'
+SIM_PASSWORD = 'sim'
+
+# Gateway paths that are mapped into the simulator root directory; anything else is the host's
+MAPPED_PREFIXES = ['/lib/firmware', '/etc/opkg', '/backup', '/var/log', '/var/lib/opkg', '/tmp']
+
+# system_version output of a Kona Micro
+SYSTEM_VERSION_TEMPLATE = """Distributor ID:           Tektelic
+Description:              Tektelic Kona {model} GNU/Linux {version}
+Release:                  {release}
+
+Product:                  Kona {model}
+u-boot:                   2013.07-rc2-kona-micro-indoor-v1.1.1-g192ec130e7
+Linux kernel:             3.12.17-tektelic-2.4.2-kona-micro-indoor-g75e8c75853
+
+System monitor:           tektelic-system-monitor-2:0.19-r0 (base tektelic-system-monitor-2_0.19-r0)*
+SNMP agent:               tektelic-snmp-agents-1.10.0-r14
+Network monitor:          kona-network-monitor-0.28-r14
+LoRa HAL:                 tektelic-lora-hal-5.1.2-r2
+BSP upgrade tool:         tektelic-upgrade-1.8.0-r30.p28 (base tektelic-upgrade-1.7.0-r30.p27)*
+Backup tool:              tektelic-backup-1.7.0-r18
+TCS agent:                tektelic-tcs-1.7.0-r73
+
+GPIO FPGA:                5007 build 0030
+"""
+
+_PATH_PATTERN = re.compile(r'(?<![\w./-])(' + '|'.join(re.escape(p) for p in MAPPED_PREFIXES) + r')(?=/|\b)')
+_FEED_PATTERN = re.compile(r'src/gz\s+(\S+)\s+(\S+)')
+
+
+def map_remote_path(root, text):
+    """Rewrite the gateway paths in a command or path so they point into the simulator root"""
+    return _PATH_PATTERN.sub(lambda m: root + m.group(1), text)
+
+
+# Gateway commands the host does not have, as Python scripts run with the simulator's paths prepended
+SHIMS = {
+    'system_version': r'''
+import json, sys
+state = json.load(open(STATE))
+release = state['version'] + (' upgrade-in-progress' if state['upgrading'] else '')
+sys.stdout.write(TEMPLATE.format(model=state['model'], version=state['version'], release=release))
+''',
+    'tektelic-dist-upgrade': r'''
+import os, sys
+if '-Ddu' in sys.argv[1:]:
+    open(os.path.join(SIMDIR, 'upgrade_requested'), 'w').close()
+    print('Upgrade scheduled')
+''',
+    'opkg': r'''
+import gzip, os, re, sys, urllib.request
+if sys.argv[1:2] == ['update']:
+    lists = ROOT + '/var/lib/opkg/lists'
+    os.makedirs(lists, exist_ok=True)
+    conf_dir = ROOT + '/etc/opkg'
+    for name in sorted(os.listdir(conf_dir)) if os.path.isdir(conf_dir) else []:
+        for line in open(os.path.join(conf_dir, name)):
+            m = re.match(r'src/gz\s+(\S+)\s+(\S+)', line.strip())
+            if not m:
+                continue
+            feed, url = m.groups()
+            url = url.rstrip('/') + '/Packages.gz'
+            if url.startswith('file://'):
+                path = url[len('file://'):]
+                data = open(path if path.startswith(ROOT) else ROOT + path, 'rb').read()
+            else:
+                data = urllib.request.urlopen(url, timeout=30).read()
+            open(os.path.join(lists, feed), 'wb').write(gzip.decompress(data))
+            print(f'Updated source {feed}.')
+elif sys.argv[1:2] == ['list-installed']:
+    sys.stdout.write(open(os.path.join(SIMDIR, 'installed')).read())
+''',
+    'dmesg': r'''
+import os, sys, time
+follow = '-w' in sys.argv[1:]
+with open(os.path.join(SIMDIR, 'dmesg')) as f:
+    while True:
+        line = f.readline()
+        if line:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        elif follow:
+            time.sleep(0.2)
+        else:
+            break
+''',
+    'df': r'''
+import os, sys
+total = int(open(os.path.join(SIMDIR, 'disk_kb')).read())
+used = 0
+for dirpath, dirnames, filenames in os.walk(ROOT):
+    if dirpath.startswith(SIMDIR):
+        continue
+    for name in filenames:
+        try:
+            used += os.path.getsize(os.path.join(dirpath, name))
+        except OSError:
+            pass
+used //= 1024
+available = max(total - used, 0)
+percent = 100 * used // max(total, 1)
+def human(kb):
+    return f'{kb / 1024:.1f}M' if kb < 1024 * 1024 else f'{kb / 1024 / 1024:.1f}G'
+print('Filesystem                Size      Used Available Use% Mounted on')
+if '-k' in sys.argv[1:]:
+    print(f'ubi0:rootfs {total} {used} {available} {percent}% /')
+else:
+    print(f'ubi0:rootfs {human(total)} {human(used)} {human(available)} {percent}% /')
+''',
+    'busybox': r'''
+import os, subprocess, sys
+args = sys.argv[1:]
+if args[:1] == ['httpd']:
+    # busybox httpd -p PORT -h DIR: serve DIR in the background with Python's HTTP server
+    port, directory = args[args.index('-p') + 1], args[args.index('-h') + 1]
+    subprocess.Popen([sys.executable, '-m', 'http.server', port], cwd=directory, stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    sys.exit(0)
+os.execvp(args[0], args)
+''',
+}
+
+SIM_FEEDS = ['bsp', 'gpio-fpga', 'utils', 'python-extra', 'webserver']  # Feed folders of a synthetic BSP archive
+
+
+def make_bsp_archive(path, version, packages_per_feed=4, package_kb=64):
+    """
+    Write a synthetic BSP archive laid out like the real ones: a folder per feed with its packages,
+    Packages and Packages.gz, and tektelic-release at version in the bsp feed. Packages other than
+    tektelic-release have the same name, version and content in every archive, as unchanged
+    packages do across real BSP releases.
+    """
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for feed in SIM_FEEDS:
+            packages = [(f'{feed}-pkg{i}', f'1.{i}.0') for i in range(packages_per_feed)]
+            if feed == 'bsp':
+                packages.append(('tektelic-release', version))
+            stanzas = []
+            for name, package_version in packages:
+                size = package_kb * 1024
+                data = random.Random(f'{name} {package_version}').getrandbits(8 * size).to_bytes(size, 'little')
+                filename = f'{name}_{package_version}_arm.ipk'
+                archive.writestr(f'{feed}/{filename}', data)
+                stanzas.append(f'Package: {name}\nVersion: {package_version}\nFilename: {filename}\n'
+                               f'Size: {size}\nMD5Sum: {hashlib.md5(data).hexdigest()}\n')
+            index = '\n'.join(stanzas) + '\n'
+            archive.writestr(f'{feed}/Packages', index)
+            archive.writestr(f'{feed}/Packages.gz', gzip.compress(index.encode()))
+    return path
+
+
+# sudo that drops the password line of "echo <pw> | sudo -S" and runs the command as is
+SUDO_SHIM = '''#!/bin/sh
+stdin_password=0
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -S) stdin_password=1; shift ;;
+        -k) shift ;;
+        -p) shift 2 ;;
+        *) break ;;
+    esac
+done
+if [ $stdin_password = 1 ]; then
+    IFS= read -r _password
+fi
+exec "$@"
+'''
+
+
+class LinkEmulator:
+    """TCP relay adding one-way latency and an optional bandwidth cap in each direction"""
+
+    def __init__(self, target_port, latency_ms=0, bandwidth_mbit=None, target_host='127.0.0.1', host='127.0.0.1',
+                 port=0):
+        self.target = (target_host, target_port)
+        self.host = host
+        self.delay = latency_ms / 1000.0
+        self.bytes_per_second = bandwidth_mbit * 125000 if bandwidth_mbit else None
+        self.port = port
+        self.bytes_up = 0  # Bytes relayed towards the target
+        self.bytes_down = 0
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self._sock.listen(16)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                break
+            try:
+                upstream = socket.create_connection(self.target)
+            except OSError:
+                client.close()
+                continue
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._relay(client, upstream, 'bytes_up')
+            self._relay(upstream, client, 'bytes_down')
+
+    def _relay(self, src, dst, counter):
+        packets = queue.Queue()
+
+        def reader():
+            while True:
+                try:
+                    data = src.recv(65536)
+                except OSError:
+                    data = b''
+                packets.put((time.monotonic() + self.delay, data))
+                if not data:
+                    return
+
+        def writer():
+            link_free_at = time.monotonic()
+            while True:
+                due, data = packets.get()
+                if not data:
+                    try:
+                        dst.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+                    return
+                if self.bytes_per_second:
+                    link_free_at = max(link_free_at, time.monotonic()) + len(data) / self.bytes_per_second
+                    due = max(due, link_free_at)
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    dst.sendall(data)
+                except OSError:
+                    return
+                with self._lock:
+                    setattr(self, counter, getattr(self, counter) + len(data))
+
+        threading.Thread(target=reader, daemon=True).start()
+        threading.Thread(target=writer, daemon=True).start()
+
+    def stop(self):
+        if self._sock:
+            self._sock.close()
+
+
+class SimulatedGateway(paramiko.ServerInterface):
+    """
+    A local SSH/SFTP server that behaves like a Kona gateway during a BSP upgrade. Commands run in
+    the host's /bin/sh with gateway paths mapped into root, and shims for the gateway's own tools
+    (system_version, opkg, tektelic-dist-upgrade, dmesg, df, busybox, sudo). An upgrade installs the
+    packages of the configured feeds, logs progress to dmesg, then drops every connection and
+    refuses new ones for reboot_seconds, `reboots` times, before reporting the new release.
+    """
+
+    def __init__(self, root, model='Micro', version='4.0.2', username=SIM_USERNAME, password=SIM_PASSWORD,
+                 disk_mb=256, upgrade_seconds=10, reboot_seconds=5, reboots=1, host='127.0.0.1', port=0):
+        self.root = os.path.abspath(root)
+        self.simdir = os.path.join(self.root, SIM_DIR)
+        self.username = username
+        self.password = password
+        self.upgrade_seconds = upgrade_seconds
+        self.reboot_seconds = reboot_seconds
+        self.reboots = reboots
+        self.host = host
+        self.port = port
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.commands = []  # Every command run, exec requests and persistent shell lines alike
+        self.connections = 0
+        self.failed_installs = []
+        self._transports = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._accepting = threading.Event()
+        self._sock = None
+        self._setup_root(model, version, disk_mb)
+
+    def _setup_root(self, model, version, disk_mb):
+        for prefix in MAPPED_PREFIXES:
+            os.makedirs(self.root + prefix, exist_ok=True)
+        os.makedirs(os.path.join(self.simdir, 'bin'), exist_ok=True)
+        for name in ('dmesg', 'installed'):
+            open(os.path.join(self.simdir, name), 'a').close()
+        with open(os.path.join(self.simdir, 'disk_kb'), 'w') as f:
+            f.write(str(disk_mb * 1024))
+        self._write_state({'model': model, 'version': version, 'upgrading': False})
+
+        header = (f"#!{sys.executable}\n"
+                  f"ROOT = {self.root!r}\nSIMDIR = {self.simdir!r}\n"
+                  f"STATE = {os.path.join(self.simdir, 'state.json')!r}\n"
+                  f"TEMPLATE = {SYSTEM_VERSION_TEMPLATE!r}\n")
+        for name, body in SHIMS.items():
+            self._write_shim(name, header + body)
+        self._write_shim('sudo', SUDO_SHIM)
+
+    def _write_shim(self, name, content):
+        path = os.path.join(self.simdir, 'bin', name)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, 0o755)
+
+    def _write_state(self, state):
+        tmp = os.path.join(self.simdir, 'state.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(self.simdir, 'state.json'))
+
+    @property
+    def state(self):
+        with open(os.path.join(self.simdir, 'state.json')) as f:
+            return json.load(f)
+
+    def dmesg(self, line):
+        with open(os.path.join(self.simdir, 'dmesg'), 'a') as f:
+            f.write(f"[{time.monotonic():12.6f}] {line}\n")
+
+    # paramiko server interface
+
+    def check_auth_password(self, username, password):
+        if username == self.username and password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode() if isinstance(command, bytes) else command
+        with self._lock:
+            self.commands.append(command)
+        threading.Thread(target=self._run, args=(channel, command), daemon=True).start()
+        return True
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=self._run, args=(channel, 'sh'), daemon=True).start()
+        return True
+
+    def _run(self, channel, command):
+        env = dict(os.environ, PATH=os.path.join(self.simdir, 'bin') + ':/usr/sbin:/usr/bin:/bin')
+        try:
+            proc = subprocess.Popen(['/bin/sh', '-c', map_remote_path(self.root, command)], cwd=self.root, env=env,
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            channel.sendall_stderr(f"{e}\n".encode())
+            channel.send_exit_status(127)
+            channel.close()
+            return
+
+        # A shell (e.g. the persistent shell backend) gets its commands as lines on stdin
+        interactive = re.search(r'(^|\s)sh$', command.strip()) is not None
+
+        def pump_stdin():
+            pending = b''
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    if interactive:
+                        pending += data
+                        *lines, pending = pending.split(b'\n')
+                        lines = [line.decode(errors='replace') for line in lines]
+                        with self._lock:
+                            self.commands.extend(lines)
+                        data = b''.join(map_remote_path(self.root, line).encode() + b'\n' for line in lines)
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except (OSError, EOFError, paramiko.SSHException):
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        def pump(stream, send):
+            try:
+                for chunk in iter(lambda: stream.read1(32768), b''):
+                    send(chunk)
+            except (OSError, EOFError, paramiko.SSHException):
+                pass
+
+        threading.Thread(target=pump_stdin, daemon=True).start()
+        stderr = threading.Thread(target=pump, args=(proc.stderr, channel.sendall_stderr), daemon=True)
+        stderr.start()
+        pump(proc.stdout, channel.sendall)
+        stderr.join()
+        status = proc.wait()
+        try:
+            channel.send_exit_status(status)
+            channel.shutdown_write()
+            channel.close()
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+
+    # Server loop
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self._sock.listen(100)
+        self._accepting.set()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        threading.Thread(target=self._upgrade_loop, daemon=True).start()
+        return self
+
+    def _accept_loop(self):
+        self._sock.settimeout(0.2)
+        while not self._stop.is_set():
+            try:
+                client, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not self._accepting.is_set():
+                client.close()
+                continue
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        transport = paramiko.Transport(client)
+        transport.set_log_channel(SERVER_LOG_CHANNEL)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SimulatedSFTPServer, root=self.root)
+        with self._lock:
+            self._transports.append(transport)
+            self.connections += 1
+        try:
+            transport.start_server(server=self)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+
+    def _drop_connections(self):
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+
+    def reboot(self, on_boot=None):
+        """Drop every connection and refuse new ones for reboot_seconds"""
+        self._accepting.clear()
+        self._drop_connections()
+        time.sleep(self.reboot_seconds)
+        if on_boot:
+            on_boot()
+        self._accepting.set()
+
+    def _feeds(self):
+        """{feed name: URL} of the opkg configuration"""
+        feeds = {}
+        conf_dir = self.root + '/etc/opkg'
+        for name in sorted(os.listdir(conf_dir)) if os.path.isdir(conf_dir) else []:
+            with open(os.path.join(conf_dir, name)) as f:
+                for line in f:
+                    match = _FEED_PATTERN.match(line.strip())
+                    if match:
+                        feeds[match.group(1)] = match.group(2)
+        return feeds
+
+    def _feed_packages(self, feed):
+        path = os.path.join(self.root + '/var/lib/opkg/lists', feed)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            stanzas = f.read().split('\n\n')
+        return [dict(line.split(': ', 1) for line in stanza.strip().splitlines() if ': ' in line)
+                for stanza in stanzas]
+
+    def _upgrade_target(self):
+        for feed in self._feeds():
+            for package in self._feed_packages(feed):
+                if package.get('Package') == 'tektelic-release':
+                    return package.get('Version')
+        return None
+
+    def _package_available(self, url, filename):
+        if url.startswith('file://'):
+            path = url[len('file://'):]
+            path = path if path.startswith(self.root) else self.root + path
+            return os.path.exists(os.path.join(path, filename))
+        try:
+            urllib.request.urlopen(url.rstrip('/') + '/' + filename, timeout=30).read()
+            return True
+        except OSError:
+            return False
+
+    def _install_packages(self):
+        """Install every feed package whose version differs from the installed one; returns missing files"""
+        installed_file = os.path.join(self.simdir, 'installed')
+        installed = {}
+        with open(installed_file) as f:
+            for line in f:
+                if ' - ' in line:
+                    name, version = line.strip().split(' - ', 1)
+                    installed[name] = version
+
+        missing = []
+        new = dict(installed)
+        for feed, url in self._feeds().items():
+            for package in self._feed_packages(feed):
+                if 'Package' not in package or installed.get(package['Package']) == package.get('Version'):
+                    continue
+                if not self._package_available(url, package['Filename']):
+                    missing.append(package['Filename'])
+                new[package['Package']] = package['Version']
+        if not missing:
+            with open(installed_file, 'w') as f:
+                for name, version in sorted(new.items()):
+                    f.write(f"{name} - {version}\n")
+        return missing
+
+    def _upgrade_loop(self):
+        flag = os.path.join(self.simdir, 'upgrade_requested')
+        while not self._stop.is_set():
+            if not os.path.exists(flag):
+                time.sleep(0.1)
+                continue
+            os.remove(flag)
+            target = self._upgrade_target()
+            if not target:
+                self.dmesg("tektelic-dist-upgrade: no upgrade available")
+                continue
+            missing = self._install_packages()
+            if missing:
+                self.dmesg(f"opkg: package files missing: {' '.join(missing)}")
+                self.failed_installs.append(missing)
+                continue
+
+            state = self.state
+            state['upgrading'] = True
+            self._write_state(state)
+            steps = 10
+            for reboot in range(self.reboots):
+                for i in range(steps + 1):
+                    self.dmesg(f"BSP upgrade progress: {i * 100 // steps}")
+                    time.sleep(self.upgrade_seconds / steps / self.reboots)
+                if reboot == self.reboots - 1:
+                    state.update(version=target, upgrading=False)
+                    self.reboot(on_boot=lambda: self._write_state(state))
+                else:
+                    self.reboot()
+
+    def stop(self):
+        self._stop.set()
+        self._drop_connections()
+        if self._sock:
+            self._sock.close()
+
+
+class SimulatedSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class SimulatedSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server mapping gateway paths into the simulator root"""
+
+    def __init__(self, server, *args, root=None, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _path(self, path):
+        path = self.canonicalize(path)
+        mapped = map_remote_path(self.root, path)
+        return mapped if mapped != path else self.root + path
+
+    def list_folder(self, path):
+        try:
+            real = self._path(path)
+            out = []
+            for name in os.listdir(real):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(real, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0o644)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                mode = 'rb'
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = SimulatedSFTPHandle(flags)
+        handle.filename = self._path(path)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        if attr.st_size is not None:
+            try:
+                os.truncate(self._path(path), attr.st_size)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated Kona gateway for testing BSP upgrades without hardware")
+    parser.add_argument('root', help="Directory holding the simulated gateway's filesystem")
+    parser.add_argument('--port', type=int, default=2222, help="SSH port to listen on (default 2222)")
+    parser.add_argument('--model', default='Micro', help="Gateway model (default Micro)")
+    parser.add_argument('--version', default='4.0.2', help="Installed BSP release (default 4.0.2)")
+    parser.add_argument('--password', default=SIM_PASSWORD, help=f"root password (default {SIM_PASSWORD})")
+    parser.add_argument('--disk-mb', type=int, default=256, help="Flash size reported by df (default 256)")
+    parser.add_argument('--upgrade-seconds', type=float, default=60, help="Install time of an upgrade (default 60)")
+    parser.add_argument('--reboot-seconds', type=float, default=30, help="Downtime of each reboot (default 30)")
+    parser.add_argument('--reboots', type=int, default=1, help="Reboots during each upgrade (default 1)")
+    parser.add_argument('--latency', type=float, default=0, help="One-way link latency in ms (default 0)")
+    parser.add_argument('--bandwidth', type=float, default=None, help="Link bandwidth in Mbit/s (default unlimited)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    shaped = args.latency or args.bandwidth
+    gateway = SimulatedGateway(args.root, model=args.model, version=args.version, password=args.password,
+                               disk_mb=args.disk_mb, upgrade_seconds=args.upgrade_seconds,
+                               reboot_seconds=args.reboot_seconds, reboots=args.reboots,
+                               port=0 if shaped else args.port).start()
+    link = LinkEmulator(gateway.port, args.latency, args.bandwidth, port=args.port).start() if shaped else None
+    print(f"Simulated Kona {args.model} {args.version} listening on 127.0.0.1:{args.port} "
+          f"(user {SIM_USERNAME}, password {args.password}); Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if link:
+            link.stop()
+        gateway.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bsp_upgrade  # noqa: E402
+from gateway_simulator import SimulatedGateway, make_bsp_archive  # noqa: E402
+
+# Local state files of the pipeline, moved into each test's directory
+STATE_FILES = ('UPLOAD_CHECKPOINT_DIR', 'FEED_SERVER_DIR', 'BSP_CACHE_DIR', 'REBOOT_STATS_FILE',
+               'HOP_STATS_FILE', 'JOURNAL_FILE', 'VERSION_INDEX_FILE')
+
+
+@pytest.fixture(autouse=True, scope='session')
+def session_log(tmp_path_factory):
+    """Send the run log that importing bsp_upgrade opens to a temporary file instead of bsp_upgrade.log"""
+    root = logging.getLogger()
+    path = str(tmp_path_factory.mktemp('log') / 'bsp_upgrade.log')
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.FileHandler) and os.path.basename(handler.baseFilename) == 'bsp_upgrade.log':
+            root.removeHandler(handler)
+            handler.close()
+            replacement = logging.FileHandler(path)
+            replacement.setFormatter(handler.formatter)
+            root.addHandler(replacement)
+    yield path
+
+
+@pytest.fixture
+def isolated_state(tmp_path, monkeypatch):
+    """Point the pipeline's state files and shared singletons at a fresh directory"""
+    for name in STATE_FILES:
+        monkeypatch.setattr(bsp_upgrade, name, str(tmp_path / os.path.basename(getattr(bsp_upgrade, name))))
+    for name in ('_bsp_store', '_journal', '_feed_server', '_reboot_stats', '_hop_stats'):
+        monkeypatch.setattr(bsp_upgrade, name, None)
+    monkeypatch.setattr(bsp_upgrade, 'PAUSE_SCALE', 0.05)
+    monkeypatch.setattr(bsp_upgrade, 'TIMING_LOG_PATHS', [])
+    yield tmp_path
+    if bsp_upgrade._feed_server:
+        bsp_upgrade._feed_server.stop()
+
+
+@pytest.fixture
+def gateway(tmp_path):
+    """A running simulated gateway (root / sim)"""
+    simulator = SimulatedGateway(str(tmp_path / 'gateway'))
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+@pytest.fixture
+def bsp_archive(tmp_path):
+    (tmp_path / 'bsps').mkdir(exist_ok=True)
+    return make_bsp_archive(str(tmp_path / 'bsps' / 'BSP_7.1.2.zip'), '7.1.2', package_kb=16)
+
+
+def gateway_entry(simulator):
+    """Inventory entry of a simulated gateway"""
+    return {'ip': '127.0.0.1', 'port': simulator.port, 'username': simulator.username,
+            'password': simulator.password, 'sudo_password': None, 'model': None}
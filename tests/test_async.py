@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+import bsp_upgrade
+from bsp_async import async_execute_command, async_upgrade_gateway, run_async, run_blocking, run_transfer
+from bsp_upgrade import GatewayContext, connect_gateway, gateway_context
+from conftest import gateway_entry
+from gateway_simulator import SimulatedGateway
+
+
+def test_async_upgrade_follows_progress_stream(isolated_state, bsp_archive, monkeypatch):
+    monkeypatch.setattr(bsp_upgrade, 'BSP_DIR', str(isolated_state / 'bsps'))
+    simulator = SimulatedGateway(str(isolated_state / 'gateway'), upgrade_seconds=2, reboot_seconds=1).start()
+    ctx = GatewayContext('127.0.0.1', simulator.username, simulator.password, port=simulator.port,
+                         target_version='7.1.2', model_hint='Micro')
+    try:
+        with gateway_context(ctx):
+            assert run_async(async_upgrade_gateway()) == '7.1.2'
+    finally:
+        ctx.close()
+        simulator.stop()
+    # Progress came from the log stream, not from re-reading the kernel log
+    assert not [command for command in simulator.commands if 'grep "BSP upgrade progress:"' in command]
+    assert any('tail -F' in command or 'dmesg -w' in command for command in simulator.commands)
+
+
+def test_async_commands_share_the_persistent_shell(isolated_state, gateway):
+    entry = gateway_entry(gateway)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'])
+
+    async def run_commands(ssh):
+        return [await async_execute_command(ssh, f'echo {word}', use_sudo=True) for word in ('one', 'two')]
+
+    with gateway_context(ctx):
+        try:
+            assert run_async(run_commands(connect_gateway())) == ['one', 'two']
+        finally:
+            ctx.close()
+    # One exec request opened the shell; both commands were lines sent to it
+    assert gateway.commands.count('sh') == 1
+    assert not [command for command in gateway.commands if command.startswith('echo ')]
+
+
+def test_short_calls_do_not_queue_behind_transfers():
+    release = threading.Event()
+
+    async def scenario():
+        transfers = [asyncio.ensure_future(run_transfer(release.wait)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        try:
+            return await asyncio.wait_for(run_blocking(lambda: 'short'), 5)
+        finally:
+            release.set()
+            await asyncio.gather(*transfers)
+
+    assert run_async(scenario(), blocking_workers=2, transfer_workers=2) == 'short'
@@ -0,0 +1,47 @@
+import pytest
+
+from bsp_upgrade import GatewayContext, RemoteBatch, connect_gateway, current_gateway, gateway_context
+from conftest import gateway_entry
+
+
+@pytest.fixture
+def ssh(isolated_state, gateway):
+    entry = gateway_entry(gateway)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'])
+    with gateway_context(ctx):
+        yield connect_gateway()
+    ctx.close()
+
+
+def test_each_step_reports_its_own_output_and_exit_code(ssh):
+    batch = (RemoteBatch('test', stop_on_error=False)
+             .add('no newline', 'printf partial')
+             .add('stderr', 'echo out; echo oops >&2; exit 3')
+             .add('here-document', 'cat <<EOF\nfrom heredoc\nEOF'))
+    round_trips = current_gateway().timings.commands
+    first, second, third = batch.run(ssh)
+
+    assert current_gateway().timings.commands == round_trips + 1
+    assert (first.exit_code, first.output) == (0, 'partial')
+    assert (second.exit_code, second.output, second.error) == (3, 'out', 'oops')
+    assert (third.exit_code, third.output) == (0, 'from heredoc')
+
+
+def test_failed_step_stops_the_batch(ssh):
+    batch = RemoteBatch('test').add('fails', 'false').add('never runs', 'echo ran')
+    failed, skipped = batch.run(ssh)
+    assert not failed.ok and failed.exit_code == 1
+    assert skipped.skipped and skipped.output == ''
+    with pytest.raises(Exception, match='fails failed'):
+        batch.run(ssh, check=True)
+
+
+def test_batch_stops_once_enough_space_is_free(ssh):
+    batch = RemoteBatch('test', stop_on_error=False, space_partition='/', stop_when_free_mb=1)
+    results = batch.add('first', 'true').add('second', 'true').run(ssh)
+    # The simulated flash already has more than 1MB free
+    assert all(result.skipped for result in results)
+
+    batch = RemoteBatch('test', stop_on_error=False, space_partition='/', stop_when_free_mb=10 ** 6)
+    results = batch.add('first', 'true').add('second', 'true').run(ssh)
+    assert all(result.ok and result.available > 0 for result in results)
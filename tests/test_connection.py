@@ -0,0 +1,23 @@
+from bsp_upgrade import GatewayContext, connect_gateway, gateway_context, get_sftp_session, renew_connection
+from conftest import gateway_entry
+
+
+def test_connection_owns_one_sftp_session(isolated_state, gateway):
+    entry = gateway_entry(gateway)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'])
+    with gateway_context(ctx):
+        try:
+            ssh = connect_gateway()
+            sftp = get_sftp_session(ssh)
+            assert get_sftp_session(ssh) is sftp
+            sftp.close()
+            reopened = get_sftp_session(ssh)
+            assert reopened is not sftp
+
+            # After a reconnect the session moves to the new transport
+            renew_connection()
+            renewed = get_sftp_session(ssh)
+            assert renewed is not reopened and renewed.sock.get_transport() is ssh.get_transport()
+            assert renewed.listdir('/')
+        finally:
+            ctx.close()
@@ -0,0 +1,29 @@
+import shutil
+import urllib.request
+
+from bsp_cache import file_sha256
+from bsp_feed_server import FeedServer
+from gateway_simulator import make_bsp_archive
+
+
+def test_reimported_archive_is_served_fresh(tmp_path):
+    server = FeedServer(str(tmp_path / 'feeds'), port=0, bind='127.0.0.1').start()
+    try:
+        archive = str(tmp_path / 'BSP_7.1.2.zip')
+        make_bsp_archive(archive, '7.1.2', package_kb=4)
+        first = server.publish(archive, file_sha256(archive))
+        assert first.endswith('/BSP_7.1.2')
+        assert server.publish(archive, file_sha256(archive)) == first
+
+        # Same name, other content: published under a new path, the old extraction untouched
+        shutil.move(archive, str(tmp_path / 'old.zip'))
+        make_bsp_archive(archive, '7.1.3', package_kb=4)
+        second = server.publish(archive, file_sha256(archive))
+        assert second != first and second.endswith('/BSP_7.1.2')
+
+        url = f"{server.url('127.0.0.1')}/{second}/bsp/Packages"
+        assert b'Version: 7.1.3' in urllib.request.urlopen(url, timeout=10).read()
+        url = f"{server.url('127.0.0.1')}/{first}/bsp/Packages"
+        assert b'Version: 7.1.2' in urllib.request.urlopen(url, timeout=10).read()
+    finally:
+        server.stop()
@@ -0,0 +1,17 @@
+from bsp_fleet import INVENTORY_FIELDS, load_inventory
+
+
+def test_inventory_fields_cover_every_column(tmp_path):
+    inventory = tmp_path / 'inventory.csv'
+    inventory.write_text(','.join(INVENTORY_FIELDS) + '\n'
+                         '# comment\n'
+                         '10.0.0.1,admin,secret,Micro,sudo-secret,site-a,192.168.1.1,yes,2222\n'
+                         '\n'
+                         '10.0.0.2,,,,,,,,\n')
+    first, second = load_inventory(str(inventory))
+
+    assert set(first) == set(INVENTORY_FIELDS)
+    assert first == {'ip': '10.0.0.1', 'username': 'admin', 'password': 'secret', 'model': 'Micro',
+                     'sudo_password': 'sudo-secret', 'site': 'site-a', 'lan_ip': '192.168.1.1',
+                     'relay': True, 'port': 2222}
+    assert second['username'] == 'root' and second['sudo_password'] is None and second['port'] is None
@@ -0,0 +1,72 @@
+import sqlite3
+
+import bsp_upgrade
+from bsp_journal import UpgradeJournal
+from bsp_upgrade import (
+    GatewayContext, connect_gateway, gateway_context, get_bsp_manifest, get_bsp_store, get_journal,
+    upload_and_prepare_bsp,
+)
+from conftest import gateway_entry
+
+
+def prepare(simulator, bsp_file):
+    entry = gateway_entry(simulator)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'],
+                         upload_mode='delta')
+    with gateway_context(ctx):
+        try:
+            ssh = connect_gateway()
+            ctx.hop = ('7.1.2', get_bsp_manifest(bsp_file).sha256)
+            upload_and_prepare_bsp(ssh, ssh.open_sftp(), bsp_file)
+        finally:
+            ctx.close()
+
+
+def test_prepared_delta_is_resumed_from_journal(isolated_state, gateway, bsp_archive, monkeypatch):
+    bsp_file = get_bsp_store().import_archive(bsp_archive)
+    prepare(gateway, bsp_file)
+    entry = get_journal().entry('127.0.0.1', get_bsp_manifest(bsp_file).sha256)
+    assert entry.phase == 'feed_written'
+    assert entry.payload and entry.payload != entry.archive
+
+    def rebuilt(*args, **kwargs):
+        raise AssertionError("delta archive built again")
+    monkeypatch.setattr(bsp_upgrade, 'prepare_delta_archive', rebuilt)
+    monkeypatch.setattr(bsp_upgrade, 'transfer_archive', rebuilt)
+    prepare(gateway, bsp_file)
+    assert get_journal().entry('127.0.0.1', entry.archive).payload == entry.payload
+
+
+def test_pending_is_the_latest_unconfirmed_hop(tmp_path):
+    journal = UpgradeJournal(str(tmp_path / 'journal.sqlite'))
+    journal.record('10.0.0.1', '4.0.2', 'a' * 64, 'confirmed')
+    journal.record('10.0.0.1', '7.1.2', 'b' * 64, 'extracted')
+    journal.record('10.0.0.2', '7.1.2', 'b' * 64, 'uploaded')
+
+    entry = journal.pending('10.0.0.1')
+    assert (entry.version, entry.phase) == ('7.1.2', 'extracted')
+    assert entry.reached('verified') and not entry.reached('feed_written')
+
+    # A repeated earlier phase moves the hop back
+    journal.record('10.0.0.1', '7.1.2', 'b' * 64, 'uploaded')
+    assert not journal.entry('10.0.0.1', 'b' * 64).reached('verified')
+
+    journal.forget('10.0.0.1')
+    assert journal.pending('10.0.0.1') is None
+    assert journal.pending('10.0.0.2').phase == 'uploaded'
+
+
+def test_journal_without_payload_column_is_migrated(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE hops (gateway TEXT NOT NULL, archive TEXT NOT NULL, version TEXT NOT NULL, '
+               'phase TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (gateway, archive))')
+    db.execute("INSERT INTO hops VALUES ('10.0.0.1', 'abc', '7.1.2', 'verified', 1.0)")
+    db.commit()
+    db.close()
+
+    journal = UpgradeJournal(path)
+    entry = journal.entry('10.0.0.1', 'abc')
+    assert entry.phase == 'verified' and entry.payload is None
+    journal.record('10.0.0.1', '7.1.2', 'abc', 'extracted', payload='def')
+    assert journal.entry('10.0.0.1', 'abc').payload == 'def'
@@ -0,0 +1,31 @@
+import os
+
+from bsp_metrics import FleetMetrics
+from test_relay import seed_relay
+
+
+def test_relay_seeding_reaches_fleet_metrics(isolated_state, gateway, bsp_archive, monkeypatch):
+    metrics = FleetMetrics(jsonl=str(isolated_state / 'metrics.jsonl'))
+    relay, requester, _ = seed_relay(gateway, bsp_archive, monkeypatch, metrics=metrics)
+    metrics.close()
+
+    size = os.path.getsize(bsp_archive)
+    assert metrics.totals()['bsp_upload_bytes_total'] >= size
+    assert ('bsp_upload_bytes_total', (('gateway', relay.ip), ('path', 'sftp'))) in metrics.counters
+    assert 'bsp_upload_throughput_bytes_per_second' in metrics.render()
+    # The seeding upload is part of the requesting gateway's run
+    assert requester.timings.bytes_sent >= size
+    assert requester.timings.commands > 0
+
+
+def test_textfile_is_written_on_close(tmp_path):
+    textfile = tmp_path / 'bsp.prom'
+    metrics = FleetMetrics(textfile=str(textfile))
+    metrics.inc('bsp_runs_total', gateway='10.0.0.1', status='ok')
+    metrics.observe('bsp_run_duration_seconds', 700, gateway='10.0.0.1', model='Micro', status='ok')
+    metrics.close()
+
+    text = textfile.read_text()
+    assert 'bsp_runs_total{gateway="10.0.0.1",status="ok"} 1' in text
+    assert 'bsp_run_duration_seconds_bucket{model="Micro",status="ok",le="1200"} 1' in text
+    assert metrics.totals() == {'bsp_runs_total': 1}
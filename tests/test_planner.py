@@ -0,0 +1,63 @@
+import bsp_upgrade
+from bsp_planner import UpgradeGraph
+from bsp_upgrade import DurationStats, get_hop_stats, get_upgrade_graph
+
+RULES = [('3.x.x', '4.0.2'), ('4.0.2', '7.x.x'), ('3.x.x', '7.x.x')]
+
+
+def seconds_only(seconds, transfer_bytes, flash_mb):
+    return seconds
+
+
+def graph(versions, rules=RULES):
+    """Graph over {version: seconds} with no transfer or flash cost"""
+    return UpgradeGraph('Micro', rules, {version: (seconds, 0, 0) for version, seconds in versions.items()},
+                        seconds_only)
+
+
+def test_direct_hop_when_the_rules_allow_it():
+    plan = graph({'3.3.7': 0, '4.0.2': 100, '7.1.2': 300}).plan('3.3.7', '7.1.2')
+    assert plan.path == ['7.1.2'] and plan.cost == 300
+
+
+def test_cheapest_intermediate_version_is_chosen():
+    rules = [('3.x.x', '4.0.x'), ('4.0.x', '7.x.x')]
+    plan = graph({'3.3.7': 0, '4.0.2': 50, '4.0.3': 200, '7.1.2': 300}, rules).plan('3.3.7', '7.1.2')
+    assert plan.path == ['4.0.2', '7.1.2']
+    assert plan.cost == plan.seconds == 350
+
+
+def test_cheapest_matching_target_is_chosen():
+    plan = graph({'4.0.2': 0, '7.1.2': 500, '7.2.0': 100}).plan('4.0.2', '7.x.x')
+    assert plan.path == ['7.2.0']
+
+
+def test_pattern_target_prefers_newest_on_equal_cost():
+    plan = graph({'4.0.2': 0, '7.1.2': 50, '7.2.0': 50}).plan('4.0.2', '7.x.x')
+    assert plan.path == ['7.2.0']
+
+
+def test_unreachable_target_has_no_plan():
+    assert graph({'3.3.7': 0, '4.0.2': 100}).plan('3.3.7', '7.x.x') is None
+
+
+def test_already_at_target_needs_no_steps():
+    plan = graph({'7.1.2': 0}).plan('7.1.2', '7.x.x')
+    assert plan.path == [] and plan.cost == 0
+
+
+def test_upgrade_graph_is_reused_until_hop_stats_change(isolated_state, bsp_archive, monkeypatch):
+    monkeypatch.setattr(bsp_upgrade, 'BSP_DIR', str(isolated_state / 'bsps'))
+    monkeypatch.setattr(bsp_upgrade, '_upgrade_graphs', {})
+    graph = get_upgrade_graph('Micro', 'full')
+
+    loads = []
+    load = DurationStats._load
+    monkeypatch.setattr(DurationStats, '_load', lambda self: loads.append(self.path) or load(self))
+    assert get_upgrade_graph('Micro', 'full') is graph
+    assert not loads
+
+    get_hop_stats().record('Micro 7.1.2', 3600)
+    updated = get_upgrade_graph('Micro', 'full')
+    assert updated is not graph
+    assert updated.versions['7.1.2'][0] >= 3600
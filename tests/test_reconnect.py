@@ -0,0 +1,53 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import bsp_upgrade
+from bsp_upgrade import (
+    GatewayContext, SSHConnectionError, backoff_delays, connect_gateway, execute_command, gateway_context,
+    reconnect_ssh,
+)
+from conftest import gateway_entry
+
+
+def test_backoff_doubles_with_jitter_up_to_the_cap():
+    delays = backoff_delays(0.5, 4)
+    steps = [0.5, 1, 2, 4, 4, 4]
+    for step in steps:
+        assert step / 2 <= next(delays) <= step
+
+
+def test_reconnect_waits_for_the_port_then_shakes_hands_once(isolated_state, gateway, monkeypatch):
+    gateway.reboot_seconds = 1
+    handshakes = []
+    open_ssh_client = bsp_upgrade.open_ssh_client
+    monkeypatch.setattr(bsp_upgrade, 'open_ssh_client', lambda: handshakes.append(time.time()) or open_ssh_client())
+    entry = gateway_entry(gateway)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'])
+    with gateway_context(ctx):
+        try:
+            ssh = connect_gateway()
+            rebooting = threading.Thread(target=gateway.reboot)
+            rebooting.start()
+            time.sleep(0.1)
+            handshakes.clear()
+            try:
+                assert reconnect_ssh(max_attempts=5, delay=2) is ssh
+            finally:
+                rebooting.join()
+            # Probing the port while the gateway was down cost no SSH handshakes
+            assert len(handshakes) == 1
+            assert execute_command(ssh, 'echo up') == 'up'
+        finally:
+            ctx.close()
+
+
+def test_reconnect_gives_up_when_the_port_stays_closed(isolated_state):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    ctx = GatewayContext('127.0.0.1', 'root', 'sim', port=port)
+    with gateway_context(ctx), pytest.raises(SSHConnectionError):
+        reconnect_ssh(max_attempts=2, delay=0.5)
@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+
+from bsp_relay import SiteRelay
+from bsp_rollout import UploadBudget
+from bsp_upgrade import GatewayContext, gateway_context
+from conftest import gateway_entry
+
+
+class RecordingBudget(UploadBudget):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.consumed = 0
+
+    def consume(self, nbytes):
+        self.consumed += nbytes
+        super().consume(nbytes)
+
+
+def seed_relay(simulator, bsp_archive, monkeypatch, relay=None, **requester_options):
+    # Seeding is what is tested here; serving would leave a busybox httpd running on the host
+    monkeypatch.setattr(SiteRelay, '_serve', lambda self, ssh, name: None)
+    relay = relay or SiteRelay('site-a', gateway_entry(simulator))
+    requester = GatewayContext('127.0.0.9', 'root', 'sim', **requester_options)
+    with gateway_context(requester):
+        url = relay.archive_url(bsp_archive)
+    return relay, requester, url
+
+
+def test_seeding_consumes_requester_upload_budget(isolated_state, gateway, bsp_archive, monkeypatch):
+    budget = RecordingBudget(bandwidth=1024 * 1024 * 1024)
+    seed_relay(gateway, bsp_archive, monkeypatch, throttle=budget)
+    assert budget.consumed >= os.path.getsize(bsp_archive)
+
+
+def test_verified_copy_is_not_seeded_again(isolated_state, gateway, bsp_archive, monkeypatch):
+    seed_relay(gateway, bsp_archive, monkeypatch)
+    budget = RecordingBudget()
+    _, _, url = seed_relay(gateway, bsp_archive, monkeypatch, throttle=budget)
+    assert budget.consumed == 0
+    assert url.endswith('/BSP_7.1.2.zip')
+
+
+def test_concurrent_requester_does_not_take_over_seeding(isolated_state, gateway, bsp_archive, monkeypatch):
+    relay = SiteRelay('site-a', gateway_entry(gateway))
+    second_budget = RecordingBudget(bandwidth=1024 * 1024 * 1024)
+    second = []
+
+    def ask_for_archive():
+        second.append(seed_relay(gateway, bsp_archive, monkeypatch, relay, throttle=second_budget)[1])
+
+    class FirstBudget(RecordingBudget):
+        def consume(self, nbytes):
+            super().consume(nbytes)
+            if not hasattr(self, 'other'):
+                # Another gateway of the site asks for the archive while it is being seeded
+                self.other = threading.Thread(target=ask_for_archive)
+                self.other.start()
+                time.sleep(0.2)
+
+    first_budget = FirstBudget(bandwidth=1024 * 1024 * 1024)
+    _, first, _ = seed_relay(gateway, bsp_archive, monkeypatch, relay, throttle=first_budget)
+    first_budget.other.join()
+    size = os.path.getsize(bsp_archive)
+    assert first_budget.consumed >= size and first.timings.bytes_sent >= size
+    assert second_budget.consumed == 0 and second[0].timings.bytes_sent == 0
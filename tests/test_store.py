@@ -0,0 +1,35 @@
+import os
+import shutil
+
+from bsp_cache import BSPStore, file_sha256
+
+
+def test_import_stores_archive_and_manifest_once(tmp_path, bsp_archive):
+    store = BSPStore(str(tmp_path / 'store'))
+    stored = store.import_archive(bsp_archive)
+    sha256 = file_sha256(bsp_archive)
+
+    assert stored == os.path.join(store.root, 'objects', sha256, 'BSP_7.1.2.zip')
+    manifest = store.manifest(stored)
+    assert manifest.sha256 == sha256 and manifest.size == os.path.getsize(bsp_archive)
+    assert 'Packages' in {os.path.basename(name) for name in manifest.files}
+    assert store.import_archive(bsp_archive) == stored
+    assert store.find('BSP_7.1.2.zip') == stored
+
+
+def test_archive_replaced_under_the_same_name_gets_a_new_object(tmp_path, bsp_archive):
+    store = BSPStore(str(tmp_path / 'store'))
+    first = store.import_archive(bsp_archive)
+    with open(bsp_archive, 'ab') as f:
+        f.write(b'\0')
+    second = store.import_archive(bsp_archive)
+
+    assert second != first and os.path.exists(first)
+    assert store.find('BSP_7.1.2.zip') == second
+    # The index survives a new store instance and outlives the source directory
+    shutil.rmtree(os.path.dirname(bsp_archive))
+    assert BSPStore(store.root).find('BSP_7.1.2.zip') == second
+
+
+def test_manifest_of_a_file_outside_the_store_is_none(tmp_path, bsp_archive):
+    assert BSPStore(str(tmp_path / 'store')).manifest(bsp_archive) is None
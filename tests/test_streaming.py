@@ -0,0 +1,60 @@
+import os
+import zipfile
+
+import pytest
+
+import bsp_upgrade
+from bsp_upgrade import (
+    GatewayContext, OutputTail, TransferSettings, connect_gateway, execute_command, gateway_context,
+    stream_archive_entries, stream_command,
+)
+from conftest import gateway_entry
+
+
+def test_stream_survives_chatty_tar(isolated_state, gateway, tmp_path):
+    # Entries dated in the future make GNU tar warn about each of them on stderr,
+    # far more than the small channel window below lets through unread
+    archive = str(tmp_path / 'BSP_7.1.2.zip')
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for i in range(3000):
+            zf.writestr(zipfile.ZipInfo(f'bsp/file{i:04d}', date_time=(2100, 1, 1, 0, 0, 0)), b'x')
+
+    entry = gateway_entry(gateway)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'],
+                         transfer=TransferSettings(window_size=32768))
+    with gateway_context(ctx):
+        try:
+            sent = stream_archive_entries(connect_gateway(), archive)
+        finally:
+            ctx.close()
+
+    assert sent > 3000 * 512
+    extracted = gateway.root + bsp_upgrade.REMOTE_BSP_DIR + 'bsp'
+    assert len(os.listdir(extracted)) == 3000
+
+
+def test_output_tail_keeps_the_latest_bytes_and_passes_every_line():
+    lines = []
+    tail = OutputTail('stdout', limit=10, on_line=lambda stream, line: lines.append(line))
+    for chunk in (b'first\nsec', b'ond\r\n', b'third line\nlast'):
+        tail.write(chunk)
+    tail.close()
+
+    assert lines == ['first', 'second', 'third line', 'last']
+    assert tail.text() == ' line\nlast'
+    assert tail.dropped == tail.total - 10
+
+
+def test_commands_fail_on_exit_status_not_on_stderr(isolated_state, gateway):
+    entry = gateway_entry(gateway)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'])
+    with gateway_context(ctx):
+        try:
+            ssh = connect_gateway()
+            assert execute_command(ssh, 'echo warning >&2; echo ok') == 'ok'
+            result = stream_command(ssh, 'echo partial; exit 4')
+            assert (result.exit_status, result.out.strip()) == (4, 'partial')
+            with pytest.raises(Exception, match='exit status 4'):
+                execute_command(ssh, 'exit 4')
+        finally:
+            ctx.close()
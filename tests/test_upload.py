@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import bsp_upgrade
+from bsp_upgrade import (
+    SFTPError, GatewayContext, TransferSettings, connect_gateway, gateway_context, get_sftp_session,
+    upload_file_resumable,
+)
+from conftest import gateway_entry
+
+CHUNK_SIZE = 64 * 1024
+
+
+@pytest.fixture
+def upload_context(isolated_state, gateway):
+    entry = gateway_entry(gateway)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'],
+                         transfer=TransferSettings(chunk_size=CHUNK_SIZE, streams=1))
+    with gateway_context(ctx):
+        yield connect_gateway()
+    ctx.close()
+
+
+def record_sent_chunks(monkeypatch):
+    sent = []
+    transfer_chunks = bsp_upgrade.transfer_chunks
+
+    def recording(channels, local_file, remote_file, chunk_size, missing, *args):
+        sent.extend(missing)
+        return transfer_chunks(channels, local_file, remote_file, chunk_size, missing, *args)
+    monkeypatch.setattr(bsp_upgrade, 'transfer_chunks', recording)
+    return sent
+
+
+def interrupt_after(monkeypatch, chunks):
+    save = bsp_upgrade.save_upload_checkpoint
+
+    def saving(local_file, checkpoint):
+        save(local_file, checkpoint)
+        if len(checkpoint['chunks']) == chunks:
+            raise IOError("connection dropped")
+    monkeypatch.setattr(bsp_upgrade, 'save_upload_checkpoint', saving)
+
+
+def upload(ssh, bsp_archive, max_retries=0):
+    remote_file = bsp_upgrade.REMOTE_BSP_DIR + os.path.basename(bsp_archive)
+    ssh.exec_command(f'mkdir -p {bsp_upgrade.REMOTE_BSP_DIR}')[1].channel.recv_exit_status()
+    upload_file_resumable(ssh, get_sftp_session(ssh), bsp_archive, remote_file, max_retries=max_retries)
+    return remote_file
+
+
+def test_interrupted_upload_resumes_from_checkpoint(upload_context, gateway, bsp_archive, monkeypatch):
+    total = -(-os.path.getsize(bsp_archive) // CHUNK_SIZE)
+    with monkeypatch.context() as interrupted:
+        interrupt_after(interrupted, 3)
+        with pytest.raises(SFTPError):
+            upload(upload_context, bsp_archive)
+
+    sent = record_sent_chunks(monkeypatch)
+    remote_file = upload(upload_context, bsp_archive)
+    assert sorted(sent) == list(range(3, total))
+    with open(gateway.root + remote_file, 'rb') as remote, open(bsp_archive, 'rb') as local:
+        assert remote.read() == local.read()
+    assert not os.listdir(bsp_upgrade.UPLOAD_CHECKPOINT_DIR)
+
+
+def test_corrupt_chunk_on_gateway_is_sent_again(upload_context, gateway, bsp_archive, monkeypatch):
+    with monkeypatch.context() as interrupted:
+        interrupt_after(interrupted, 3)
+        with pytest.raises(SFTPError):
+            upload(upload_context, bsp_archive)
+    remote_path = gateway.root + bsp_upgrade.REMOTE_BSP_DIR + os.path.basename(bsp_archive)
+    with open(remote_path, 'r+b') as f:
+        f.seek(CHUNK_SIZE + 10)
+        f.write(b'corrupt')
+
+    sent = record_sent_chunks(monkeypatch)
+    upload(upload_context, bsp_archive)
+    assert 1 in sent and 0 not in sent and 2 not in sent
+    with open(remote_path, 'rb') as remote, open(bsp_archive, 'rb') as local:
+        assert remote.read() == local.read()
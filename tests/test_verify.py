@@ -0,0 +1,24 @@
+import bsp_upgrade
+from bsp_upgrade import (
+    GatewayContext, connect_gateway, gateway_context, get_bsp_manifest, stream_archive_entries, verify_extracted_files,
+)
+from conftest import gateway_entry
+
+
+def test_long_file_lists_are_hashed_in_batches(isolated_state, gateway, bsp_archive, monkeypatch):
+    manifest = get_bsp_manifest(bsp_archive)
+    monkeypatch.setattr(bsp_upgrade, 'COMMAND_ARGS_LIMIT', 200)
+    entry = gateway_entry(gateway)
+    ctx = GatewayContext(entry['ip'], entry['username'], entry['password'], port=entry['port'])
+    with gateway_context(ctx):
+        try:
+            ssh = connect_gateway()
+            stream_archive_entries(ssh, bsp_archive)
+            verify_extracted_files(ssh, manifest)
+        finally:
+            ctx.close()
+
+    hashing = [command for command in gateway.commands if 'sha256sum "' in command]
+    assert len(hashing) > 1
+    listed = [name for command in hashing for name in manifest.files if f'"{name}"' in command]
+    assert sorted(listed) == sorted(manifest.files)